@@ -1,9 +1,17 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from werkzeug.utils import secure_filename
+import json
 import os
-from upload_worker import process_file_background
+import shutil
+import tempfile
+import time
+import metrics
+from upload_worker import process_file_background, pipeline
 from logger_config import setup_logger
-from vector_db import vector_db
+from metadata_index import validate_where
+from query_coalescer import search_coalescer
+from sharded_collection import collection_registry
+from vector_db import DOCUMENT_FIELDS, vector_db
 
 # Set up logging
 logger = setup_logger(__name__)
@@ -14,9 +22,48 @@ UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = 1 * 1024 * 1024 * 1024  # 1GB max
+# Largest number of queries accepted by /search/batch
+MAX_BATCH_QUERIES = int(os.getenv("SEARCH_BATCH_LIMIT", "1000"))
+# Largest n_results accepted by /search and /search/batch
+MAX_SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS_LIMIT", "1000"))
+# Documents per /documents page, by default and at most
+DOCUMENTS_PAGE_SIZE = int(os.getenv("DOCUMENTS_PAGE_SIZE", "100"))
+MAX_DOCUMENTS_PAGE_SIZE = int(os.getenv("DOCUMENTS_PAGE_LIMIT", "1000"))
 
 logger.info("Flask application starting up")
 
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    if "started" in g:
+        # Routes rather than paths, so document IDs do not create a series each
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.started, method=request.method,
+                                        endpoint=endpoint, status=response.status_code)
+    return response
+
+def _database(name, create=False):
+    """The shared database, or the named collection when ``name`` is given.
+    
+    Only uploads pass ``create``; the other routes get a 404 for a
+    collection that does not exist. Returns (database, error response); the
+    error response is None if the collection can be used.
+    """
+    if name is None:
+        return vector_db, None
+    try:
+        collection = collection_registry.get(name, create=create)
+    except ValueError as e:
+        logger.warning(f"Request with invalid collection {name!r}")
+        return None, (jsonify({"error": str(e)}), 400)
+    if collection is None:
+        logger.warning(f"Request for missing collection {name!r}")
+        return None, (jsonify({"error": f"Collection {name} not found"}), 404)
+    return collection, None
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
     logger.info("Upload endpoint called")
@@ -30,21 +77,111 @@ def upload_file():
         logger.warning("Upload request with empty filename")
         return jsonify({"error": "No selected file"}), 400
 
+    # Only a well-formed upload creates its collection
+    db, error = _database(request.form.get("collection"), create=True)
+    if error:
+        return error
+
     filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    # A directory of its own, so a queued upload is not overwritten by a later one of the same name
+    upload_dir = tempfile.mkdtemp(dir=app.config["UPLOAD_FOLDER"])
+    file_path = os.path.join(upload_dir, filename)
     file.save(file_path)
     
     logger.info(f"File saved: {filename} at {file_path}")
     
-    process_file_background(file_path)
-    logger.info(f"Started background processing for file: {filename}")
+    # The pipeline writes to the shared database unless told otherwise
+    if not process_file_background(file_path, None if db is vector_db else db):
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return _queue_full_response()
+    logger.info(f"Queued background processing for file: {filename}")
     
     return jsonify({"status": f"File {filename} is being processed"}), 202
 
+def _queue_full_response():
+    retry_after = pipeline.retry_after()
+    logger.warning(f"Upload rejected, ingestion queue is full (retry after {retry_after}s)")
+    response = jsonify({"error": "Ingestion queue is full, retry later", "retry_after": retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+@app.route("/ingestion/stats", methods=["GET"])
+def ingestion_stats():
+    """Get queue depth and batching statistics of the ingestion pipeline"""
+    logger.info("Ingestion stats endpoint called")
+    return jsonify(pipeline.get_stats())
+
+@app.route("/search/stats", methods=["GET"])
+def search_stats():
+    """Get batching statistics of the /search request coalescer"""
+    logger.info("Search stats endpoint called")
+    return jsonify(search_coalescer.get_stats())
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Latency histograms, counters and gauges of every server process in the Prometheus text format"""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/collections", methods=["GET"])
+def list_collections():
+    """List the names of the sharded collections"""
+    logger.info("List collections endpoint called")
+    return jsonify({"collections": collection_registry.names()})
+
 @app.route("/health", methods=["GET"])
 def health():
     logger.info("Health check endpoint accessed")
-    return jsonify({"status": "ok"})
+    # A worker is healthy while it warms up; "ready" tells when it has loaded the index
+    return jsonify({"status": "ok", "ready": vector_db.ready})
+
+def _search_options(data):
+    """Read the search options shared by /search and /search/batch.
+    
+    Returns (options, error response); the error response is None if the
+    options are valid.
+    """
+    n_results = data.get('n_results', 5)
+    if not isinstance(n_results, int) or isinstance(n_results, bool) or not 1 <= n_results <= MAX_SEARCH_RESULTS:
+        logger.warning(f"Search request with invalid n_results: {n_results!r}")
+        return None, (jsonify({"error": f"n_results must be an integer between 1 and {MAX_SEARCH_RESULTS}"}), 400)
+    options = {
+        'n_results': n_results,
+        # Fold passage hits of chunked uploads back into their parent document
+        'collapse': bool(data.get('collapse', False)),
+    }
+    # Recall/speed knobs of approximate indexes (IVF lists probed, HNSW candidate list size)
+    for knob in ('nprobe', 'ef_search'):
+        value = data.get(knob)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            logger.warning(f"Search request with invalid {knob}: {value!r}")
+            return None, (jsonify({"error": f"{knob} must be a positive integer"}), 400)
+        options[knob] = value
+    # Metadata filter, e.g. {"filename": "notes.txt", "file_size": {"$lt": 10000}}
+    where = data.get('where')
+    if where is not None:
+        try:
+            validate_where(where)
+        except ValueError as e:
+            logger.warning(f"Search request with invalid where: {e}")
+            return None, (jsonify({"error": str(e)}), 400)
+        options['where'] = where
+    return options, None
+
+def _format_results(results, i=0):
+    """Format the results of the i-th query of a nested search result"""
+    formatted_results = []
+    if results['documents'] and results['documents'][i]:
+        for j, doc in enumerate(results['documents'][i]):
+            result = {
+                'content': doc,
+                'metadata': results['metadatas'][i][j] if results['metadatas'] and results['metadatas'][i] else {},
+                'distance': results['distances'][i][j] if results['distances'] and results['distances'][i] else None,
+                'id': results['ids'][i][j] if results['ids'] and results['ids'][i] else None
+            }
+            formatted_results.append(result)
+    return formatted_results
 
 @app.route("/search", methods=["POST"])
 def search_documents():
@@ -57,50 +194,123 @@ def search_documents():
         return jsonify({"error": "Query is required"}), 400
     
     query = data['query']
-    n_results = data.get('n_results', 5)
+    options, error = _search_options(data)
+    if error:
+        return error
+    db, error = _database(data.get('collection'))
+    if error:
+        return error
     
-    logger.info(f"Searching for: '{query}' with {n_results} results")
+    logger.info(f"Searching for: '{query}' with {options['n_results']} results")
     
-    results = vector_db.search_documents(query, n_results)
+    # Concurrent searches with the same options share one vectorizer and index call
+    results = search_coalescer.search_documents(db, query, **options)
     
     if results is None:
         return jsonify({"error": "Search failed"}), 500
     
     # Format results for response
-    formatted_results = []
-    if results['documents'] and results['documents'][0]:
-        for i, doc in enumerate(results['documents'][0]):
-            result = {
-                'content': doc,
-                'metadata': results['metadatas'][0][i] if results['metadatas'] and results['metadatas'][0] else {},
-                'distance': results['distances'][0][i] if results['distances'] and results['distances'][0] else None,
-                'id': results['ids'][0][i] if results['ids'] and results['ids'][0] else None
-            }
-            formatted_results.append(result)
+    with metrics.STAGE_SECONDS.time(operation="search", stage="serialize"):
+        formatted_results = _format_results(results)
+        response = jsonify({
+            "query": query,
+            "collapse": options['collapse'],
+            "results": formatted_results,
+            "count": len(formatted_results)
+        })
+    return response
+
+@app.route("/search/batch", methods=["POST"])
+def search_documents_batch():
+    """Search documents for many queries in one vectorizer and index call"""
+    logger.info("Batch search endpoint called")
     
-    return jsonify({
-        "query": query,
-        "results": formatted_results,
-        "count": len(formatted_results)
-    })
+    data = request.get_json()
+    queries = data.get('queries') if data else None
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+        logger.warning("Batch search request missing queries")
+        return jsonify({"error": "queries must be a non-empty list of strings"}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        logger.warning(f"Batch search request with {len(queries)} queries")
+        return jsonify({"error": f"At most {MAX_BATCH_QUERIES} queries per batch"}), 400
+    options, error = _search_options(data)
+    if error:
+        return error
+    db, error = _database(data.get('collection'))
+    if error:
+        return error
+    
+    logger.info(f"Searching for {len(queries)} queries with {options['n_results']} results each")
+    
+    results = db.search_documents_batch(queries, **options)
+    
+    if results is None:
+        return jsonify({"error": "Search failed"}), 500
+    
+    with metrics.STAGE_SECONDS.time(operation="search", stage="serialize"):
+        batch = []
+        for i, query in enumerate(queries):
+            formatted_results = _format_results(results, i)
+            batch.append({
+                "query": query,
+                "results": formatted_results,
+                "count": len(formatted_results)
+            })
+        response = jsonify({
+            "collapse": options['collapse'],
+            "results": batch,
+            "count": len(batch)
+        })
+    return response
 
 @app.route("/documents", methods=["GET"])
 def list_documents():
-    """List all documents in the vector database"""
+    """List documents in the vector database, one page at a time"""
     logger.info("List documents endpoint called")
     
-    documents = vector_db.list_documents()
+    limit = request.args.get('limit', str(DOCUMENTS_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_DOCUMENTS_PAGE_SIZE:
+        logger.warning(f"List documents request with invalid limit: {limit!r}")
+        return jsonify({"error": f"limit must be between 1 and {MAX_DOCUMENTS_PAGE_SIZE}"}), 400
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else DOCUMENT_FIELDS
+    output = request.args.get('format', 'json')
+    if output not in ('json', 'ndjson'):
+        return jsonify({"error": "format must be json or ndjson"}), 400
+    db, error = _database(request.args.get('collection'))
+    if error:
+        return error
+    
+    try:
+        page, next_cursor = db.list_documents_page(int(limit), request.args.get('after'), fields)
+    except ValueError as e:
+        logger.warning(f"List documents request rejected: {e}")
+        return jsonify({"error": str(e)}), 400
+    
+    if output == 'ndjson':
+        # One document per line, serialized as the response is sent
+        response = Response((json.dumps(document) + "\n" for document in page), mimetype="application/x-ndjson")
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return response
+    
+    documents = list(page)
     return jsonify({
         "documents": documents,
-        "count": len(documents)
+        "count": len(documents),
+        "total": db.get_document_count(),
+        "next_cursor": next_cursor
     })
 
 @app.route("/documents/<document_id>", methods=["GET"])
 def get_document(document_id):
     """Get a specific document by ID"""
     logger.info(f"Get document endpoint called for ID: {document_id}")
+    db, error = _database(request.args.get('collection'))
+    if error:
+        return error
     
-    document = vector_db.get_document(document_id)
+    document = db.get_document(document_id)
     
     if document is None:
         return jsonify({"error": "Document not found"}), 404
@@ -111,8 +321,11 @@ def get_document(document_id):
 def delete_document(document_id):
     """Delete a document from the vector database"""
     logger.info(f"Delete document endpoint called for ID: {document_id}")
+    db, error = _database(request.args.get('collection'))
+    if error:
+        return error
     
-    success = vector_db.delete_document(document_id)
+    success = db.delete_document(document_id)
     
     if success:
         return jsonify({"message": f"Document {document_id} deleted successfully"})
@@ -123,8 +336,11 @@ def delete_document(document_id):
 def get_db_info():
     """Get information about the vector database"""
     logger.info("Database info endpoint called")
+    db, error = _database(request.args.get('collection'))
+    if error:
+        return error
     
-    info = vector_db.get_collection_info()
+    info = db.get_collection_info()
     
     if info is None:
         return jsonify({"error": "Failed to get database info"}), 500
@@ -0,0 +1,285 @@
+"""Offline benchmark for ingestion, search and persistence.
+
+Every corpus size runs in a fresh process against a temporary directory, so
+peak RSS and load times are not skewed by earlier runs. Results are written
+as JSON; pass an earlier result file as ``--baseline`` to fail on
+regressions.
+
+    python benchmark.py --sizes 10000 100000 --output results.json
+    python benchmark.py --sizes 10000 --baseline results.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+def _zipf_probabilities(vocabulary: int) -> np.ndarray:
+    weights = 1.0 / np.arange(1, vocabulary + 1)
+    return weights / weights.sum()
+
+def synthetic_batches(n: int, batch_size: int = 1000, length: int = 100, vocabulary: int = 5000,
+                      seed: int = 0) -> Iterator[Tuple[List[str], List[str]]]:
+    """Yield (ids, documents) batches of a reproducible synthetic corpus of ``n`` documents.
+
+    Documents hold ``length`` words on average (between half and one and a
+    half times as many), drawn from a Zipf-distributed vocabulary like
+    natural text.
+    """
+    rng = np.random.default_rng(seed)
+    probabilities = _zipf_probabilities(vocabulary)
+    words = np.array([f"term{i}" for i in range(vocabulary)])
+    for start in range(0, n, batch_size):
+        count = min(batch_size, n - start)
+        lengths = rng.integers(max(length // 2, 1), length + length // 2 + 1, size=count)
+        tokens = words[rng.choice(vocabulary, size=int(lengths.sum()), p=probabilities)]
+        bounds = np.concatenate(([0], np.cumsum(lengths)))
+        documents = [" ".join(tokens[bounds[i]:bounds[i + 1]]) for i in range(count)]
+        yield [f"doc{start + i}" for i in range(count)], documents
+
+def synthetic_queries(n: int, words: int = 3, vocabulary: int = 5000, seed: int = 1) -> List[str]:
+    """Reproducible queries drawn from the corpus vocabulary."""
+    rng = np.random.default_rng(seed)
+    choices = rng.choice(vocabulary, size=(n, words), p=_zipf_probabilities(vocabulary))
+    return [" ".join(f"term{i}" for i in row) for row in choices]
+
+def latency_stats(seconds: List[float]) -> Dict[str, float]:
+    """Summarize latencies in milliseconds."""
+    ms = np.asarray(seconds) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+def _timed(function, *args, **kwargs) -> float:
+    started = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - started
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _directory_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names)
+
+def run_size(size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Benchmark one corpus size in a temporary directory."""
+    from vector_db import VectorDatabase
+    import app as app_module
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    def open_database(**kwargs):
+        # The query cache would turn repeated measurements into cache hits
+        return VectorDatabase(directory, backend=options["backend"], index_type=options["index_type"],
+                              cache_size=options["cache_size"], **kwargs)
+
+    directory = tempfile.mkdtemp(prefix="vector-benchmark-")
+    try:
+        result = {"documents": size}
+        db = open_database()
+
+        seconds = 0.0
+        for ids, documents in synthetic_batches(size, options["ingest_batch_size"], options["doc_length"],
+                                                options["vocabulary"]):
+            metadatas = [{"source": "benchmark", "n": int(doc_id[3:])} for doc_id in ids]
+            seconds += _timed(db.add_documents, documents, metadatas, ids)
+        settle = _timed(lambda: (db.store.wait_for_merges(), db.wait_for_compaction()))
+        result["ingest"] = {
+            "seconds": seconds,
+            "docs_per_second": size / seconds,
+            "settle_seconds": settle,
+            "disk_bytes": _directory_bytes(directory),
+        }
+        logger.info(f"{size} documents: ingested at {size / seconds:.0f} docs/s")
+
+        queries = synthetic_queries(options["queries"], vocabulary=options["vocabulary"])
+        n_results = options["n_results"]
+        result["query"] = latency_stats([_timed(db.query, query, n_results) for query in queries])
+        batch = options["query_batch_size"]
+        batches = [queries[i:i + batch] for i in range(0, len(queries), batch)]
+        batch_seconds = [_timed(db.query_batch, chunk, n_results) for chunk in batches]
+        result["batch_query"] = dict(latency_stats(batch_seconds), batch_size=batch,
+                                     queries_per_second=len(queries) / sum(batch_seconds))
+        logger.info(f"{size} documents: query p50 {result['query']['p50_ms']:.2f} ms")
+
+        app_module.vector_db = db
+        app_module.app.config["TESTING"] = True
+        with app_module.app.test_client() as client:
+            result["api"] = {
+                "search": latency_stats([
+                    _timed(client.post, "/search", json={"query": query, "n_results": n_results})
+                    for query in queries
+                ]),
+                "search_batch": latency_stats([
+                    _timed(client.post, "/search/batch", json={"queries": chunk, "n_results": n_results})
+                    for chunk in batches
+                ]),
+                "documents_page": latency_stats([
+                    _timed(client.get, "/documents?limit=100&fields=id,metadata") for _ in range(20)
+                ]),
+            }
+
+        # Cold start of a second process opening the same directory
+        reopened = open_database(lazy=True)
+        result["load_seconds"] = _timed(reopened.warm_up)
+
+        deleted = [f"doc{i}" for i in range(0, size, 10)]
+        delete_seconds = sum(_timed(db.delete_document, doc_id) for doc_id in deleted)
+        db.wait_for_compaction()
+        result["delete"] = {
+            "count": len(deleted),
+            "deletes_per_second": len(deleted) / delete_seconds,
+            "compact_seconds": _timed(db.compact),
+        }
+        result["peak_rss_bytes"] = peak_rss_bytes()
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def run(sizes: List[int], options: Dict[str, Any], isolate: bool = True) -> Dict[str, Any]:
+    """Benchmark every size, each in a fresh process unless ``isolate`` is False."""
+    results = []
+    for size in sizes:
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results.append(pool.submit(run_size, size, options).result())
+        else:
+            results.append(run_size(size, options))
+    return {
+        "format": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "options": options,
+        "results": results,
+    }
+
+def environment() -> Dict[str, Any]:
+    versions = {}
+    for package in ("numpy", "scipy", "scikit-learn", "faiss-cpu", "flask"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "packages": versions,
+    }
+
+def flatten(report: Dict[str, Any]) -> Dict[str, float]:
+    """Numeric metrics of a report keyed as ``<documents>.<section>.<metric>``."""
+    metrics = {}
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                walk(f"{prefix}.{key}", inner)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[prefix] = float(value)
+
+    for result in report["results"]:
+        walk(str(result["documents"]), {key: value for key, value in result.items() if key != "documents"})
+    return metrics
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.1) -> List[str]:
+    """Describe every metric that got worse than the baseline by more than ``tolerance``.
+
+    Rates (``*_per_second``) regress when they drop; times and sizes when
+    they grow. Counts and settings are not compared.
+    """
+    regressions = []
+    baseline_metrics = flatten(baseline)
+    for key, value in flatten(current).items():
+        before = baseline_metrics.get(key)
+        metric = key.rsplit(".", 1)[-1]
+        if before is None or before <= 0 or metric in ("count", "batch_size"):
+            continue
+        change = (value - before) / before
+        if metric.endswith("_per_second"):
+            change = -change
+        if change > tolerance:
+            regressions.append(f"{key}: {before:.4g} -> {value:.4g} ({change:+.0%} worse)")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="corpus sizes to benchmark")
+    parser.add_argument("--doc-length", type=int, default=100, help="average words per document")
+    parser.add_argument("--vocabulary", type=int, default=5000, help="distinct words in the corpus")
+    parser.add_argument("--ingest-batch-size", type=int, default=1000, help="documents per add_documents call")
+    parser.add_argument("--queries", type=int, default=200, help="queries to time")
+    parser.add_argument("--query-batch-size", type=int, default=32, help="queries per batch query")
+    parser.add_argument("--n-results", type=int, default=5, help="results per query")
+    parser.add_argument("--backend", default="faiss", choices=["faiss", "sparse"])
+    parser.add_argument("--index-type", default="flat", help="index type of the faiss backend")
+    parser.add_argument("--cache-size", type=int, default=0, help="query cache entries (0 disables it)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results to compare against; exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    parser.add_argument("--no-isolate", action="store_true", help="run every size in this process")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(message)s")
+    logger.setLevel(logging.INFO)
+    options = {
+        "doc_length": args.doc_length,
+        "vocabulary": args.vocabulary,
+        "ingest_batch_size": args.ingest_batch_size,
+        "queries": args.queries,
+        "query_batch_size": args.query_batch_size,
+        "n_results": args.n_results,
+        "backend": args.backend,
+        "index_type": args.index_type,
+        "cache_size": args.cache_size,
+    }
+    report = run(args.sizes, options, isolate=not args.no_isolate)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            return 1
+        logger.info("No regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+"""Gunicorn settings, picked up automatically from the working directory."""
+import os
+import time
+
+# Searches share the database's state lock, so each worker serves several requests at a time
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+# Workers share their metrics through files in this directory, see metrics.Registry
+os.environ.setdefault("METRICS_DIR", "metrics")
+
+def on_starting(server):
+    # Counters restart with the server instead of adding up over restarts
+    from metrics import registry
+    registry.clear()
+
+def post_fork(server, worker):
+    worker.started_at = time.monotonic()
+
+def post_worker_init(worker):
+    # Load the documents and index before the worker accepts requests, not on the first one
+    from vector_db import vector_db
+    vector_db.warm_up()
+    # Report this worker's gauges to /metrics even before it records anything
+    from metrics import registry
+    registry.start()
+    worker.log.info(f"Worker {worker.pid} ready in {time.monotonic() - worker.started_at:.2f}s")
@@ -1,39 +1,239 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import random
 import sys
 import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # no advisory file locks, e.g. on Windows: single process only
+    fcntl = None
+
+LOG_FILE = os.getenv('LOG_FILE', 'logs/app.log')
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'function': record.funcName,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Size-based rotation that several processes (e.g. gunicorn workers) can share.
+
+    Rollovers are serialized with a lock file, and a process reopens the log
+    when another process has rotated it, instead of writing on into the
+    renamed backup.
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding=None):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding)
+        self._lock_fd = os.open(self.baseFilename + '.lock', os.O_RDWR | os.O_CREAT, 0o644) if fcntl else None
+
+    def _rotated(self) -> bool:
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except (OSError, AttributeError, ValueError):
+            return True
+
+    def emit(self, record):
+        if self._lock_fd is None:
+            return super().emit(record)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            if self.stream is not None and self._rotated():
+                self.stream.close()
+                self.stream = None
+            super().emit(record)
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+class RouteSampler(logging.Filter):
+    """Keep only a sample of the records logged while serving high-frequency routes.
+
+    ``rules`` maps a Flask route (e.g. ``/health``) to the fraction of its
+    requests whose records are kept (``"0.1"``) or to the number of
+    requests per second that are logged (``"5/s"``). The decision is taken
+    once per request, so a request is logged completely or not at all.
+    Warnings and errors are always kept, as are records logged outside a
+    request.
+    """
+
+    def __init__(self, rules):
+        super().__init__()
+        self.rules = {}
+        for route, rule in rules.items():
+            if rule.endswith('/s'):
+                self.rules[route] = ('rate', float(rule[:-2]))
+            else:
+                self.rules[route] = ('ratio', float(rule))
+        # route -> (second, requests logged in it)
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_string(cls, spec):
+        """Parse ``"/health=1/s,/search=0.1"``."""
+        rules = {}
+        for item in filter(None, (part.strip() for part in spec.split(','))):
+            route, _, rule = item.partition('=')
+            rules[route.strip()] = rule.strip()
+        return cls(rules)
+
+    def _keep(self, route):
+        kind, value = self.rules[route]
+        if kind == 'ratio':
+            return random.random() < value
+        second = int(time.monotonic())
+        with self._lock:
+            window, count = self._windows.get(route, (second, 0))
+            if window != second:
+                window, count = second, 0
+            self._windows[route] = (window, count + 1)
+        return count < value
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rules:
+            return True
+        flask = sys.modules.get('flask')
+        if flask is None or not flask.has_request_context():
+            return True
+        request = flask.request
+        route = request.url_rule.rule if request.url_rule else request.path
+        if route not in self.rules:
+            return True
+        keep = flask.g.get('_log_sampled')
+        if keep is None:
+            keep = flask.g._log_sampled = self._keep(route)
+        return keep
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the background writer without formatting or waiting.
+
+    The stock ``QueueHandler`` formats each record in the calling thread;
+    here only the message arguments are merged, and formatting happens in
+    the writer thread. When the queue is full the record is dropped and
+    counted in ``dropped`` rather than blocking the request.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.args:
+            # The arguments may change after the call returns
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        if _listener_pid != os.getpid():
+            # Forked since the writer thread started, e.g. a gunicorn worker of a preloaded app
+            _async_handler(_listener_level)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Background writer shared by every logger of this process
+_queue_handler = None
+_listener = None
+_listener_pid = None
+_listener_level = None
+_listener_lock = threading.Lock()
+
+def _output_handlers(log_level):
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        console_formatter = file_formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+    else:
+        console_formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+
+        file_formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(getattr(logging, log_level))
+    console_handler.setFormatter(console_formatter)
+
+    os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+    file_handler = SharedRotatingFileHandler(
+        LOG_FILE,
+        maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+        backupCount=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    )
+    file_handler.setLevel(getattr(logging, os.getenv('LOG_FILE_LEVEL', 'DEBUG').upper()))
+    file_handler.setFormatter(file_formatter)
+    return [console_handler, file_handler]
+
+def _async_handler(log_level):
+    """The queue handler of this process, starting its writer thread on first use."""
+    global _queue_handler, _listener, _listener_pid, _listener_level
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return _queue_handler
+        # First logger of this process, or a forked child whose writer thread did not survive the fork
+        log_queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', '10000')))
+        if _queue_handler is None:
+            _queue_handler = NonBlockingQueueHandler(log_queue)
+        else:
+            # Loggers set up before the fork keep their handler, point it at the new queue
+            _queue_handler.queue = log_queue
+        _listener = logging.handlers.QueueListener(log_queue, *_output_handlers(log_level),
+                                                   respect_handler_level=True)
+        _listener.start()
+        _listener_pid, _listener_level = os.getpid(), log_level
+        atexit.register(_listener.stop)
+        return _queue_handler
 
 def setup_logger(name=__name__, log_level=None):
+    """Configure a logger writing to the console and the rotating ``LOG_FILE``.
+
+    With ``LOG_ASYNC`` (the default) records are handed to a queue and
+    written by a background thread, so request threads never wait on the
+    console or disk. ``LOG_SAMPLE`` thins out the records of
+    high-frequency routes (see ``RouteSampler``).
+    """
     if log_level is None:
         log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
-    
+
     logger = logging.getLogger(name)
     logger.setLevel(getattr(logging, log_level))
-    
+
     if logger.handlers:
         return logger
-    
-    console_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(getattr(logging, log_level))
-    console_handler.setFormatter(console_formatter)
-    
-    os.makedirs('logs', exist_ok=True)
-    file_handler = logging.FileHandler('logs/app.log')
-    file_handler.setLevel(logging.DEBUG)  # Always log DEBUG and above to file
-    file_handler.setFormatter(file_formatter)
-    
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler) 
-    
+
+    if os.getenv('LOG_ASYNC', '1').lower() in ('1', 'true', 'yes'):
+        handlers = [_async_handler(log_level)]
+    else:
+        handlers = _output_handlers(log_level)
+
+    sampler = RouteSampler.from_string(os.getenv('LOG_SAMPLE', '/health=1/s,/metrics=1/s'))
+    for handler in handlers:
+        if sampler.rules and not any(isinstance(f, RouteSampler) for f in handler.filters):
+            handler.addFilter(sampler)
+        logger.addHandler(handler)
+
     return logger
 
 def get_logger(name=__name__):
@@ -0,0 +1,126 @@
+import json
+from typing import Any, Dict, Iterable, Optional
+import numpy as np
+
+# Comparison operators of a ``where`` filter; a bare value means ``$eq``
+OPERATORS = ("$eq", "$in", "$gt", "$gte", "$lt", "$lte")
+RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_scalar(value) -> bool:
+    return value is None or isinstance(value, (str, bool)) or _is_number(value)
+
+def _key(value):
+    """Lookup key of a metadata value: 1 and 1.0 are equal, True and 1 are not."""
+    if _is_number(value):
+        return float(value)
+    return (type(value).__name__, value)
+
+def validate_where(where: Dict[str, Any]):
+    """Raise ValueError unless ``where`` is a valid metadata filter.
+
+    A filter maps metadata fields to a value (equality) or to a dict of
+    operators: ``{"category": {"$in": ["AI", "ML"]}, "file_size": {"$gte": 1024}}``.
+    All conditions must hold.
+    """
+    if not isinstance(where, dict):
+        raise ValueError("where must be an object mapping metadata fields to conditions")
+    for field, condition in where.items():
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        if not condition:
+            raise ValueError(f"Empty condition for {field}")
+        for operator, value in condition.items():
+            if operator not in OPERATORS:
+                raise ValueError(f"Unknown operator {operator!r} for {field} (expected one of {', '.join(OPERATORS)})")
+            if operator == "$in":
+                if not isinstance(value, list) or not all(_is_scalar(v) for v in value):
+                    raise ValueError(f"$in of {field} takes a list of strings, numbers or booleans")
+            elif operator in RANGE_OPERATORS:
+                if not _is_number(value):
+                    raise ValueError(f"{operator} of {field} takes a number")
+            elif not _is_scalar(value):
+                raise ValueError(f"{field} can only be compared with a string, number or boolean")
+
+def where_key(where: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Canonical form of a filter, for cache keys."""
+    return json.dumps(where, sort_keys=True) if where else None
+
+class MetadataIndex:
+    """Inverted and sorted indexes over the scalar metadata fields of the rows.
+
+    Every scalar value is recorded in an inverted index (field -> value ->
+    rows) for equality and ``$in`` conditions, and numeric values also in a
+    per-field array sorted by value for range conditions. Rows are added in
+    order with ``add``; ``candidates`` turns a ``where`` filter into the
+    sorted array of matching rows.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self._postings = {}  # field -> value key -> rows
+        self._numbers = {}  # field -> ([values], [rows]) in insertion order
+        self._sorted = {}  # field -> (values, rows) sorted by value, dropped when rows are added
+
+    def add(self, metadata: Iterable[Optional[Dict[str, Any]]]):
+        """Index the metadata of the next rows."""
+        for meta in metadata:
+            row = self.rows
+            self.rows += 1
+            for field, value in (meta or {}).items():
+                if not _is_scalar(value):
+                    continue
+                self._postings.setdefault(field, {}).setdefault(_key(value), []).append(row)
+                if _is_number(value):
+                    values, rows = self._numbers.setdefault(field, ([], []))
+                    values.append(value)
+                    rows.append(row)
+                    self._sorted.pop(field, None)
+
+    def _equal(self, field: str, values) -> np.ndarray:
+        postings = self._postings.get(field, {})
+        matches = [postings[_key(value)] for value in values if _key(value) in postings]
+        if not matches:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([np.asarray(rows, dtype=np.int64) for rows in matches]))
+
+    def _range(self, field: str, condition: Dict[str, Any]) -> np.ndarray:
+        if field not in self._numbers:
+            return np.empty(0, dtype=np.int64)
+        if field not in self._sorted:
+            values, rows = self._numbers[field]
+            values = np.asarray(values, dtype=np.float64)
+            order = np.argsort(values, kind="stable")
+            self._sorted[field] = (values[order], np.asarray(rows, dtype=np.int64)[order])
+        values, rows = self._sorted[field]
+        start, stop = 0, len(values)
+        if "$gt" in condition:
+            start = max(start, np.searchsorted(values, condition["$gt"], side="right"))
+        if "$gte" in condition:
+            start = max(start, np.searchsorted(values, condition["$gte"], side="left"))
+        if "$lt" in condition:
+            stop = min(stop, np.searchsorted(values, condition["$lt"], side="left"))
+        if "$lte" in condition:
+            stop = min(stop, np.searchsorted(values, condition["$lte"], side="right"))
+        return np.sort(rows[start:stop]) if start < stop else np.empty(0, dtype=np.int64)
+
+    def candidates(self, where: Dict[str, Any]) -> np.ndarray:
+        """Sorted rows whose metadata matches every condition of ``where``."""
+        result = None
+        for field, condition in where.items():
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            parts = []
+            if "$eq" in condition:
+                parts.append(self._equal(field, [condition["$eq"]]))
+            if "$in" in condition:
+                parts.append(self._equal(field, condition["$in"]))
+            if any(operator in condition for operator in RANGE_OPERATORS):
+                parts.append(self._range(field, condition))
+            for rows in parts:
+                result = rows if result is None else np.intersect1d(result, rows, assume_unique=True)
+            if result is not None and not len(result):
+                break
+        return result if result is not None else np.arange(self.rows, dtype=np.int64)
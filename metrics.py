@@ -0,0 +1,380 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+try:
+    import fcntl
+    import resource
+except ImportError:  # not available on Windows
+    fcntl = resource = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How the gauges of several processes are combined: summed, the largest one, or one series per process
+GAUGE_MODES = ("sum", "max", "all")
+
+# Counters and histograms of every exited process, folded into one file
+EXITED_FILE = "exited.json"
+
+class Metric:
+    """A named metric with one series per combination of label values."""
+
+    kind = None
+
+    def __init__(self, registry: "Registry", name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labelnames) or 'none'}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[list]:
+        return [[list(key), value] for key, value in self._values.items()]
+
+class Counter(Metric):
+    """A value that only goes up, summed over every process."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._registry._updating():
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+class Histogram(Metric):
+    """Observations counted into buckets, summed over every process."""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._registry._updating():
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one past every bound), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bucket] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[list]:
+        return [[list(key), [list(counts), total]] for key, (counts, total) in self._values.items()]
+
+class Gauge(Metric):
+    """A value that goes up and down, combined over processes according to ``mode``."""
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, documentation, labelnames=(), mode: str = "sum"):
+        if mode not in GAUGE_MODES:
+            raise ValueError(f"Unknown gauge mode: {mode!r} (expected one of {', '.join(GAUGE_MODES)})")
+        super().__init__(registry, name, documentation, labelnames)
+        self.mode = mode
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._registry._updating():
+            self._values[key] = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from ``function`` whenever the metrics are collected."""
+        self._function = function
+
+    def _read_function(self) -> List[list]:
+        try:
+            return [[[], float(self._function())]]
+        except Exception as e:
+            logger.debug(f"Could not read gauge {self.name}: {e}")
+            return []
+
+class Registry:
+    """Metrics of this process, exported in the Prometheus text format.
+
+    With a ``directory`` every process writes its metrics to
+    ``<directory>/<pid>.json`` once every ``flush_interval`` seconds, and
+    ``render`` combines the files of all processes, so any gunicorn worker
+    can answer a scrape for the whole server. Counters and histograms of
+    processes that exited keep counting: ``render`` folds their files into
+    one ``exited.json``, so files do not pile up as workers are replaced.
+    Their gauges are dropped. Without a directory only this process is
+    reported.
+    """
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flusher = None
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), mode: str = "sum") -> Gauge:
+        return self._register(Gauge(self, name, documentation, labelnames, mode))
+
+    @contextmanager
+    def _updating(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked child starts from zero instead of counting its parent's values again
+                for metric in self._metrics.values():
+                    metric._values.clear()
+                self._pid, self._flusher = os.getpid(), None
+            if self._flusher is None and self.directory:
+                self._flusher = threading.Thread(target=self._flush_periodically, name="metrics-flusher", daemon=True)
+                self._flusher.start()
+            yield
+
+    def start(self):
+        """Start writing this process' metrics to the directory (idempotent, recording a value does too)."""
+        with self._updating():
+            pass
+
+    def collect(self) -> Dict[str, Dict[str, Any]]:
+        """Snapshot of this process' metrics."""
+        with self._updating():
+            snapshot = {
+                metric.name: {
+                    "kind": metric.kind,
+                    "documentation": metric.documentation,
+                    "labelnames": list(metric.labelnames),
+                    "buckets": list(getattr(metric, "buckets", ())),
+                    "mode": getattr(metric, "mode", None),
+                    "samples": metric._samples(),
+                }
+                for metric in self._metrics.values()
+            }
+        # Gauge functions may take locks of their own, whose holders may be waiting to record a metric
+        for metric in self._metrics.values():
+            if getattr(metric, "_function", None) is not None:
+                snapshot[metric.name]["samples"] = metric._read_function()
+        return snapshot
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        """Write this process' metrics to its file in the metrics directory."""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        _write_json(self._path(os.getpid()), self.collect())
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"Could not write metrics: {e}")
+
+    def clear(self):
+        """Remove the files of every process, e.g. when the server starts."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith((".json", ".json.tmp", ".lock")):
+                os.remove(os.path.join(self.directory, name))
+
+    @contextmanager
+    def _directory_lock(self):
+        """Keeps the processes answering scrapes from folding the same files at once."""
+        with open(os.path.join(self.directory, "metrics.lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _pids(self) -> List[int]:
+        """Processes other than this one with a file in the directory."""
+        pids = []
+        for name in sorted(os.listdir(self.directory)):
+            pid = name[:-len(".json")]
+            if name.endswith(".json") and pid.isdigit() and int(pid) != os.getpid():
+                pids.append(int(pid))
+        return pids
+
+    def _fold_exited(self):
+        """Add the counters and histograms of exited processes to the exited file and remove their files."""
+        exited_pids = [pid for pid in self._pids() if not _alive(pid)]
+        if not exited_pids:
+            return
+        exited_path = os.path.join(self.directory, EXITED_FILE)
+        exited = (_read_json(exited_path) if os.path.exists(exited_path) else None) or {}
+        for pid in exited_pids:
+            for name, metric in (_read_json(self._path(pid)) or {}).items():
+                if metric["kind"] == "gauge":
+                    continue
+                target = exited.setdefault(name, dict(metric, samples=[]))
+                samples = {tuple(labels): value for labels, value in target["samples"]}
+                for labels, value in metric["samples"]:
+                    samples[tuple(labels)] = _combine(metric, samples.get(tuple(labels)), value)
+                target["samples"] = [[list(labels), value] for labels, value in samples.items()]
+        # Written before the files are removed: a crash in between counts them twice rather than never
+        _write_json(exited_path, exited)
+        for pid in exited_pids:
+            os.remove(self._path(pid))
+        logger.info(f"Folded the metrics of {len(exited_pids)} exited processes")
+
+    def _snapshots(self) -> List[tuple]:
+        """(pid, alive, metrics) of every process, this one first; exited processes are folded into pid 0."""
+        snapshots = [(os.getpid(), True, self.collect())]
+        if not self.directory or not os.path.isdir(self.directory):
+            return snapshots
+        with self._directory_lock():
+            self._fold_exited()
+            if os.path.exists(os.path.join(self.directory, EXITED_FILE)):
+                snapshots.append((0, False, _read_json(os.path.join(self.directory, EXITED_FILE)) or {}))
+            for pid in self._pids():
+                metrics = _read_json(self._path(pid))
+                if metrics is not None:
+                    snapshots.append((pid, _alive(pid), metrics))
+        return snapshots
+
+    def render(self) -> str:
+        """All processes' metrics in the Prometheus text exposition format."""
+        merged = {}
+        for pid, alive, metrics in self._snapshots():
+            for name, metric in metrics.items():
+                if metric["kind"] == "gauge" and not alive:
+                    continue
+                target = merged.setdefault(name, dict(metric, samples={}))
+                labelnames = metric["labelnames"]
+                for labels, value in metric["samples"]:
+                    labels = tuple(zip(labelnames, labels))
+                    if metric["kind"] == "gauge" and metric["mode"] == "all":
+                        labels += (("pid", str(pid)),)
+                    target["samples"][labels] = _combine(metric, target["samples"].get(labels), value)
+
+        lines = []
+        for name, metric in merged.items():
+            lines.append(f"# HELP {name} {_escape(metric['documentation'], help_text=True)}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for labels, value in metric["samples"].items():
+                if metric["kind"] != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(list(metric["buckets"]) + [float("inf")], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def _combine(metric: Dict[str, Any], current, value):
+    if current is None:
+        return value
+    if metric["kind"] == "histogram":
+        return [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1]]
+    if metric["kind"] == "gauge" and metric["mode"] == "max":
+        return max(current, value)
+    return current + value
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Skipping unreadable metrics file {os.path.basename(path)}: {e}")
+        return None
+
+def _write_json(path: str, data: Dict[str, Any]):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _escape(value: str, help_text: bool = False) -> str:
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value if help_text else value.replace('"', '\\"')
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def resident_memory_bytes() -> float:
+    """Current resident memory of this process (the peak where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Shared registry; every process of the server writes to the same directory, which
+# gunicorn.conf.py sets. Without one (tests, scripts, flask run) nothing is written.
+registry = Registry(os.getenv("METRICS_DIR") or None)
+
+REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "Time spent answering HTTP requests", ["method", "endpoint", "status"])
+STAGE_SECONDS = registry.histogram(
+    "stage_duration_seconds", "Time spent in each stage of searches, writes, maintenance and ingestion",
+    ["operation", "stage"])
+SEARCH_BATCH_SIZE = registry.histogram(
+    "search_coalesced_batch_size", "Queries answered by each coalesced search batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+INGESTED_FILES = registry.counter(
+    "ingest_files_total", "Uploaded files by outcome: read, failed or rejected", ["result"])
+INGESTED_DOCUMENTS = registry.counter(
+    "ingest_documents_total", "Documents written by the ingestion pipeline by outcome", ["result"])
+DOCUMENTS = registry.gauge("vector_db_documents", "Documents in the vector database", mode="max")
+INDEX_VECTORS = registry.gauge("vector_db_index_vectors", "Vectors in the search index, deleted rows included", mode="max")
+QUEUE_DEPTH = registry.gauge("ingest_queue_depth", "Uploaded files waiting to be ingested")
+MEMORY = registry.gauge("process_resident_memory_bytes", "Resident memory of each server process", mode="all")
+MEMORY.set_function(resident_memory_bytes)
@@ -0,0 +1,189 @@
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+def normalize_query(query_text: str) -> str:
+    """Cache key form of a query: the vectorizer lowercases and splits on whitespace anyway."""
+    return " ".join(query_text.lower().split())
+
+def content_hash(text: str) -> str:
+    """Content address of a document body."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def result_size(results: Dict[str, Any]) -> int:
+    """Approximate memory held by a query result, in bytes."""
+    size = sys.getsizeof(results)
+    for values in results.values():
+        size += sys.getsizeof(values)
+        for value in values:
+            size += sys.getsizeof(value)
+            if isinstance(value, dict):
+                size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return size
+
+class QueryCache:
+    """Thread-safe LRU cache of query results, bounded by entries and by bytes.
+
+    Every lookup passes the generation of the data it would read; entries
+    stored under another generation are dropped, so a result is never served
+    after the documents changed. Entries older than ``ttl`` seconds expire
+    (``ttl=0`` keeps them until evicted), and ``max_entries=0`` disables the
+    cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored at, size, result)
+        self._generation = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def _invalidate(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._generation = generation
+
+    def get(self, key: Hashable, generation) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached result for ``key``, or None on a miss."""
+        if not self.max_entries:
+            return None
+        with self._lock:
+            self._invalidate(generation)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self._bytes -= entry[1]
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+        # Callers get their own lists, the cached ones stay untouched
+        return {name: list(values) for name, values in entry[2].items()}
+
+    def put(self, key: Hashable, generation, results: Dict[str, Any]):
+        """Cache a result computed from data at ``generation``."""
+        if not self.max_entries:
+            return
+        size = result_size(results)
+        if size > self.max_bytes:
+            return
+        results = {name: list(values) for name, values in results.items()}
+        with self._lock:
+            if generation != self._generation:
+                # Computed from data that has changed since, or older than what is cached
+                if self._generation is not None:
+                    return
+                self._generation = generation
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (time.monotonic(), size, results)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        """Drop every entry, e.g. after the index was rebuilt."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Hit, miss and eviction counts and the current size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            })
+        return stats
+
+class VectorCache:
+    """Thread-safe LRU cache of term count vectors keyed by content hash, bounded by bytes.
+
+    Term counts only depend on the text and the feature space, so unlike
+    query results they stay valid when documents change; identical content
+    is tokenized once. ``max_bytes=0`` disables the cache.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # content hash -> 1-row count matrix
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def _size(vector) -> int:
+        return vector.data.nbytes + vector.indices.nbytes + vector.indptr.nbytes
+
+    def get_many(self, keys) -> Dict[str, Any]:
+        """Cached vectors of the keys that are present."""
+        found = {}
+        if not self.max_bytes:
+            return found
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is None:
+                    self._stats["misses"] += 1
+                    continue
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                found[key] = vector
+        return found
+
+    def put_many(self, items):
+        """Cache (content hash, 1-row count matrix) pairs."""
+        if not self.max_bytes:
+            return
+        with self._lock:
+            for key, vector in items:
+                size = self._size(vector)
+                if size > self.max_bytes:
+                    continue
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self._bytes -= self._size(previous)
+                self._entries[key] = vector
+                self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._size(evicted)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        """Drop every entry, e.g. when the feature space changes."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Hit, miss and eviction counts, the hit rate and the current size."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats.update({
+                "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            })
+        return stats
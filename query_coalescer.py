@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from metadata_index import where_key
+from metrics import SEARCH_BATCH_SIZE, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class _Request:
+    """A query waiting for the batch it is run in."""
+
+    __slots__ = ("text", "ready", "lead", "result", "error")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.ready = threading.Event()  # set once the result is in, or the request leads the next batch
+        self.lead = False
+        self.result = None
+        self.error = None
+
+class QueryCoalescer:
+    """Runs concurrent single queries as one ``query_batch`` call.
+
+    Queries are grouped by database and search options. The first query of
+    a group runs at once, so a lone query waits for nothing. Queries that
+    arrive while it runs are queued, and when it finishes the first of them
+    leads the next batch: it waits up to ``window`` seconds for the batch
+    to fill to ``max_batch`` queries and runs them all with one vectorizer
+    call and one index search over the whole query matrix. Batching thus
+    only sets in when queries actually overlap. ``max_batch=1`` turns it
+    off.
+
+    Works with anything that has ``query_batch``, e.g. a ``VectorDatabase``
+    or a ``ShardedCollection``.
+    """
+
+    def __init__(self, window: float = 0.001, max_batch: int = 64):
+        self.window = window
+        self.max_batch = max_batch
+        self._condition = threading.Condition()
+        # Group key -> queued requests; a group is present while one of its batches runs
+        self._queues = {}
+        self._batches = 0
+        self._queries = 0
+
+    def query(self, db, query_text: str, n_results: int = 5, collapse: bool = False,
+              nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+              where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """``db.query``, run in a batch with the overlapping queries of the same options."""
+        options = (n_results, collapse, nprobe, ef_search, where)
+        if self.max_batch <= 1:
+            return db.query_batch([query_text], *options)[0]
+        key = (id(db), n_results, collapse, nprobe, ef_search, where_key(where))
+        request = _Request(query_text)
+        with self._condition:
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = []
+                batch = [request]
+            else:
+                queue.append(request)
+                # A leader may be waiting for its batch to fill
+                self._condition.notify_all()
+                batch = None
+        if batch is None:
+            with STAGE_SECONDS.time(operation="search", stage="queue"):
+                request.ready.wait()
+            if request.lead:
+                batch = self._gather(key)
+        if batch is not None:
+            self._run(key, db, batch, options)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _gather(self, key) -> List[_Request]:
+        """Take the next batch off a group's queue, waiting up to ``window`` for it to fill."""
+        deadline = time.monotonic() + self.window
+        with self._condition:
+            queue = self._queues[key]
+            while len(queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = queue[:self.max_batch]
+            del queue[:self.max_batch]
+        return batch
+
+    def _run(self, key, db, batch: List[_Request], options: tuple):
+        """Run a batch, hand every request its result and promote the next queued request to lead.
+
+        The group is handed on and every request woken even if handing out
+        the results fails, so later queries of the group never wait forever.
+        """
+        try:
+            try:
+                results, error = db.query_batch([request.text for request in batch], *options), None
+            except Exception as e:
+                results, error = [None] * len(batch), e
+            SEARCH_BATCH_SIZE.observe(len(batch))
+            for request, result in zip(batch, results):
+                request.result, request.error = result, error
+        finally:
+            with self._condition:
+                self._batches += 1
+                self._queries += len(batch)
+                queue = self._queues[key]
+                leader = queue[0] if queue else None
+                if leader is None:
+                    del self._queues[key]
+                else:
+                    leader.lead = True
+            for request in batch:
+                if request.result is None and request.error is None:
+                    request.error = RuntimeError("Search batch failed before returning this query's result")
+                request.ready.set()
+            if leader is not None:
+                leader.ready.set()
+
+    def search_documents(self, db, query_text: str, n_results: int = 5, collapse: bool = False,
+                         nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                         where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, List[List[Any]]]]:
+        """``db.search_documents`` through the coalescer. Returns None if the search fails."""
+        try:
+            result = self.query(db, query_text, n_results, collapse, nprobe, ef_search, where)
+        except Exception as e:
+            logger.error(f"Error searching documents: {e}")
+            return None
+        return {
+            "ids": [result["ids"]],
+            "documents": [result["documents"]],
+            "metadatas": [result["metadata"]],
+            "distances": [result["distances"]],
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "batches": self._batches,
+                "queries": self._queries,
+                "mean_batch_size": self._queries / self._batches if self._batches else 0.0,
+                "window": self.window,
+                "max_batch": self.max_batch,
+            }
+
+# Shared coalescer used by the /search endpoint
+search_coalescer = QueryCoalescer(
+    window=float(os.getenv("SEARCH_COALESCE_WINDOW_MS", "1")) / 1000,
+    max_batch=int(os.getenv("SEARCH_COALESCE_MAX_BATCH", "64")),
+)
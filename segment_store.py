@@ -0,0 +1,1123 @@
+import atexit
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+import logging
+from collections.abc import Sequence
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Dict, Any, Optional, Tuple
+import numpy as np
+from scipy import sparse
+
+try:
+    import fcntl
+except ImportError:  # no advisory file locks, e.g. on Windows: single process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+STORE_FILE = re.compile(r"^(seg|tomb|index)-(\d{6,})\.(jsonl|ids|meta|bin|npz|log|faiss)$")
+
+# When writes are made durable: each on its own, in groups, or only on shutdown
+DURABILITY_MODES = ("write", "group", "shutdown")
+
+class FileLock:
+    """Reentrant lock shared by the threads of this process and, through
+    ``flock``, by every process that opens the same lock file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock.release()
+                return False
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class ReadWriteLock:
+    """Lock held by any number of readers or by one writer, within a process.
+
+    Writers are preferred: once one is waiting, new readers queue behind it,
+    so a steady stream of readers cannot starve writes. Both sides are
+    reentrant and the writing thread may also read, but a reader must not
+    ask to write.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local()  # this thread's read depth and whether it counts as a reader
+
+    def acquire_read(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            counted = self._writer != threading.get_ident()
+            if counted:
+                with self._condition:
+                    while self._writer is not None or self._waiting_writers:
+                        self._condition.wait()
+                    self._readers += 1
+            self._local.counted = counted
+        self._local.depth = depth + 1
+
+    def release_read(self):
+        self._local.depth -= 1
+        if self._local.depth == 0 and self._local.counted:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        if getattr(self._local, "depth", 0):
+            raise RuntimeError("A reader cannot acquire the write lock")
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        self._write_depth -= 1
+        if self._write_depth == 0:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class SegmentContents(Sequence):
+    """Strings of one segment (bodies, IDs or metadata) read from a memory-mapped file.
+
+    The file holds the UTF-8 strings back to back followed by ``count + 1``
+    little-endian offsets into them and the ``count`` itself. Strings are
+    only paged in and decoded when they are read. Slicing returns a view
+    over the same mapping.
+    """
+
+    def __init__(self, buffer: mmap.mmap, offsets: np.ndarray, start: int = 0, stop: Optional[int] = None):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._start = start
+        self._stop = len(offsets) - 1 if stop is None else stop
+
+    @classmethod
+    def open(cls, path: str, count: Optional[int] = None) -> "SegmentContents":
+        """Map a file; ``count`` is only given for format 3 files, which end without it."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(buffer)
+        if count is None:
+            end -= 8
+            count = struct.unpack_from("<Q", buffer, end)[0]
+        offsets = np.frombuffer(buffer, dtype="<u8", count=count + 1, offset=end - 8 * (count + 1))
+        return cls(buffer, offsets)
+
+    @staticmethod
+    def write(path: str, documents: Iterable[str]):
+        offsets = [0]
+        with open(path, 'wb') as f:
+            for content in documents:
+                data = content.encode('utf-8', 'surrogatepass')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+            f.write(np.asarray(offsets, dtype="<u8").tobytes())
+            f.write(struct.pack("<Q", len(offsets) - 1))
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return SegmentContents(self._buffer, self._offsets, self._start + start, self._start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row out of range")
+        row = self._start + index
+        return self._buffer[int(self._offsets[row]):int(self._offsets[row + 1])].decode('utf-8', 'surrogatepass')
+
+class MetadataList(Sequence):
+    """Metadata of one segment, stored as a JSON string per row and decoded when read."""
+
+    def __init__(self, strings: SegmentContents):
+        self._strings = strings
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MetadataList(self._strings[index])
+        return json.loads(self._strings[index])
+
+class ContentList(Sequence):
+    """Read-only concatenation of per-segment row sequences, addressed by row.
+
+    Holds the ``SegmentContents`` or ``MetadataList`` views of each segment
+    (or plain lists for segments written in older formats), so slicing and
+    extending never read a row.
+    """
+
+    def __init__(self, parts: Iterable[Sequence] = ()):
+        self._parts = []
+        self._starts = [0]
+        for part in parts:
+            self.extend(part)
+
+    def extend(self, part: Sequence):
+        if isinstance(part, ContentList):
+            for inner in part._parts:
+                self.extend(inner)
+        elif len(part):
+            self._parts.append(part)
+            self._starts.append(self._starts[-1] + len(part))
+
+    def take(self, rows: Iterable[int]) -> "ContentList":
+        """View of the given rows, which must be ascending."""
+        view = ContentList()
+        start = stop = None
+        for row in rows:
+            if row != stop:
+                if start is not None:
+                    view.extend(self[start:stop])
+                start = row
+            stop = row + 1
+        if start is not None:
+            view.extend(self[start:stop])
+        return view
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def __iter__(self):
+        for part in self._parts:
+            yield from part
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            view = ContentList()
+            first = bisect.bisect_right(self._starts, start) - 1
+            for part in range(max(first, 0), len(self._parts)):
+                offset = self._starts[part]
+                if offset >= stop:
+                    break
+                view.extend(self._parts[part][max(start - offset, 0):stop - offset])
+            return view
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row out of range")
+        part = bisect.bisect_right(self._starts, index) - 1
+        return self._parts[part][index - self._starts[part]]
+
+class SegmentStore:
+    """Append-only, log-structured persistence for the vector database.
+
+    Every write adds a new segment instead of rewriting the store:
+    ``<segment>.ids``, ``<segment>.meta`` and ``<segment>.bin`` hold the
+    document IDs, JSON-encoded metadata and bodies in the binary format of
+    ``SegmentContents``, and ``<segment>.npz`` the document vectors (raw
+    term counts), if any. Only the IDs are decoded when a segment is read;
+    metadata and bodies are memory-mapped and decoded on access. Segments
+    of older formats keep IDs and metadata in ``<segment>.jsonl``. Deletes are appended to a
+    tombstone log as ``<segment> <line>`` entries. ``manifest.json`` lists the
+    live segments in order and names the current tombstone log; it is
+    replaced atomically whenever either changes.
+
+    Rows are addressed by their position across all segments in manifest
+    order, deleted rows included. Adjacent segments of similar size are
+    merged in a background thread, which keeps row positions stable. Deleted
+    rows are only dropped by a compaction, which renumbers the rows and
+    starts a new ``epoch``.
+
+    Several processes can share a store. Every change happens under a
+    ``flock`` on ``store.lock`` and increments the counter in the
+    memory-mapped ``generation`` file, so a reader can tell that the store
+    changed with a single memory read and only then re-read the manifest.
+
+    A commit fsyncs the segments appended since the last one, the
+    tombstone log and the directory, then the manifest, which records the
+    commit point as ``synced``. ``durability`` decides when appends and
+    deletes commit: ``"write"`` commits each one, ``"group"`` every
+    ``commit_writes`` writes or ``commit_interval`` seconds, and
+    ``"shutdown"`` only when the process exits; until then they are
+    visible to every process but can be lost in a crash. Merges,
+    compactions and snapshots replace files and always commit. Segments
+    carry a checksum in the manifest, so a segment left incomplete by a
+    crash after the last commit is detected and dropped, with the ones
+    after it, the next time the store is opened. Outside ``"write"`` mode
+    every commit also leaves ``manifest.checkpoint.json``, which is read
+    if the manifest itself did not survive.
+    """
+
+    MANIFEST_FILE = "manifest.json"
+    CHECKPOINT_FILE = "manifest.checkpoint.json"
+    GENERATION_FILE = "generation"
+    FORMAT_VERSION = 4
+    # Files of a segment, in the order they are checksummed
+    SEGMENT_FILES = ("ids", "meta", "bin", "npz")
+
+    def __init__(self, directory: str, merge_in_background: bool = True, durability: str = "write",
+                 commit_writes: int = 64, commit_interval: float = 1.0):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.directory = directory
+        self.merge_in_background = merge_in_background
+        self.durability = durability
+        self.commit_writes = commit_writes
+        self.commit_interval = commit_interval
+        self._uncommitted = 0  # appends and deletes of this process since the last commit
+        os.makedirs(directory, exist_ok=True)
+        # Guards the manifest and tombstones, across processes
+        self._lock = FileLock(os.path.join(directory, "store.lock"))
+        # Serializes merges, compactions and index snapshots, which all replace files
+        self.maintenance_lock = FileLock(os.path.join(directory, "maintenance.lock"))
+        self._merge_thread = None
+        self._tombstone_log = None
+        self._tombstone_log_name = None
+        self._mapped = {}  # segment name -> its (bodies, metadata), mapped on first use
+        self._generation = self._map_generation()
+        self._verified = set()  # index snapshots whose checksum matched
+        with self._lock:
+            self._synced = self.generation
+            self.manifest = self._read_manifest()
+            self.deleted = self._read_tombstones()  # segment name -> sorted deleted lines
+            self._recover()
+            self._index_segments()
+        self._remove_orphans()
+        if durability != "write":
+            # Writes since the last commit are made durable when the process exits
+            atexit.register(self.commit)
+        if durability == "group" and commit_interval > 0:
+            threading.Thread(target=self._commit_periodically, name="segment-store-commit", daemon=True).start()
+
+    def _map_generation(self) -> mmap.mmap:
+        fd = os.open(os.path.join(self.directory, self.GENERATION_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+            return mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+
+    @property
+    def generation(self) -> int:
+        """Change counter shared by every process using the store. Costs one memory read."""
+        return struct.unpack_from("<Q", self._generation)[0]
+
+    def _bump(self):
+        """Publish a change to the other processes. Caller must hold ``self._lock``."""
+        self._synced = self.generation + 1
+        struct.pack_into("<Q", self._generation, 0, self._synced)
+
+    def _sync(self):
+        """Re-read the manifest if another process changed the store. Caller must hold ``self._lock``."""
+        generation = self.generation
+        if generation == self._synced:
+            return
+        self.manifest = self._read_manifest()
+        self.deleted = self._read_tombstones()
+        self._index_segments()
+        self._synced = generation
+
+    def refresh(self) -> int:
+        """Catch up with changes made by other processes. Returns the generation synced to."""
+        with self._lock:
+            self._sync()
+            return self._synced
+
+    @property
+    def lock(self) -> FileLock:
+        """Held while the store changes; hold it to keep the store still."""
+        return self._lock
+
+    @property
+    def epoch(self) -> int:
+        """Incremented whenever rows are renumbered (compaction, clear)."""
+        return self.manifest.get("epoch", 0)
+
+    @property
+    def index_snapshot(self) -> Optional[Dict[str, Any]]:
+        """The latest index snapshot: its file name, epoch and number of rows."""
+        return self.manifest.get("index")
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, self.MANIFEST_FILE)
+
+    def exists(self) -> bool:
+        """Whether the directory already holds a segment store."""
+        return os.path.exists(self.manifest_path)
+
+    @property
+    def segment_count(self) -> int:
+        return len(self.manifest["segments"])
+
+    @property
+    def row_count(self) -> int:
+        """Number of rows across all segments, deleted rows included."""
+        return self._starts[-1]
+
+    @property
+    def deleted_count(self) -> int:
+        return sum(len(lines) for lines in self.deleted.values())
+
+    @property
+    def uncommitted_writes(self) -> int:
+        """Appends and deletes of this process that a crash could still lose."""
+        return self._uncommitted
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    return json.load(f)
+            except ValueError:
+                checkpoint = os.path.join(self.directory, self.CHECKPOINT_FILE)
+                if not os.path.exists(checkpoint):
+                    raise
+                # Replaced but not yet on disk when the machine went down
+                logger.error(f"Manifest of {self.directory} is damaged, reverting to the last checkpoint")
+                with open(checkpoint, 'r') as f:
+                    return json.load(f)
+        return {"format": self.FORMAT_VERSION, "next_segment": 1, "synced": 1, "segments": [], "tombstones": None}
+
+    def _write_manifest(self, commit: bool = True):
+        """Atomically replace the manifest and publish it. Caller must hold ``self._lock``.
+
+        With ``commit`` the files written since the last commit are made
+        durable first and the manifest is fsynced; otherwise the change is
+        only visible to other processes until the next commit.
+        """
+        if commit:
+            self._sync_files()
+            self.manifest["synced"] = self.manifest["next_segment"]
+            self._uncommitted = 0
+        self.manifest["format"] = self.FORMAT_VERSION
+        self._replace_json(self.manifest_path, self.manifest, commit)
+        if commit:
+            self._fsync(self.directory)
+            if self.durability != "write":
+                self._replace_json(os.path.join(self.directory, self.CHECKPOINT_FILE), self.manifest, True)
+        self._bump()
+
+    @staticmethod
+    def _replace_json(path: str, data: Dict[str, Any], durable: bool):
+        """Write ``data`` to a temporary file and rename it over ``path``."""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _fsync(path: str):
+        """Flush a file, or the entries of a directory, to disk."""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass  # directories cannot be fsynced on every platform
+        finally:
+            os.close(fd)
+
+    def _sync_files(self):
+        """Fsync the segments appended since the last commit and the tombstone log. Caller must hold ``self._lock``."""
+        synced = self.manifest.get("synced", self.manifest["next_segment"])
+        for entry in self.manifest["segments"]:
+            if self._segment_number(entry["name"]) >= synced:
+                for path in self._segment_paths(entry["name"]):
+                    self._fsync(path)
+        if self._tombstone_log is not None:
+            self._tombstone_log.flush()
+        if self.manifest.get("tombstones"):
+            self._fsync(self._path(self.manifest["tombstones"], "log"))
+
+    def commit(self):
+        """Make the writes of this process durable now, e.g. before it exits."""
+        if not self._uncommitted or not os.path.isdir(self.directory):
+            return
+        with self._lock:
+            self._sync()
+            self._write_manifest()
+        logger.debug(f"Committed {self.directory}")
+
+    def _commit_due(self) -> bool:
+        """Count a write and tell whether it has to be committed now."""
+        self._uncommitted += 1
+        return self.durability == "write" or (self.durability == "group" and self._uncommitted >= self.commit_writes)
+
+    def _commit_periodically(self):
+        while True:
+            time.sleep(self.commit_interval)
+            try:
+                self.commit()
+            except Exception as e:
+                logger.error(f"Error committing {self.directory}: {e}")
+
+    @staticmethod
+    def _segment_number(name: str) -> int:
+        return int(name.rsplit("-", 1)[1])
+
+    def _segment_paths(self, name: str) -> List[str]:
+        return [path for path in (self._path(name, extension) for extension in self.SEGMENT_FILES)
+                if os.path.exists(path)]
+
+    @staticmethod
+    def _checksum(paths: Iterable[str]) -> int:
+        """CRC-32 of the files' contents, one after the other."""
+        crc = 0
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def _recover(self):
+        """Drop the segments a crash left incomplete. Caller must hold ``self._lock``.
+
+        Only segments appended since the last commit can be incomplete; the
+        first whose checksum does not match is dropped with all later ones.
+        """
+        synced = self.manifest.get("synced", self.manifest["next_segment"])
+        segments = self.manifest["segments"]
+        for position, entry in enumerate(segments):
+            if self._segment_number(entry["name"]) < synced or "crc" not in entry:
+                continue
+            try:
+                if self._checksum(self._segment_paths(entry["name"])) == entry["crc"]:
+                    continue
+            except OSError:
+                pass
+            dropped = segments[position:]
+            self.manifest["segments"] = segments[:position]
+            for lost in dropped:
+                self.deleted.pop(lost["name"], None)
+            snapshot = self.index_snapshot
+            if snapshot and snapshot["rows"] > sum(kept["count"] for kept in self.manifest["segments"]):
+                self.manifest.pop("index")
+            logger.error(f"Dropped {len(dropped)} segments of {sum(lost['count'] for lost in dropped)} documents "
+                         f"that were not completely written before a crash")
+            self._write_tombstone_log()
+            self._write_manifest()
+            return
+
+    def _read_tombstones(self) -> Dict[str, List[int]]:
+        deleted = {}
+        # Format 1 manifests kept the deleted lines in the segment entries
+        for entry in self.manifest["segments"]:
+            lines = entry.pop("deleted", None)
+            if lines:
+                deleted[entry["name"]] = sorted(lines)
+        names = {entry["name"] for entry in self.manifest["segments"]}
+        if self.manifest.get("tombstones"):
+            with open(self._path(self.manifest["tombstones"], "log"), 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    # Ignore a torn last line and entries for segments compacted away
+                    if len(parts) == 2 and parts[0] in names and parts[1].isdigit():
+                        self._insert(deleted.setdefault(parts[0], []), int(parts[1]))
+        return deleted
+
+    @staticmethod
+    def _insert(lines: List[int], position: int) -> bool:
+        """Insert into a sorted list unless present. Returns whether it was inserted."""
+        index = bisect.bisect_left(lines, position)
+        if index < len(lines) and lines[index] == position:
+            return False
+        lines.insert(index, position)
+        return True
+
+    def _write_tombstone_log(self) -> Optional[str]:
+        """Start a new tombstone log holding the current deletes.
+
+        Caller must hold ``self._lock`` and write the manifest afterwards.
+        Returns the name of the replaced log.
+        """
+        old_name = self.manifest.get("tombstones")
+        name = f"tomb-{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        with open(self._path(name, "log"), 'w') as f:
+            for entry in self.manifest["segments"]:
+                for position in self.deleted.get(entry["name"], []):
+                    f.write(f"{entry['name']} {position}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.manifest["tombstones"] = name
+        return old_name
+
+    def _index_segments(self):
+        """Recompute the first row of every segment. Caller must hold ``self._lock``."""
+        starts = [0]
+        for entry in self.manifest["segments"]:
+            starts.append(starts[-1] + entry["count"])
+        self._starts = starts
+        # Stop mapping replaced segments; readers still holding them keep their mapping
+        names = {entry["name"] for entry in self.manifest["segments"]}
+        self._mapped = {name: columns for name, columns in self._mapped.items() if name in names}
+        if self._tombstone_log is not None and self._tombstone_log_name != self.manifest.get("tombstones"):
+            # Another writer started a new log
+            self._tombstone_log.close()
+            self._tombstone_log = None
+
+    def _remove_orphans(self):
+        """Remove files replaced by a merge or compaction that was interrupted before cleanup.
+
+        Segments are written either under ``maintenance_lock`` or, by
+        ``append``, under ``self._lock``, so with both held nothing is in
+        flight. Files numbered at or above ``next_segment`` were never
+        reserved and are simply overwritten if they were abandoned, so they
+        are kept. Cleanup is skipped while another process holds the locks.
+        """
+        if not self.maintenance_lock.acquire(blocking=False):
+            return
+        try:
+            if not self._lock.acquire(blocking=False):
+                return
+            try:
+                self._sync()
+                live = {entry["name"] for entry in self.manifest["segments"]}
+                live.add(self.manifest.get("tombstones"))
+                live.add((self.index_snapshot or {}).get("name"))
+                for filename in os.listdir(self.directory):
+                    match = STORE_FILE.match(filename)
+                    if (match and int(match.group(2)) < self.manifest["next_segment"]
+                            and filename.rsplit('.', 1)[0] not in live):
+                        self._remove(os.path.join(self.directory, filename))
+            finally:
+                self._lock.release()
+        finally:
+            self.maintenance_lock.release()
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _path(self, name: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    def _reserve_name(self, prefix: str = "seg") -> str:
+        """Reserve a file number, persisting it so no other process can take it."""
+        with self._lock:
+            self._sync()
+            name = f"{prefix}-{self.manifest['next_segment']:06d}"
+            self.manifest["next_segment"] += 1
+            self._write_manifest()
+        return name
+
+    def _write_segment(self, name: str, ids: List[str], documents: Sequence,
+                       metadata: Sequence, vectors: Optional[sparse.csr_matrix], durable: bool = True) -> int:
+        """Write the files of a segment, fsynced if ``durable``. Returns their checksum."""
+        SegmentContents.write(self._path(name, "ids"), ids)
+        SegmentContents.write(self._path(name, "meta"), (json.dumps(meta) for meta in metadata))
+        SegmentContents.write(self._path(name, "bin"), documents)
+        if vectors is not None:
+            sparse.save_npz(self._path(name, "npz"), sparse.csr_matrix(vectors), compressed=False)
+        paths = self._segment_paths(name)
+        if durable:
+            for path in paths:
+                self._fsync(path)
+        return self._checksum(paths)
+
+    def _read_segment(self, name: str, skip: Optional[List[int]] = None):
+        """Read every row of a segment except the lines in ``skip``.
+
+        Only the IDs are decoded; the documents and metadata are returned as
+        lazy sequences over the mapped files.
+        """
+        if os.path.exists(self._path(name, "ids")):
+            ids = list(SegmentContents.open(self._path(name, "ids")))
+            documents, metadata = self._columns(name)
+        else:
+            ids, documents, metadata = self._read_jsonl(name)
+            self._mapped.setdefault(name, (documents, metadata))
+        if skip:
+            skip = set(skip)
+            keep = [line for line in range(len(ids)) if line not in skip]
+            ids = [ids[line] for line in keep]
+            documents = ContentList([documents]).take(keep)
+            metadata = ContentList([metadata]).take(keep)
+        return ids, documents, metadata, self._read_vectors(name, skip)
+
+    def _read_jsonl(self, name: str) -> Tuple[List[str], Sequence, List[Dict[str, Any]]]:
+        """Read a segment of format 3 or older, which kept IDs and metadata as JSON lines."""
+        ids, metadata, inline = [], [], []
+        with open(self._path(name, "jsonl"), 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                ids.append(record["id"])
+                metadata.append(record["metadata"])
+                if "content" in record:
+                    # Format 2 segments also kept the bodies inline
+                    inline.append(record["content"])
+        documents = inline if inline else SegmentContents.open(self._path(name, "bin"), len(ids))
+        return ids, documents, metadata
+
+    def _columns(self, name: str) -> Tuple[Sequence, Sequence]:
+        """The bodies and metadata of a segment, mapped once and shared by every reader."""
+        columns = self._mapped.get(name)
+        if columns is None:
+            if os.path.exists(self._path(name, "meta")):
+                columns = (SegmentContents.open(self._path(name, "bin")),
+                           MetadataList(SegmentContents.open(self._path(name, "meta"))))
+            else:
+                columns = self._read_jsonl(name)[1:]
+            self._mapped[name] = columns
+        return columns
+
+    def columns(self, rows: Optional[int] = None, epoch: Optional[int] = None) -> Optional[Tuple[ContentList, ContentList]]:
+        """The bodies and metadata of the first ``rows`` rows (all rows by default), read lazily.
+
+        Returns None if ``epoch`` is given and the rows have been renumbered since.
+        """
+        with self._lock:
+            self._sync()
+            if epoch is not None and epoch != self.epoch:
+                return None
+            columns = [self._columns(entry["name"]) for entry in self.manifest["segments"]]
+        documents, metadata = (ContentList(column[i] for column in columns) for i in (0, 1))
+        if rows is None:
+            return documents, metadata
+        return documents[:rows], metadata[:rows]
+
+    def _read_vectors(self, name: str, skip: Optional[set] = None) -> Optional[sparse.csr_matrix]:
+        if not os.path.exists(self._path(name, "npz")):
+            return None
+        vectors = sparse.load_npz(self._path(name, "npz")).tocsr()
+        if skip:
+            keep = np.ones(vectors.shape[0], dtype=bool)
+            keep[list(skip)] = False
+            vectors = vectors[keep]
+        return vectors
+
+    def append(self, ids: List[str], documents: List[str], metadata: List[Dict[str, Any]],
+               vectors: Optional[sparse.csr_matrix] = None) -> Tuple[int, int]:
+        """Write new documents as a segment. Costs O(size of the new documents).
+
+        Returns the epoch and the row of the first new document.
+        """
+        with self._lock:
+            # Written under the lock so the reservation and the manifest update are one change
+            self._sync()
+            first_row = self.row_count
+            if not documents:
+                return self.epoch, first_row
+            name = f"seg-{self.manifest['next_segment']:06d}"
+            self.manifest["next_segment"] += 1
+            # Fsynced by the commit, which may come later
+            crc = self._write_segment(name, ids, documents, metadata, vectors, durable=False)
+            self.manifest["segments"].append({"name": name, "count": len(documents), "crc": crc})
+            self._write_manifest(commit=self._commit_due())
+            self._index_segments()
+            epoch = self.epoch
+        logger.debug(f"Appended segment {name} with {len(documents)} documents")
+        self._maybe_merge()
+        return epoch, first_row
+
+    def delete(self, row: int, epoch: Optional[int] = None) -> bool:
+        """Record the deletion of a row by appending it to the tombstone log.
+
+        Returns False without deleting anything if ``epoch`` is given and the
+        rows have been renumbered since.
+        """
+        with self._lock:
+            self._sync()
+            if epoch is not None and epoch != self.epoch:
+                return False
+            if not 0 <= row < self.row_count:
+                raise IndexError("row out of range")
+            segment = bisect.bisect_right(self._starts, row) - 1
+            name = self.manifest["segments"][segment]["name"]
+            position = row - self._starts[segment]
+            if not self._insert(self.deleted.setdefault(name, []), position):
+                return True
+
+            if self.manifest.get("tombstones") is None:
+                self._write_tombstone_log()
+                self._write_manifest()
+            else:
+                if self._tombstone_log is None:
+                    self._tombstone_log_name = self.manifest["tombstones"]
+                    self._tombstone_log = open(self._path(self._tombstone_log_name, "log"), 'a')
+                self._tombstone_log.write(f"{name} {position}\n")
+                self._tombstone_log.flush()
+                if not self._commit_due():
+                    self._bump()
+                elif self.durability == "write":
+                    # The manifest is unchanged, only the log needs to reach the disk
+                    os.fsync(self._tombstone_log.fileno())
+                    self._uncommitted = 0
+                    self._bump()
+                else:
+                    self._write_manifest()
+            return True
+
+    def deleted_rows(self) -> set:
+        """Rows of every deleted document."""
+        with self._lock:
+            self._sync()
+            rows = set()
+            for segment, entry in enumerate(self.manifest["segments"]):
+                start = self._starts[segment]
+                rows.update(start + line for line in self.deleted.get(entry["name"], []))
+            return rows
+
+    def load(self, attempts: int = 3) -> List[Tuple[List[str], List[str], List[Dict[str, Any]], Optional[sparse.csr_matrix], List[int]]]:
+        """Replay the manifest, returning (ids, documents, metadata, vectors, deleted lines) per segment.
+
+        Deleted rows are included so row positions match the store's.
+        """
+        for attempt in range(attempts):
+            with self._lock:
+                self._sync()
+                names = [entry["name"] for entry in self.manifest["segments"]]
+                deleted = {name: list(self.deleted.get(name, [])) for name in names}
+            try:
+                return [self._read_segment(name) + (deleted[name],) for name in names]
+            except FileNotFoundError:
+                # Another writer replaced segments since the manifest was read
+                if attempt == attempts - 1:
+                    raise
+                self._resync()
+
+    def _resync(self):
+        """Re-read the manifest even if no change was published (e.g. a pre-generation writer)."""
+        with self._lock:
+            self._synced = None
+            self._sync()
+
+    def read_rows(self, start: int, attempts: int = 3) -> Tuple[List[str], List[str], List[Dict[str, Any]], Optional[sparse.csr_matrix]]:
+        """Read (ids, documents, metadata, vectors) of every row from ``start`` on, deleted rows included."""
+        for attempt in range(attempts):
+            with self._lock:
+                self._sync()
+                first = max(bisect.bisect_right(self._starts, start) - 1, 0)
+                names = [entry["name"] for entry in self.manifest["segments"][first:]]
+                skip = start - self._starts[first]
+            try:
+                parts = [self._read_segment(name) for name in names]
+            except FileNotFoundError:
+                if attempt == attempts - 1:
+                    raise
+                self._resync()
+                continue
+            ids = [doc_id for part in parts for doc_id in part[0]][skip:]
+            documents, metadata = (ContentList(part[i] for part in parts)[skip:] for i in (1, 2))
+            vectors = None
+            if parts and all(part[3] is not None for part in parts):
+                vectors = sparse.vstack([part[3] for part in parts], format='csr')[skip:]
+            return ids, documents, metadata, vectors
+
+    def clear(self):
+        """Delete every segment."""
+        with self.maintenance_lock, self._lock:
+            self._sync()
+            names = [entry["name"] for entry in self.manifest["segments"]]
+            self.manifest["segments"] = []
+            self.deleted = {}
+            old_log = self._write_tombstone_log()
+            old_snapshot = self._renumber()
+            self._write_manifest()
+            self._index_segments()
+        for name in names:
+            self._remove_files(name)
+        self._remove_log(old_log)
+        self._remove_snapshot(old_snapshot)
+
+    def _renumber(self) -> Optional[Dict[str, Any]]:
+        """Start a new epoch, dropping the index snapshot of the old one.
+
+        Caller must hold ``self._lock`` and write the manifest afterwards.
+        Returns the dropped snapshot.
+        """
+        self.manifest["epoch"] = self.epoch + 1
+        return self.manifest.pop("index", None)
+
+    def _remove_snapshot(self, snapshot: Optional[Dict[str, Any]]):
+        if snapshot:
+            # Processes that mapped the file keep their mapping after the unlink
+            self._remove(self.snapshot_path(snapshot))
+
+    def _remove_files(self, name: str):
+        for extension in ("jsonl", "ids", "meta", "bin", "npz"):
+            self._remove(self._path(name, extension))
+
+    def _remove_log(self, name: Optional[str]):
+        if name:
+            self._remove(self._path(name, "log"))
+
+    # Merging
+
+    def _pick_merge(self) -> Optional[Tuple[str, str]]:
+        """Pick two adjacent segments whose sizes are within a factor of two."""
+        with self._lock:
+            self._sync()
+            segments = self.manifest["segments"]
+            for i in range(len(segments) - 1, 0, -1):
+                if segments[i - 1]["count"] <= 2 * segments[i]["count"]:
+                    return segments[i - 1]["name"], segments[i]["name"]
+        return None
+
+    def _maybe_merge(self):
+        if not self.merge_in_background or self._pick_merge() is None:
+            return
+        if self._merge_thread is None or not self._merge_thread.is_alive():
+            self._merge_thread = threading.Thread(target=self.merge_segments, daemon=True)
+            self._merge_thread.start()
+
+    def wait_for_merges(self):
+        """Block until a running background merge has finished."""
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def merge_segments(self) -> int:
+        """Merge adjacent segments until none qualify. Returns the number of merges."""
+        merges = 0
+        with self.maintenance_lock:
+            while True:
+                pair = self._pick_merge()
+                if pair is None:
+                    return merges
+                try:
+                    self._merge(*pair)
+                except Exception as e:
+                    logger.error(f"Error merging segments: {e}")
+                    return merges
+                merges += 1
+
+    def _merge(self, older: str, newer: str):
+        older_data = self._read_segment(older)
+        newer_data = self._read_segment(newer)
+        ids = older_data[0] + newer_data[0]
+        documents, metadata = (ContentList([older_data[i], newer_data[i]]) for i in (1, 2))
+        vectors = None
+        if older_data[3] is not None and newer_data[3] is not None:
+            vectors = sparse.vstack([older_data[3], newer_data[3]], format='csr')
+
+        name = self._reserve_name()
+        crc = self._write_segment(name, ids, documents, metadata, vectors)
+
+        with self._lock:
+            self._sync()
+            segments = self.manifest["segments"]
+            position = next(i for i, entry in enumerate(segments) if entry["name"] == older)
+            older_count = segments[position]["count"]
+            segments[position:position + 2] = [{"name": name, "count": len(documents), "crc": crc}]
+            # Row positions do not change, only the segment the deletes refer to
+            deleted = self.deleted.pop(older, []) + [older_count + line for line in self.deleted.pop(newer, [])]
+            if deleted:
+                self.deleted[name] = deleted
+            old_log = self._write_tombstone_log()
+            self._write_manifest()
+            self._index_segments()
+
+        self._remove_files(older)
+        self._remove_files(newer)
+        self._remove_log(old_log)
+        logger.debug(f"Merged segments {older} and {newer} into {name}")
+
+    # Compaction
+
+    def plan_compaction(self) -> Dict[str, Any]:
+        """Snapshot the segments and deleted rows a compaction will drop.
+
+        The caller must hold ``maintenance_lock`` from here until
+        ``commit_compaction`` so no merge replaces the planned segments.
+        """
+        with self._lock:
+            self._sync()
+            return {
+                "segments": [entry["name"] for entry in self.manifest["segments"]],
+                "deleted": {name: list(lines) for name, lines in self.deleted.items() if lines},
+                "replacements": {},
+                "checksums": {},
+            }
+
+    def write_compaction(self, plan: Dict[str, Any]):
+        """Rewrite every planned segment that has deleted rows without them."""
+        for name, lines in plan["deleted"].items():
+            ids, documents, metadata, vectors = self._read_segment(name, skip=lines)
+            replacement = None
+            if documents:
+                replacement = self._reserve_name()
+                plan["checksums"][replacement] = self._write_segment(replacement, ids, documents, metadata, vectors)
+            plan["replacements"][name] = replacement
+
+    def read_plan_vectors(self, plan: Dict[str, Any]) -> Optional[sparse.csr_matrix]:
+        """Read the vectors of the rows kept by a written compaction, in order."""
+        vectors = []
+        for name in plan["segments"]:
+            name = plan["replacements"].get(name, name)
+            if name is None:
+                continue
+            segment_vectors = self._read_vectors(name)
+            if segment_vectors is None:
+                return None
+            vectors.append(segment_vectors)
+        return sparse.vstack(vectors, format='csr') if vectors else None
+
+    def read_vectors(self, rows: int) -> Optional[sparse.csr_matrix]:
+        """Read the vectors of the first ``rows`` rows, or None if a segment has none.
+
+        The caller must hold ``maintenance_lock`` so no merge replaces the segments.
+        """
+        with self._lock:
+            self._sync()
+            names = [entry["name"] for entry in self.manifest["segments"]]
+        vectors, total = [], 0
+        for name in names:
+            if total >= rows:
+                break
+            segment_vectors = self._read_vectors(name)
+            if segment_vectors is None:
+                return None
+            vectors.append(segment_vectors)
+            total += segment_vectors.shape[0]
+        return sparse.vstack(vectors, format='csr')[:rows] if vectors else None
+
+    def commit_compaction(self, plan: Dict[str, Any]):
+        """Swap the rewritten segments in, renumbering the rows.
+
+        Rows deleted after ``plan_compaction`` stay deleted in the new segments.
+        """
+        with self._lock:
+            self._sync()
+            segments = []
+            for entry in self.manifest["segments"]:
+                name = entry["name"]
+                if name not in plan["replacements"]:
+                    segments.append(entry)
+                    continue
+                dropped = plan["deleted"][name]
+                dropped_set = set(dropped)
+                late = [line for line in self.deleted.pop(name, []) if line not in dropped_set]
+                replacement = plan["replacements"][name]
+                if replacement is None:
+                    continue
+                segments.append({"name": replacement, "count": entry["count"] - len(dropped),
+                                 "crc": plan["checksums"][replacement]})
+                if late:
+                    self.deleted[replacement] = [line - bisect.bisect_left(dropped, line) for line in late]
+            self.manifest["segments"] = segments
+            old_log = self._write_tombstone_log()
+            old_snapshot = self._renumber()
+            self._write_manifest()
+            self._index_segments()
+
+        for name in plan["replacements"]:
+            self._remove_files(name)
+        self._remove_log(old_log)
+        self._remove_snapshot(old_snapshot)
+        logger.debug(f"Compacted {len(plan['replacements'])} segments")
+
+    # Index snapshots
+
+    def snapshot_path(self, snapshot: Dict[str, Any]) -> str:
+        return self._path(snapshot["name"], "faiss")
+
+    def write_index_snapshot(self, rows: int, epoch: int, write: Callable[[str], None]) -> bool:
+        """Publish an index over the first ``rows`` rows of ``epoch``, written by ``write(path)``.
+
+        Other processes can map the file instead of building their own
+        index. The snapshot is discarded if the rows were renumbered in the
+        meantime or a snapshot of at least as many rows already exists.
+        Returns whether it was published.
+        """
+        name = self._reserve_name("index")
+        snapshot = {"name": name, "rows": rows, "epoch": epoch}
+        path = self.snapshot_path(snapshot)
+        write(path)
+        # Only published once it is completely on disk
+        self._fsync(path)
+        snapshot["crc"] = self._checksum([path])
+        self._verified.add(name)
+        with self._lock:
+            self._sync()
+            current = self.index_snapshot
+            published = epoch == self.epoch and rows <= self.row_count and (current is None or current["rows"] < rows)
+            if published:
+                self.manifest["index"] = snapshot
+                self._write_manifest()
+        self._remove_snapshot(current if published else snapshot)
+        if published:
+            logger.debug(f"Published index snapshot {name} of {rows} rows")
+        return published
+
+    def verify_snapshot(self, snapshot: Dict[str, Any]) -> bool:
+        """Whether an index snapshot file matches its checksum. Checked once per snapshot and process."""
+        if snapshot["name"] in self._verified or "crc" not in snapshot:
+            return True
+        try:
+            valid = self._checksum([self.snapshot_path(snapshot)]) == snapshot["crc"]
+        except OSError:
+            return False
+        if valid:
+            self._verified.add(snapshot["name"])
+        return valid
@@ -0,0 +1,294 @@
+import base64
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from vector_db import DATABASE_OPTIONS, DOCUMENT_FIELDS, VectorDatabase
+
+logger = logging.getLogger(__name__)
+
+# Collection names double as directory names
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def validate_collection_name(name: str):
+    """Raise ValueError unless ``name`` is a valid collection name."""
+    if not isinstance(name, str) or not COLLECTION_NAME.match(name):
+        raise ValueError("collection must be 1-64 letters, digits, '_' or '-'")
+
+def shard_key(doc_id: str) -> str:
+    """The part of a document ID that picks its shard: passages ``<parent>#<n>`` stay with their parent."""
+    return doc_id.partition("#")[0]
+
+class ShardedCollection:
+    """A named collection of documents split over independent ``VectorDatabase`` shards.
+
+    Each document goes to the shard picked by a hash of its ID; passages
+    follow their parent document, so collapsing works within a shard. Every
+    shard has its own index and segment store in ``<directory>/shard-<i>``
+    and compacts and rebuilds on its own. Searches fan out to all shards on
+    a thread pool (FAISS releases the GIL while it searches) and the ranked
+    hits of the shards are merged with a heap, so search latency follows
+    the largest shard rather than the whole collection.
+
+    The number of shards is fixed when the collection is created and
+    recorded in ``collection.json``, since it decides where every document
+    lives. Scores come from each shard's own IDF statistics, which agree
+    closely once the shards hold a few hundred documents each.
+    """
+
+    def __init__(self, name: str, directory: str, shards: int = 4, **options):
+        validate_collection_name(name)
+        self.name = name
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.shard_count = self._shard_count(shards)
+        self.shards = [
+            VectorDatabase(persist_directory=os.path.join(directory, f"shard-{i}"), **dict(options, lazy=True))
+            for i in range(self.shard_count)
+        ]
+        self._pool = ThreadPoolExecutor(max_workers=self.shard_count, thread_name_prefix=f"collection-{name}")
+        if not options.get("lazy", False):
+            self.warm_up()
+
+    def _shard_count(self, shards: int) -> int:
+        """The recorded shard count, or ``shards`` for a new collection."""
+        path = os.path.join(self.directory, "collection.json")
+        try:
+            # Exclusive create: of several processes opening a new collection, the first one decides
+            with open(path, "x") as file:
+                json.dump({"shards": shards}, file)
+            return shards
+        except FileExistsError:
+            with open(path) as file:
+                return json.load(file)["shards"]
+
+    def _map(self, function, shards=None) -> List[Any]:
+        """Run ``function`` on every shard in parallel, returning the results in shard order."""
+        return list(self._pool.map(function, self.shards if shards is None else shards))
+
+    @property
+    def ready(self) -> bool:
+        return all(shard.ready for shard in self.shards)
+
+    def warm_up(self):
+        """Load every shard, in parallel."""
+        self._map(lambda shard: shard.warm_up())
+
+    def shard_for(self, doc_id: str) -> VectorDatabase:
+        """The shard that stores ``doc_id``."""
+        return self.shards[zlib.crc32(shard_key(doc_id).encode("utf-8")) % self.shard_count]
+
+    def add_documents(self, documents: List[str], metadata: List[Dict[str, Any]] = None, ids: List[str] = None):
+        """Add documents, each to its shard, tokenizing for the shards in parallel.
+
+        Like ``VectorDatabase.add_documents`` raises ValueError, without
+        adding anything, if an ID is already stored or repeated. The write
+        and store locks of every shard written to are held, taken in shard
+        order, from the ID check until the last shard is written, so no
+        other writer of any process can take an ID in between. A disk error
+        can still leave the shards written before it.
+        """
+        if metadata is None:
+            metadata = [{}] * len(documents)
+        if ids is None:
+            ids = [f"doc_{uuid.uuid4().hex}" for _ in documents]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Document IDs are repeated")
+        groups = {}
+        for doc_id, document, meta in zip(ids, documents, metadata):
+            shard = self.shard_for(doc_id)
+            group = groups.setdefault(id(shard), (shard, [], [], []))
+            group[1].append(document)
+            group[2].append(meta)
+            group[3].append(doc_id)
+        groups = sorted(groups.values(), key=lambda group: self.shards.index(group[0]))
+        # The costly part, done before any lock is taken
+        counts = self._map(lambda group: group[0]._tokenize(group[1]), groups)
+        with ExitStack() as locks:
+            for shard, _, _, _ in groups:
+                locks.enter_context(shard._write_lock)
+                locks.enter_context(shard.store.lock)
+            for shard, _, _, shard_ids in groups:
+                # Checked up front, so a taken ID does not leave the other shards written
+                shard.refresh()
+                shard._check_new_ids(shard_ids)
+            for (shard, shard_documents, shard_metadata, shard_ids), shard_counts in zip(groups, counts):
+                shard._store_documents(shard_documents, shard_metadata, shard_ids, shard_counts)
+        for shard, _, _, _ in groups:
+            shard._maybe_maintain()
+        logger.info(f"Added {len(documents)} documents to collection {self.name} over {len(groups)} shards")
+
+    def add_document(self, doc_id: str, content: str, metadata: Dict[str, Any] = None) -> bool:
+        """Add a single document. Returns False if it could not be stored."""
+        return self.shard_for(doc_id).add_document(doc_id, content, metadata)
+
+    def get_document(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Get a document by its ID, or None if it does not exist."""
+        return self.shard_for(doc_id).get_document(doc_id)
+
+    def delete_document(self, doc_id: str) -> bool:
+        """Delete a document by its ID."""
+        return self.shard_for(doc_id).delete_document(doc_id)
+
+    def update_document(self, doc_id: str, content: str, metadata: Dict[str, Any] = None) -> bool:
+        """Replace the content and metadata of an existing document."""
+        return self.shard_for(doc_id).update_document(doc_id, content, metadata)
+
+    def get_document_count(self) -> int:
+        return sum(shard.get_document_count() for shard in self.shards)
+
+    def find_by_metadata(self, field: str, values: List[Any]) -> Dict[Any, str]:
+        """Like ``VectorDatabase.find_by_metadata``, over every shard."""
+        if not values:
+            return {}
+        found = {}
+        for shard_found in self._map(lambda shard: shard.find_by_metadata(field, values)):
+            for value, doc_id in shard_found.items():
+                found.setdefault(value, doc_id)
+        return found
+
+    def query_batch(self, query_texts: List[str], n_results: int = 5, collapse: bool = False,
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                    where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Query every shard for the top ``n_results`` hits and merge them per text."""
+        per_shard = self._map(lambda shard: shard.query_batch(query_texts, n_results, collapse,
+                                                              nprobe, ef_search, where))
+        return [self._merge([results[i] for results in per_shard], n_results) for i in range(len(query_texts))]
+
+    @staticmethod
+    def _merge(results: List[Dict[str, Any]], n_results: int) -> Dict[str, Any]:
+        """Merge per-shard results, each ranked by distance, into the overall top ``n_results``."""
+        ranked = [[(distance, shard, hit) for hit, distance in enumerate(result["distances"])]
+                  for shard, result in enumerate(results)]
+        top = list(itertools.islice(heapq.merge(*ranked), n_results))
+        return {field: [results[shard][field][hit] for _, shard, hit in top]
+                for field in ("documents", "metadata", "ids", "distances")}
+
+    def query(self, query_text: str, n_results: int = 5, collapse: bool = False,
+              nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+              where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Query the collection, see ``VectorDatabase.query``."""
+        return self.query_batch([query_text], n_results, collapse, nprobe, ef_search, where)[0]
+
+    def search_documents(self, query_text: str, n_results: int = 5, collapse: bool = False,
+                         nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                         where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, List[List[Any]]]]:
+        """Search documents. Returns None if the search fails."""
+        return self.search_documents_batch([query_text], n_results, collapse, nprobe, ef_search, where)
+
+    def search_documents_batch(self, query_texts: List[str], n_results: int = 5, collapse: bool = False,
+                               nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                               where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, List[List[Any]]]]:
+        """Search documents for many queries. Returns None if the search fails."""
+        try:
+            return VectorDatabase._nested(self.query_batch(query_texts, n_results, collapse, nprobe, ef_search, where))
+        except Exception as e:
+            logger.error(f"Error searching collection {self.name}: {e}")
+            return None
+
+    def list_documents_page(self, limit: int = 100, after: Optional[str] = None,
+                            fields: Sequence[str] = DOCUMENT_FIELDS) -> Tuple[Iterator[Dict[str, Any]], Optional[str]]:
+        """List documents shard by shard, see ``VectorDatabase.list_documents_page``.
+
+        A page never spans two shards, so it can hold fewer than ``limit``
+        documents before the listing ends; it ends when the cursor is None.
+        """
+        if after:
+            try:
+                shard, cursor = json.loads(base64.urlsafe_b64decode(after.encode()))
+            except (ValueError, TypeError):
+                raise ValueError("Invalid cursor")
+            if not isinstance(shard, int) or not 0 <= shard < self.shard_count:
+                raise ValueError("Invalid cursor")
+        else:
+            shard, cursor = self._next_shard(0), None
+        if shard is None:
+            return iter(()), None
+        page, cursor = self.shards[shard].list_documents_page(limit, cursor, fields)
+        if cursor is None:
+            shard = self._next_shard(shard + 1)
+            if shard is None:
+                return page, None
+        return page, base64.urlsafe_b64encode(json.dumps([shard, cursor]).encode()).decode()
+
+    def _next_shard(self, start: int) -> Optional[int]:
+        """The first shard from ``start`` on that holds documents."""
+        return next((i for i in range(start, self.shard_count) if self.shards[i].get_document_count()), None)
+
+    def get_collection_info(self) -> Optional[Dict[str, Any]]:
+        """Get information about the collection and each of its shards for the /db-info endpoint."""
+        try:
+            shards = self._map(lambda shard: shard.get_stats())
+            return {
+                "name": self.name,
+                "count": sum(stats["document_count"] for stats in shards),
+                "document_count": sum(stats["document_count"] for stats in shards),
+                "shard_count": self.shard_count,
+                "index_memory_bytes": sum(stats["index_memory_bytes"] for stats in shards),
+                "persist_directory": self.directory,
+                "shards": shards,
+            }
+        except Exception as e:
+            logger.error(f"Error getting info of collection {self.name}: {e}")
+            return None
+
+    def close(self):
+        """Stop the fan-out threads."""
+        self._pool.shutdown()
+
+class CollectionRegistry:
+    """Named sharded collections under one directory, opened on first use.
+
+    Collections are only created when asked to, e.g. by an upload; looking
+    up a collection that does not exist leaves no trace on disk.
+    """
+
+    def __init__(self, directory: str = "collections", shards: int = 4, **options):
+        self.directory = directory
+        self.shards = shards
+        self.options = options
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, create: bool = False) -> Optional[ShardedCollection]:
+        """The collection called ``name``, or None if it does not exist.
+
+        With ``create=True`` a missing collection is created. Raises
+        ValueError for an invalid name.
+        """
+        validate_collection_name(name)
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is not None:
+                return collection
+            directory = os.path.join(self.directory, name)
+            if not create and not os.path.exists(os.path.join(directory, "collection.json")):
+                return None
+            collection = ShardedCollection(name, directory, self.shards, **dict(self.options, lazy=True))
+            self._collections[name] = collection
+            logger.info(f"Opened collection {name} with {collection.shard_count} shards")
+        # Once, outside the registry lock, so other collections stay available meanwhile
+        collection.warm_up()
+        return collection
+
+    def names(self) -> List[str]:
+        """Names of the collections stored in the directory."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if COLLECTION_NAME.match(name) and os.path.exists(os.path.join(self.directory, name, "collection.json")))
+
+# Shared registry used by the Flask app
+collection_registry = CollectionRegistry(
+    os.getenv("COLLECTIONS_DIR", "collections"),
+    shards=int(os.getenv("COLLECTION_SHARDS", "4")),
+    **DATABASE_OPTIONS,
+)
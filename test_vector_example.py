@@ -76,11 +76,11 @@ def test_vector_database():
     
     # List all documents
     print("\n6. Listing all documents...")
-    response = requests.get(f"{BASE_URL}/documents")
+    response = requests.get(f"{BASE_URL}/documents", params={"limit": 3, "fields": "id,metadata"})
     if response.status_code == 200:
         docs = response.json()
-        print(f"Total documents: {docs['count']}")
-        for doc in docs['documents'][:3]:  # Show first 3
+        print(f"Total documents: {docs['total']}")
+        for doc in docs['documents']:  # Show first 3
             print(f"  - ID: {doc['id']}")
             print(f"    Filename: {doc['metadata'].get('filename', 'Unknown')}")
             print(f"    Size: {doc['metadata'].get('file_size', 'Unknown')} bytes")
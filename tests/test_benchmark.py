@@ -0,0 +1,62 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import benchmark
+
+OPTIONS = {
+    "doc_length": 20,
+    "vocabulary": 500,
+    "ingest_batch_size": 100,
+    "queries": 20,
+    "query_batch_size": 8,
+    "n_results": 3,
+    "backend": "faiss",
+    "index_type": "flat",
+    "cache_size": 0,
+}
+
+def test_synthetic_corpus_is_reproducible():
+    """Test that the same seed generates the same corpus in batches"""
+    first = list(benchmark.synthetic_batches(250, batch_size=100, length=10))
+    second = list(benchmark.synthetic_batches(250, batch_size=100, length=10))
+
+    assert first == second
+    assert [len(ids) for ids, _ in first] == [100, 100, 50]
+    assert first[2][0][-1] == "doc249"
+    assert all(5 <= len(doc.split()) <= 15 for _, docs in first for doc in docs)
+
+def test_run_reports_every_metric(tmp_path):
+    """Test a small benchmark run through the API and the endpoints"""
+    report = benchmark.run([300], OPTIONS, isolate=False)
+
+    result = report["results"][0]
+    assert result["documents"] == 300
+    assert result["ingest"]["docs_per_second"] > 0
+    assert result["query"]["count"] == 20
+    assert result["query"]["p50_ms"] <= result["query"]["p99_ms"]
+    assert result["batch_query"]["count"] == 3
+    assert set(result["api"]) == {"search", "search_batch", "documents_page"}
+    assert result["load_seconds"] > 0
+    assert result["delete"]["count"] == 30
+    assert result["peak_rss_bytes"] > 0
+
+    # Results are plain JSON and a run never regresses against itself
+    path = tmp_path / "baseline.json"
+    path.write_text(json.dumps(report))
+    assert benchmark.compare(report, json.loads(path.read_text())) == []
+
+def test_compare_flags_regressions():
+    """Test that slower latencies and lower throughput are regressions"""
+    def report(p50, rate):
+        return {"results": [{"documents": 10, "query": {"count": 5, "p50_ms": p50},
+                             "ingest": {"docs_per_second": rate}}]}
+
+    assert benchmark.compare(report(1.05, 95), report(1.0, 100)) == []
+    regressions = benchmark.compare(report(2.0, 50), report(1.0, 100))
+    assert len(regressions) == 2
+    assert regressions[0].startswith("10.query.p50_ms")
+    assert benchmark.compare(report(0.5, 200), report(1.0, 100)) == []
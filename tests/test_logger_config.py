@@ -0,0 +1,70 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import logging
+import queue
+from flask import Flask
+from logger_config import JsonFormatter, NonBlockingQueueHandler, RouteSampler, SharedRotatingFileHandler
+
+def make_record(msg, *args, level=logging.INFO):
+    return logging.LogRecord("test", level, __file__, 1, msg, args, None)
+
+def test_route_sampler_rate_limits_per_request():
+    """Test that a rate-limited route logs whole requests up to the rate"""
+    app = Flask(__name__)
+    app.add_url_rule("/health", "health", lambda: "ok")
+    app.add_url_rule("/search", "search", lambda: "ok")
+    sampler = RouteSampler.from_string("/health=1/s, /search=0")
+
+    with app.test_request_context("/health"):
+        assert sampler.filter(make_record("first request"))
+        assert sampler.filter(make_record("same request"))
+    with app.test_request_context("/health"):
+        assert not sampler.filter(make_record("over the rate"))
+        assert sampler.filter(make_record("warnings are kept", level=logging.WARNING))
+    with app.test_request_context("/search"):
+        assert not sampler.filter(make_record("never sampled"))
+    with app.test_request_context("/documents"):
+        assert sampler.filter(make_record("other routes are kept"))
+    assert sampler.filter(make_record("outside a request"))
+
+def test_queue_handler_never_blocks():
+    """Test that records are queued unformatted and dropped when the queue is full"""
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+
+    handler.handle(make_record("Stored %d documents", 3))
+    handler.handle(make_record("dropped"))
+
+    record = handler.queue.get_nowait()
+    assert (record.msg, record.args) == ("Stored 3 documents", None)
+    assert handler.dropped == 1
+
+def test_json_formatter():
+    """Test that JSON output holds one parseable object per record"""
+    entry = json.loads(JsonFormatter().format(make_record("Searching for: %r", "ai")))
+
+    assert entry["message"] == "Searching for: 'ai'"
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "test"
+
+def test_rotating_file_handler(tmp_path):
+    """Test size-based rotation and reopening after another process rotated the log"""
+    path = tmp_path / "app.log"
+    handler = SharedRotatingFileHandler(str(path), maxBytes=100, backupCount=2)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+
+    for i in range(10):
+        handler.emit(make_record("x" * 30 + str(i)))
+    assert (tmp_path / "app.log.1").exists()
+    assert (tmp_path / "app.log.2").exists()
+    assert not (tmp_path / "app.log.3").exists()
+
+    # Another process renames the file away
+    os.replace(path, tmp_path / "app.log.2")
+    handler.emit(make_record("after rotation"))
+    handler.close()
+    assert path.read_text() == "after rotation\n"
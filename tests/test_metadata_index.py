@@ -0,0 +1,50 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from metadata_index import MetadataIndex, validate_where, where_key
+
+def make_index():
+    index = MetadataIndex()
+    index.add([
+        {"filename": "a.txt", "file_size": 10, "draft": True},
+        {"filename": "b.txt", "file_size": 20.5, "tags": ["x"]},
+        None,
+        {"filename": "a.txt", "file_size": 30, "draft": False},
+    ])
+    return index
+
+def test_equality_and_in():
+    """Test inverted index lookups"""
+    index = make_index()
+    
+    assert index.candidates({"filename": "a.txt"}).tolist() == [0, 3]
+    assert index.candidates({"filename": {"$in": ["b.txt", "c.txt"]}}).tolist() == [1]
+    assert index.candidates({"file_size": 10.0}).tolist() == [0]
+    # Booleans are not numbers
+    assert index.candidates({"draft": True}).tolist() == [0]
+    assert index.candidates({"draft": 1}).tolist() == []
+    assert index.candidates({"missing": "x"}).tolist() == []
+
+def test_ranges():
+    """Test sorted index lookups, also after more rows were added"""
+    index = make_index()
+    
+    assert index.candidates({"file_size": {"$gt": 10}}).tolist() == [1, 3]
+    assert index.candidates({"file_size": {"$gte": 10, "$lte": 20.5}}).tolist() == [0, 1]
+    assert index.candidates({"file_size": {"$lt": 10}}).tolist() == []
+    index.add([{"file_size": 15}])
+    assert index.candidates({"file_size": {"$gt": 10, "$lt": 30}}).tolist() == [1, 4]
+    assert index.candidates({"file_size": {"$gt": 10}, "filename": "a.txt"}).tolist() == [3]
+
+def test_validate_where():
+    """Test that malformed filters are rejected"""
+    validate_where({"filename": "a.txt", "file_size": {"$gte": 1, "$lt": 5}, "tag": {"$in": ["x", 1]}})
+    for where in ([], {"f": {"$regex": "a"}}, {"f": {"$gt": "a"}}, {"f": {"$in": "a"}}, {"f": {}}, {"f": ["a"]}):
+        with pytest.raises(ValueError):
+            validate_where(where)
+    assert where_key({"b": 1, "a": 2}) == where_key({"a": 2, "b": 1})
+    assert where_key(None) is None
@@ -0,0 +1,81 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import subprocess
+import pytest
+from metrics import Registry
+
+def test_histogram_buckets_are_cumulative():
+    """Test that observations are rendered as cumulative buckets with sum and count"""
+    registry = Registry()
+    seconds = registry.histogram("stage_seconds", "Stage latency", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        seconds.observe(value, stage="search")
+
+    text = registry.render()
+
+    assert "# TYPE stage_seconds histogram" in text
+    assert 'stage_seconds_bucket{stage="search",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="search",le="1"} 3' in text
+    assert 'stage_seconds_bucket{stage="search",le="+Inf"} 4' in text
+    assert 'stage_seconds_sum{stage="search"} 6.05' in text
+    assert 'stage_seconds_count{stage="search"} 4' in text
+
+def test_labels_are_checked_and_escaped():
+    """Test that every label must be given and values are escaped"""
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["path"])
+    requests.inc(path='a"b')
+    requests.inc(2, path='a"b')
+
+    assert 'requests_total{path="a\\"b"} 3' in registry.render()
+    with pytest.raises(ValueError):
+        requests.inc()
+
+def test_gauge_function_is_read_on_collect():
+    """Test that callback gauges report the current value"""
+    registry = Registry()
+    queue = [1, 2]
+    registry.gauge("queue_depth", "Queue depth").set_function(lambda: len(queue))
+    queue.append(3)
+
+    assert "queue_depth 3" in registry.render()
+
+def test_processes_are_combined(tmp_path):
+    """Test that the metrics files of other processes are merged into one exposition"""
+    registry = Registry(str(tmp_path))
+    requests = registry.counter("requests_total", "Requests")
+    documents = registry.gauge("documents", "Documents", mode="max")
+    memory = registry.gauge("memory_bytes", "Memory", mode="all")
+    requests.inc(2)
+    documents.set(10)
+    memory.set(100)
+
+    # A live process (the parent of this test) and one that has exited
+    other = registry.collect()
+    other["documents"]["samples"] = [[[], 12.0]]
+    (tmp_path / f"{os.getppid()}.json").write_text(json.dumps(other))
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                            capture_output=True, text=True).stdout.strip()
+    (tmp_path / f"{exited}.json").write_text(json.dumps(registry.collect()))
+
+    text = registry.render()
+
+    # Counters of exited processes keep counting, their gauges are dropped
+    assert "requests_total 6" in text
+    assert "documents 12" in text
+    assert f'memory_bytes{{pid="{os.getpid()}"}} 100' in text
+    assert f'memory_bytes{{pid="{os.getppid()}"}} 100' in text
+    assert f'pid="{exited}"' not in text
+    # The exited process' file is folded away, its counters still count
+    assert not (tmp_path / f"{exited}.json").exists()
+    assert "requests_total 6" in registry.render()
+
+    registry.flush()
+    assert (tmp_path / f"{os.getpid()}.json").exists()
+    registry.clear()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,101 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import query_cache
+from query_cache import QueryCache, VectorCache, content_hash, normalize_query, result_size
+
+def make_result(doc_id, content="content"):
+    """A query result holding a single document"""
+    return {"documents": [content], "metadata": [{"id": doc_id}], "ids": [doc_id], "distances": [0.5]}
+
+def test_normalize_query():
+    """Test that case and whitespace differences map to one key"""
+    assert normalize_query("  Artificial\tIntelligence \n") == normalize_query("artificial intelligence")
+
+def test_hit_returns_copy():
+    """Test that callers cannot modify a cached result"""
+    cache = QueryCache()
+    cache.put("q", 1, make_result("a"))
+    
+    result = cache.get("q", 1)
+    result["ids"].append("b")
+    
+    assert cache.get("q", 1)["ids"] == ["a"]
+    assert cache.get("other", 1) is None
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+
+def test_generation_change_invalidates():
+    """Test that results are never served for another generation"""
+    cache = QueryCache()
+    cache.put("q", 1, make_result("a"))
+    
+    assert cache.get("q", 2) is None
+    # A result computed before the change arrives late and is ignored
+    cache.put("q", 1, make_result("a"))
+    assert cache.get("q", 2) is None
+    assert cache.get_stats()["invalidations"] == 1
+
+def test_lru_eviction_by_entries_and_bytes():
+    """Test that the least recently used entries go first, by count and by size"""
+    cache = QueryCache(max_entries=2)
+    cache.put("a", 1, make_result("a"))
+    cache.put("b", 1, make_result("b"))
+    cache.get("a", 1)
+    cache.put("c", 1, make_result("c"))
+    
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) is not None
+    assert cache.get_stats()["evictions"] == 1
+    
+    size = result_size(make_result("a", "x" * 1000))
+    cache = QueryCache(max_bytes=2 * size + size // 2)
+    for key in "abc":
+        cache.put(key, 1, make_result(key, "x" * 1000))
+    assert [key for key in "abc" if cache.get(key, 1) is not None] == ["b", "c"]
+    assert cache.get_stats()["bytes"] <= cache.max_bytes
+    
+    # Results larger than the whole cache are not stored
+    cache.put("huge", 1, make_result("huge", "x" * 10000))
+    assert cache.get("huge", 1) is None
+
+def test_ttl_expiry(monkeypatch):
+    """Test that entries expire after the TTL"""
+    now = [100.0]
+    monkeypatch.setattr(query_cache.time, "monotonic", lambda: now[0])
+    cache = QueryCache(ttl=10)
+    cache.put("q", 1, make_result("a"))
+    
+    now[0] += 5
+    assert cache.get("q", 1) is not None
+    now[0] += 10
+    assert cache.get("q", 1) is None
+    assert cache.get_stats()["expirations"] == 1
+
+def test_disabled_cache():
+    """Test that max_entries=0 disables caching"""
+    cache = QueryCache(max_entries=0)
+    cache.put("q", 1, make_result("a"))
+    assert cache.get("q", 1) is None
+
+def test_vector_cache_is_content_addressed_and_bounded():
+    """Test that vectors are found by content hash and evicted by size"""
+    from scipy import sparse
+    vector = sparse.csr_matrix(([1.0, 2.0], [3, 7], [0, 2]), shape=(1, 10))
+    size = vector.data.nbytes + vector.indices.nbytes + vector.indptr.nbytes
+    cache = VectorCache(max_bytes=2 * size)
+    keys = [content_hash(text) for text in ("a", "b", "c")]
+    assert len(set(keys)) == 3
+    
+    cache.put_many([(keys[0], vector), (keys[1], vector)])
+    assert set(cache.get_many(keys[:2])) == set(keys[:2])
+    cache.put_many([(keys[2], vector)])
+    
+    assert set(cache.get_many(keys)) == set(keys[1:])
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["entries"]) == (4, 1, 1, 2)
+    assert stats["hit_rate"] == 0.8
+    assert VectorCache(max_bytes=0).get_many(keys) == {}
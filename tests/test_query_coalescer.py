@@ -0,0 +1,150 @@
+import sys
+import os
+import threading
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_coalescer import QueryCoalescer
+
+class FakeDatabase:
+    """Answers each query with its own text; can hold the first batch back until released"""
+    
+    def __init__(self, block=False):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+    
+    def query_batch(self, query_texts, n_results=5, collapse=False, nprobe=None, ef_search=None, where=None):
+        self.batches.append((list(query_texts), n_results))
+        self.started.set()
+        self.release.wait(5)
+        if "fail" in query_texts:
+            raise RuntimeError("index unavailable")
+        return [{"documents": [text], "metadata": [{}], "ids": [text], "distances": [float(n_results)]}
+                for text in query_texts]
+
+def run_in_threads(calls):
+    """Start each call in a thread; returns the threads and a dict their results or errors land in"""
+    results = {}
+    def run(name, call):
+        try:
+            results[name] = call()
+        except Exception as e:
+            results[name] = e
+    threads = [threading.Thread(target=run, args=item, daemon=True) for item in calls]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def wait_queued(coalescer, count):
+    """Wait until ``count`` queries are queued behind the running batch"""
+    for _ in range(500):
+        with coalescer._condition:
+            if sum(len(queue) for queue in coalescer._queues.values()) >= count:
+                return
+        threading.Event().wait(0.01)
+    raise AssertionError("queries were not queued")
+
+def test_lone_query_runs_at_once():
+    """Test that a query without concurrent company is not held back by the window"""
+    db = FakeDatabase()
+    coalescer = QueryCoalescer(window=60, max_batch=64)
+    
+    assert coalescer.query(db, "alpha")["ids"] == ["alpha"]
+    results = coalescer.search_documents(db, "beta", n_results=3)
+    
+    assert results["ids"] == [["beta"]] and results["distances"] == [[3.0]]
+    assert db.batches == [(["alpha"], 5), (["beta"], 3)]
+    assert coalescer.get_stats()["batches"] == 2
+
+def test_queries_queued_behind_a_batch_run_together():
+    """Test that queries arriving during a search share the next batch and get their own results"""
+    db = FakeDatabase(block=True)
+    coalescer = QueryCoalescer(window=0.05, max_batch=3)
+    first, results = run_in_threads([("first", lambda: coalescer.query(db, "first"))])
+    assert db.started.wait(5)
+    
+    names = ["q0", "q1", "q2", "q3"]
+    threads, queued = run_in_threads([(name, lambda name=name: coalescer.query(db, name)) for name in names])
+    wait_queued(coalescer, len(names))
+    db.release.set()
+    for thread in first + threads:
+        thread.join(5)
+    
+    assert results["first"]["ids"] == ["first"]
+    assert all(queued[name]["ids"] == [name] for name in names)
+    # The four queued queries fill one batch of three, then a batch of one
+    assert [len(texts) for texts, _ in db.batches] == [1, 3, 1]
+    assert sorted(text for texts, _ in db.batches[1:] for text in texts) == names
+    stats = coalescer.get_stats()
+    assert (stats["batches"], stats["queries"]) == (3, 5)
+    assert coalescer._queues == {}
+
+def test_different_options_are_not_mixed():
+    """Test that queries only share a batch with queries of the same options"""
+    db = FakeDatabase(block=True)
+    coalescer = QueryCoalescer(window=0.05)
+    first, _ = run_in_threads([("first", lambda: coalescer.query(db, "first"))])
+    assert db.started.wait(5)
+    
+    threads, results = run_in_threads([
+        ("five", lambda: coalescer.query(db, "five")),
+        ("ten", lambda: coalescer.query(db, "ten", n_results=10)),
+    ])
+    wait_queued(coalescer, 1)
+    db.release.set()
+    for thread in first + threads:
+        thread.join(5)
+    
+    assert results["five"]["distances"] == [5.0]
+    assert results["ten"]["distances"] == [10.0]
+    assert sorted(db.batches[1:]) == [(["five"], 5), (["ten"], 10)]
+
+def test_batch_error_reaches_every_query():
+    """Test that a failing batch fails each of its queries and the next batch still runs"""
+    db = FakeDatabase(block=True)
+    coalescer = QueryCoalescer(window=0.05)
+    first, results = run_in_threads([("first", lambda: coalescer.query(db, "fail"))])
+    assert db.started.wait(5)
+    
+    threads, later = run_in_threads([("later", lambda: coalescer.query(db, "later"))])
+    wait_queued(coalescer, 1)
+    db.release.set()
+    for thread in first + threads:
+        thread.join(5)
+    
+    assert isinstance(results["first"], RuntimeError)
+    assert later["later"]["ids"] == ["later"]
+    assert coalescer.search_documents(db, "fail") is None
+
+def test_error_after_the_search_wakes_every_query(monkeypatch):
+    """Test that a failure while handing out results still wakes the batch and hands the group on"""
+    import query_coalescer
+    
+    class FailingHistogram:
+        def observe(self, value):
+            raise RuntimeError("metrics unavailable")
+    monkeypatch.setattr(query_coalescer, "SEARCH_BATCH_SIZE", FailingHistogram())
+    db = FakeDatabase(block=True)
+    coalescer = QueryCoalescer(window=0.05)
+    first, results = run_in_threads([("first", lambda: coalescer.query(db, "first"))])
+    assert db.started.wait(5)
+    
+    threads, later = run_in_threads([("q0", lambda: coalescer.query(db, "q0")), ("q1", lambda: coalescer.query(db, "q1"))])
+    wait_queued(coalescer, 2)
+    db.release.set()
+    for thread in first + threads:
+        thread.join(5)
+    
+    assert not any(thread.is_alive() for thread in first + threads)
+    assert isinstance(results["first"], RuntimeError)
+    assert all(isinstance(later[name], RuntimeError) for name in ("q0", "q1"))
+    assert coalescer._queues == {}
+    # The group is free again, so a later query runs at once
+    monkeypatch.undo()
+    threads, after = run_in_threads([("next", lambda: coalescer.query(db, "next"))])
+    threads[0].join(5)
+    assert after["next"]["ids"] == ["next"]
@@ -0,0 +1,284 @@
+import pytest
+import sys
+import os
+import json
+import tempfile
+import shutil
+import threading
+from scipy import sparse
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segment_store import ContentList, MetadataList, ReadWriteLock, SegmentContents, SegmentStore
+
+@pytest.fixture
+def store():
+    """Create a segment store in a temporary directory without background merges"""
+    temp_dir = tempfile.mkdtemp()
+    yield SegmentStore(temp_dir, merge_in_background=False)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+def append_documents(store, names):
+    """Append one segment with a document per name and a one-hot vector per document"""
+    vectors = sparse.csr_matrix(sparse.identity(len(names), format="csr"))
+    store.append(names, [f"content of {name}" for name in names], [{"name": name} for name in names], vectors)
+
+def replay(store):
+    """Replay a store into the list of ids of its live rows"""
+    ids = []
+    for segment_ids, documents, metadata, vectors, deleted in store.load():
+        assert len(segment_ids) == len(documents) == len(metadata) == vectors.shape[0]
+        ids.extend(doc_id for line, doc_id in enumerate(segment_ids) if line not in deleted)
+    return ids
+
+def compact(store):
+    """Run a full compaction"""
+    plan = store.plan_compaction()
+    store.write_compaction(plan)
+    store.commit_compaction(plan)
+
+def test_append_and_replay(store):
+    """Test that appended segments are replayed in order after reopening"""
+    append_documents(store, ["a", "b"])
+    append_documents(store, ["c"])
+    
+    reopened = SegmentStore(store.directory, merge_in_background=False)
+    assert reopened.segment_count == 2
+    assert replay(reopened) == ["a", "b", "c"]
+
+def test_append_only_writes_new_segment(store):
+    """Test that an append leaves existing segment files untouched"""
+    append_documents(store, ["a", "b", "c", "d"])
+    first = store.manifest["segments"][0]["name"]
+    first_mtime = os.stat(os.path.join(store.directory, f"{first}.ids")).st_mtime_ns
+    
+    append_documents(store, ["e"])
+    
+    assert os.stat(os.path.join(store.directory, f"{first}.ids")).st_mtime_ns == first_mtime
+    assert store.segment_count == 2
+
+def test_bodies_are_memory_mapped(store):
+    """Test that bodies live in the content file and are read lazily by row"""
+    bodies = ["plain", "", "ünïcödé \U0001F600", "lone \ud800 surrogate"]
+    store.append(["a", "b", "c", "d"], bodies, [{}] * 4)
+    store.append(["e"], ["last"], [{}])
+    name = store.manifest["segments"][0]["name"]
+    
+    assert not os.path.exists(os.path.join(store.directory, f"{name}.jsonl"))
+    contents, metadata = SegmentStore(store.directory, merge_in_background=False).columns()
+    assert isinstance(contents, ContentList)
+    assert all(isinstance(part, SegmentContents) for part in contents._parts)
+    assert list(contents) == bodies + ["last"]
+    assert contents[-1] == "last"
+    assert list(contents[2:5]) == bodies[2:] + ["last"]
+    assert list(contents.take([0, 1, 4])) == ["plain", "", "last"]
+    assert list(store.columns(rows=2)[0]) == bodies[:2]
+    assert isinstance(metadata._parts[0], MetadataList)
+    assert list(metadata) == [{}] * 5
+
+def test_json_lines_of_older_segments(store):
+    """Test that segments with rows as JSON lines are still read, and rewritten by a merge"""
+    store.append(["a", "b"], ["a", "b"], [{}, {}])
+    store.append(["c"], ["content of c"], [{}])
+    name = store.manifest["segments"][0]["name"]
+    with open(os.path.join(store.directory, f"{name}.jsonl"), "w") as f:
+        for doc_id in ["a", "b"]:
+            f.write(json.dumps({"id": doc_id, "metadata": {"name": doc_id}, "content": f"inline {doc_id}"}) + "\n")
+    for extension in ("ids", "meta", "bin"):
+        os.remove(os.path.join(store.directory, f"{name}.{extension}"))
+    
+    reopened = SegmentStore(store.directory, merge_in_background=False)
+    contents, metadata = reopened.columns()
+    assert list(contents) == ["inline a", "inline b", "content of c"]
+    assert list(metadata) == [{"name": "a"}, {"name": "b"}, {}]
+    
+    assert reopened.merge_segments() == 1
+    merged = reopened.manifest["segments"][0]["name"]
+    assert os.path.exists(os.path.join(store.directory, f"{merged}.meta"))
+    assert not os.path.exists(os.path.join(store.directory, f"{merged}.jsonl"))
+    assert list(SegmentStore(store.directory, merge_in_background=False).columns()[0]) == \
+        ["inline a", "inline b", "content of c"]
+
+def test_delete_is_replayed(store):
+    """Test that deleted rows are logged and skipped when replaying"""
+    append_documents(store, ["a", "b"])
+    append_documents(store, ["c", "d"])
+    
+    store.delete(2)  # "c"
+    store.delete(0)  # "a"
+    store.delete(0)  # deleting twice is a no-op
+    
+    reopened = SegmentStore(store.directory, merge_in_background=False)
+    assert replay(reopened) == ["b", "d"]
+    assert reopened.row_count == 4
+    assert reopened.deleted_count == 2
+
+def test_delete_appends_to_log(store):
+    """Test that once the tombstone log exists deletes do not rewrite the manifest"""
+    append_documents(store, ["a", "b", "c"])
+    store.delete(0)
+    manifest_mtime = os.stat(store.manifest_path).st_mtime_ns
+    
+    store.delete(1)
+    store.delete(2)
+    
+    assert os.stat(store.manifest_path).st_mtime_ns == manifest_mtime
+    with open(os.path.join(store.directory, f"{store.manifest['tombstones']}.log")) as f:
+        assert len(f.readlines()) == 3
+
+def test_merge_keeps_row_positions(store):
+    """Test that merging combines segments without renumbering rows"""
+    for name in ["a", "b", "c", "d", "e"]:
+        append_documents(store, [name])
+    store.delete(1)
+    
+    assert store.merge_segments() > 0
+    
+    assert store.segment_count < 5
+    assert store.row_count == 5
+    assert replay(SegmentStore(store.directory, merge_in_background=False)) == ["a", "c", "d", "e"]
+    store.delete(3)
+    assert replay(store) == ["a", "c", "e"]
+    assert sorted(os.listdir(store.directory)) == sorted(
+        [SegmentStore.MANIFEST_FILE, SegmentStore.GENERATION_FILE, "store.lock", "maintenance.lock",
+         f"{store.manifest['tombstones']}.log"]
+        + [f"{entry['name']}.{ext}" for entry in store.manifest["segments"] for ext in ("ids", "meta", "bin", "npz")]
+    )
+
+def test_compaction_drops_deleted_rows(store):
+    """Test that compaction rewrites only segments with deletes and renumbers rows"""
+    append_documents(store, ["a", "b"])
+    append_documents(store, ["c"])
+    append_documents(store, ["d", "e"])
+    untouched = store.manifest["segments"][1]["name"]
+    store.delete(0)
+    store.delete(3)
+    store.delete(4)
+    
+    compact(store)
+    
+    assert store.row_count == 2
+    assert store.deleted_count == 0
+    assert [entry["name"] for entry in store.manifest["segments"]][1] == untouched
+    assert store.segment_count == 2  # the fully deleted segment is gone
+    assert replay(SegmentStore(store.directory, merge_in_background=False)) == ["b", "c"]
+
+def test_delete_during_compaction_is_carried_over(store):
+    """Test that a row deleted while a compaction is running stays deleted"""
+    append_documents(store, ["a", "b", "c"])
+    store.delete(0)
+    
+    plan = store.plan_compaction()
+    store.write_compaction(plan)
+    store.delete(2)  # "c", after the compaction planned its work
+    store.commit_compaction(plan)
+    
+    assert store.row_count == 2
+    assert replay(store) == ["b"]
+    assert replay(SegmentStore(store.directory, merge_in_background=False)) == ["b"]
+    assert store.plan_compaction()["deleted"] == {store.manifest["segments"][0]["name"]: [1]}
+
+def test_orphaned_segments_are_removed(store):
+    """Test that files left by an interrupted merge are cleaned up on open"""
+    append_documents(store, ["a"])
+    append_documents(store, ["b"])
+    orphan = os.path.join(store.directory, "seg-000001.ids")
+    in_flight = os.path.join(store.directory, f"seg-{store.manifest['next_segment']:06d}.ids")
+    store.manifest["segments"].pop(0)  # as if a merge had replaced it
+    with store._lock:
+        store._write_manifest()
+    with open(in_flight, "w") as f:
+        f.write("{}\n")
+    
+    SegmentStore(store.directory, merge_in_background=False)
+    
+    assert not os.path.exists(orphan)
+    assert os.path.exists(in_flight)
+
+def test_group_commit(tmp_path, monkeypatch):
+    """Test that group mode fsyncs once per commit_writes writes, and reopening drops an incomplete uncommitted segment"""
+    store = SegmentStore(str(tmp_path), merge_in_background=False, durability="group", commit_writes=3, commit_interval=0)
+    fsyncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: fsyncs.append(fd) or fsync(fd))
+    append_documents(store, ["a"])
+    append_documents(store, ["b"])
+    assert not fsyncs and store.uncommitted_writes == 2
+    store.delete(0)
+    assert fsyncs and store.uncommitted_writes == 0
+    assert store.manifest["synced"] == store.manifest["next_segment"]
+    
+    append_documents(store, ["c"])
+    append_documents(store, ["d"])
+    last = store.manifest["segments"][-1]["name"]
+    with open(os.path.join(store.directory, f"{last}.bin"), "r+b") as f:
+        f.truncate(4)  # as if the machine went down before the page cache was written back
+    
+    reopened = SegmentStore(store.directory, merge_in_background=False)
+    assert replay(reopened) == ["b", "c"]
+    assert reopened.manifest["synced"] == reopened.manifest["next_segment"]
+
+def test_damaged_manifest_reverts_to_checkpoint(tmp_path):
+    """Test that a manifest lost in a crash is replaced by the last commit's checkpoint"""
+    store = SegmentStore(str(tmp_path), merge_in_background=False, durability="shutdown")
+    append_documents(store, ["a", "b"])
+    store.commit()
+    append_documents(store, ["c"])
+    with open(store.manifest_path, "w") as f:
+        f.write("")
+    
+    assert replay(SegmentStore(store.directory, merge_in_background=False)) == ["a", "b"]
+    with pytest.raises(ValueError):
+        SegmentStore(store.directory, durability="sometimes")
+
+def test_index_snapshot_checksum(store):
+    """Test that a snapshot is published with a checksum that detects a damaged file"""
+    append_documents(store, ["a"])
+    def write(path):
+        with open(path, "wb") as f:
+            f.write(b"index bytes")
+    assert store.write_index_snapshot(1, store.epoch, write)
+    snapshot = store.index_snapshot
+    assert store.verify_snapshot(snapshot)
+    
+    with open(store.snapshot_path(snapshot), "wb") as f:
+        f.write(b"index bytez")
+    assert not SegmentStore(store.directory, merge_in_background=False).verify_snapshot(snapshot)
+
+def test_read_write_lock():
+    """Test that readers share the lock, a waiting writer holds back new readers, and both sides are reentrant"""
+    lock = ReadWriteLock()
+    events = []
+    reading, done = threading.Event(), threading.Event()
+    
+    def read(name, hold=None):
+        with lock.read(), lock.read():
+            events.append(name)
+            if hold:
+                hold.set()
+                done.wait(5)
+    def write():
+        with lock.write(), lock.write(), lock.read():
+            events.append("write")
+    
+    reader = threading.Thread(target=read, args=("read", reading))
+    reader.start()
+    assert reading.wait(5)
+    with lock.read():
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+    
+    writer = threading.Thread(target=write)
+    writer.start()
+    writer.join(timeout=0.2)
+    assert writer.is_alive()
+    late_reader = threading.Thread(target=read, args=("late read",))
+    late_reader.start()
+    late_reader.join(timeout=0.2)
+    assert late_reader.is_alive()  # queued behind the writer
+    
+    done.set()
+    for thread in (reader, writer, late_reader):
+        thread.join(timeout=5)
+    assert events == ["read", "write", "late read"]
@@ -0,0 +1,153 @@
+import io
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app import app
+from sharded_collection import CollectionRegistry, ShardedCollection
+
+def topic_documents(n):
+    return [f"Document {i} is about topic{i} and subject{i % 7}" for i in range(n)]
+
+@pytest.fixture
+def collection(tmp_path):
+    collection = ShardedCollection("notes", str(tmp_path / "notes"), shards=3)
+    yield collection
+    collection.close()
+
+def test_documents_are_spread_over_shards(collection):
+    """Test that documents land on their shards and are found by fan-out search"""
+    collection.add_documents(topic_documents(60), ids=[f"doc{i}" for i in range(60)])
+
+    counts = [shard.get_document_count() for shard in collection.shards]
+    assert sum(counts) == collection.get_document_count() == 60
+    assert all(counts)
+    assert collection.get_document("doc42")["content"] == topic_documents(60)[42]
+    assert collection.query("topic42", n_results=1)["ids"] == ["doc42"]
+
+    results = collection.query("subject3", n_results=8)
+    assert len(results["ids"]) == 8
+    assert results["distances"] == sorted(results["distances"])
+    assert all(int(doc_id[3:]) % 7 == 3 for doc_id in results["ids"])
+
+    with pytest.raises(ValueError):
+        collection.add_documents(["again"], ids=["doc42"])
+    assert collection.delete_document("doc42")
+    assert collection.query("topic42", n_results=1)["ids"] != ["doc42"]
+
+def test_passages_stay_with_their_parent(collection):
+    """Test that passages share a shard, so a collapsed search reports their parent once"""
+    ids = [f"file_a.txt_1#{i}" for i in range(6)]
+    metadata = [{"parent_id": "file_a.txt_1", "passage_index": i} for i in range(6)]
+    collection.add_documents([f"passage {i} about compilers" for i in range(6)], metadata, ids)
+    collection.add_document("other", "gardening and compilers", {})
+
+    assert len({id(collection.shard_for(doc_id)) for doc_id in ids}) == 1
+    results = collection.query("compilers", n_results=5, collapse=True)
+    assert results["ids"].count("file_a.txt_1") == 1
+
+def test_writes_touch_one_shard(collection):
+    """Test that adding to a shard leaves the stores of the other shards alone"""
+    collection.add_documents(topic_documents(30), ids=[f"doc{i}" for i in range(30)])
+    generations = [shard.store.refresh() for shard in collection.shards]
+
+    collection.add_document("late", "A late document", {})
+
+    changed = [shard.store.refresh() != generation for shard, generation in zip(collection.shards, generations)]
+    assert changed.count(True) == 1
+    assert changed.index(True) == collection.shards.index(collection.shard_for("late"))
+
+def test_ids_cannot_be_taken_during_a_batch(collection, monkeypatch):
+    """Test that another writer cannot take an ID between the check of a batch and its write"""
+    import threading
+    ids = [f"doc{i}" for i in range(12)]
+    first = min(collection.shards.index(collection.shard_for(doc_id)) for doc_id in ids)
+    shard = collection.shards[first]
+    taken = next(doc_id for doc_id in ids if collection.shard_for(doc_id) is shard)
+    check = shard._check_new_ids
+    racer = threading.Thread(target=lambda: racer.result.append(shard.add_document(taken, "racing writer", {})))
+    racer.result = []
+
+    def check_then_race(shard_ids):
+        check(shard_ids)
+        if racer.ident is None:
+            racer.start()
+            racer.join(0.2)
+    monkeypatch.setattr(shard, "_check_new_ids", check_then_race)
+    collection.add_documents(topic_documents(12), ids=ids)
+    racer.join(5)
+
+    assert racer.result == [False]
+    assert collection.get_document_count() == 12
+    assert collection.get_document(taken)["content"] == topic_documents(12)[ids.index(taken)]
+
+def test_shard_count_is_recorded(tmp_path):
+    """Test that reopening a collection keeps the shard count it was created with"""
+    first = ShardedCollection("notes", str(tmp_path / "notes"), shards=2)
+    first.add_documents(topic_documents(10), ids=[f"doc{i}" for i in range(10)])
+    first.close()
+
+    reopened = ShardedCollection("notes", str(tmp_path / "notes"), shards=5)
+    assert reopened.shard_count == 2
+    assert reopened.get_document_count() == 10
+    reopened.close()
+    with pytest.raises(ValueError):
+        ShardedCollection("../escape", str(tmp_path / "escape"))
+
+def test_listing_walks_every_shard(collection):
+    """Test that following the cursors lists every document once"""
+    collection.add_documents(topic_documents(25), ids=[f"doc{i}" for i in range(25)])
+
+    listed, cursor = [], None
+    while True:
+        page, cursor = collection.list_documents_page(limit=4, after=cursor, fields=["id"])
+        listed.extend(document["id"] for document in page)
+        if cursor is None:
+            break
+    assert sorted(listed) == sorted(f"doc{i}" for i in range(25))
+
+def test_collection_endpoints(tmp_path, monkeypatch):
+    """Test that search, documents and info routes take a collection"""
+    registry = CollectionRegistry(str(tmp_path / "collections"), shards=2)
+    monkeypatch.setattr("app.collection_registry", registry)
+    registry.get("team-a", create=True).add_documents(topic_documents(10), ids=[f"doc{i}" for i in range(10)])
+    app.config['TESTING'] = True
+    client = app.test_client()
+
+    response = client.post("/search", json={"query": "topic4", "n_results": 1, "collection": "team-a"})
+    assert response.status_code == 200
+    assert response.get_json()["results"][0]["id"] == "doc4"
+    assert client.get("/documents/doc4?collection=team-a").get_json()["id"] == "doc4"
+    info = client.get("/db-info?collection=team-a").get_json()
+    assert (info["count"], info["shard_count"]) == (10, 2)
+    assert client.get("/collections").get_json() == {"collections": ["team-a"]}
+
+    response = client.post("/search", json={"query": "topic4", "collection": "no/such"})
+    assert response.status_code == 400
+
+def test_missing_collections_are_not_created(tmp_path, monkeypatch):
+    """Test that only uploads create collections and other routes answer 404 for a missing one"""
+    registry = CollectionRegistry(str(tmp_path / "collections"), shards=2)
+    monkeypatch.setattr("app.collection_registry", registry)
+    app.config['TESTING'] = True
+    client = app.test_client()
+
+    assert client.post("/search", json={"query": "topic4", "collection": "typo"}).status_code == 404
+    assert client.get("/documents/doc4?collection=typo").status_code == 404
+    assert client.delete("/documents/doc4?collection=typo").status_code == 404
+    assert client.get("/db-info?collection=typo").status_code == 404
+    assert registry.get("typo") is None
+    assert not (tmp_path / "collections" / "typo").exists()
+
+    # Rejected uploads do not create their collection either
+    names = registry.names()
+    assert client.post("/upload", content_type="multipart/form-data", data={"collection": "typo"}).status_code == 400
+    data = {"collection": "typo", "file": (io.BytesIO(b"notes"), "")}
+    assert client.post("/upload", content_type="multipart/form-data", data=data).status_code == 400
+    assert registry.names() == names
+
+    created = registry.get("team-b", create=True)
+    assert registry.get("team-b") is created and created.ready
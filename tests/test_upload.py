@@ -24,3 +24,257 @@ def test_upload_success(client):
 def test_upload_missing_file(client):
     response = client.post("/upload", content_type="multipart/form-data", data={})
     assert response.status_code == 400
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    """Replace the shared ingestion pipeline with one writing to a temporary database"""
+    import upload_worker
+    from upload_worker import IngestionPipeline
+    from vector_db import VectorDatabase
+    
+    test_pipeline = IngestionPipeline(
+        VectorDatabase(persist_directory=str(tmp_path / "db")),
+        max_queue_size=1, workers=1, batch_size=8, flush_interval=0.05
+    )
+    monkeypatch.setattr(upload_worker, "pipeline", test_pipeline)
+    monkeypatch.setattr("app.pipeline", test_pipeline)
+    yield test_pipeline
+    test_pipeline.stop()
+
+def test_upload_queue_full(client, pipeline, monkeypatch):
+    import threading
+    import upload_worker
+    
+    release = threading.Event()
+    build_document = upload_worker.build_document
+    
+    def blocked_build_document(path):
+        release.wait(5)
+        return build_document(path)
+    monkeypatch.setattr(upload_worker, "build_document", blocked_build_document)
+    
+    def upload(name):
+        data = {"file": (io.BytesIO(f"queued data of {name}".encode()), name)}
+        return client.post("/upload", content_type="multipart/form-data", data=data)
+    
+    assert upload("first.txt").status_code == 202  # taken by the worker
+    for _ in range(20):  # wait for the worker to pick it up
+        if pipeline.files.empty():
+            break
+        threading.Event().wait(0.01)
+    assert upload("second.txt").status_code == 202  # waits in the queue
+    
+    response = upload("third.txt")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.get_json()["retry_after"] >= 1
+    
+    release.set()
+    assert pipeline.wait_until_idle(timeout=5)
+    assert pipeline.db.get_document_count() == 2
+    assert pipeline.get_stats()["rejected"] == 1
+
+def test_same_name_uploads_are_saved_apart(client, pipeline, monkeypatch):
+    """Test that a queued upload keeps its content when another of the same name arrives, and is deleted once read"""
+    import threading
+    import upload_worker
+    
+    release = threading.Event()
+    saved = []
+    build_document = upload_worker.build_document
+    
+    def blocked_build_document(path):
+        saved.append(path)
+        release.wait(5)
+        return build_document(path)
+    monkeypatch.setattr(upload_worker, "build_document", blocked_build_document)
+    
+    for content in (b"first draft of the notes", b"second draft of the notes"):
+        data = {"file": (io.BytesIO(content), "notes.txt")}
+        assert client.post("/upload", content_type="multipart/form-data", data=data).status_code == 202
+    release.set()
+    assert pipeline.wait_until_idle(timeout=5)
+    
+    documents = pipeline.db.list_documents()
+    assert sorted(document["content"] for document in documents) == ["first draft of the notes", "second draft of the notes"]
+    assert {document["metadata"]["filename"] for document in documents} == {"notes.txt"}
+    assert len(set(saved)) == 2
+    assert not any(os.path.exists(os.path.dirname(path)) for path in saved)
+
+def test_ingestion_batches_files(pipeline, tmp_path):
+    import queue
+    pipeline.files = queue.Queue(maxsize=10)
+    for i in range(6):
+        path = tmp_path / f"file{i}.txt"
+        path.write_text(f"document number {i}")
+        assert pipeline.submit(str(path))
+    
+    assert pipeline.wait_until_idle(timeout=5)
+    stats = pipeline.get_stats()
+    assert stats["processed"] == 6
+    assert stats["batches"] < 6
+    assert stats["queue_depth"] == 0
+    assert pipeline.db.get_document_count() == 6
+
+def test_duplicate_uploads_are_skipped(pipeline, tmp_path):
+    import queue
+    pipeline.files = queue.Queue(maxsize=10)
+    first = tmp_path / "report.txt"
+    first.write_text("quarterly report about compilers")
+    retry = tmp_path / "report_retry.txt"
+    retry.write_text("quarterly report about compilers")
+    
+    assert pipeline.submit(str(first))
+    assert pipeline.wait_until_idle(timeout=5)
+    assert pipeline.submit(str(retry))
+    assert pipeline.wait_until_idle(timeout=5)
+    
+    stats = pipeline.get_stats()
+    assert (stats["files_read"], stats["files_duplicate"]) == (1, 1)
+    assert stats["duplicate_file_rate"] == 0.5
+    assert pipeline.db.get_document_count() == 1
+    document = pipeline.db.list_documents()[0]
+    assert document["metadata"]["content_hash"] and document["metadata"]["file_hash"]
+    assert stats["recent_duplicates"] == [{"filename": "report_retry.txt", "stored_as": document["id"]}]
+
+def test_drop_duplicates(tmp_path):
+    from upload_worker import drop_duplicates
+    from query_cache import content_hash
+    from vector_db import VectorDatabase
+    
+    db = VectorDatabase(persist_directory=str(tmp_path / "db"))
+    db.add_document("stored", "a passage seen before", {"content_hash": content_hash("a passage seen before")})
+    batch = [(f"new{i}", text, {"content_hash": content_hash(text)})
+             for i, text in enumerate(["a passage seen before", "a new passage", "a new passage"])]
+    
+    unique, duplicates = drop_duplicates(db, batch)
+    assert [doc_id for doc_id, _, _ in unique] == ["new1"]
+    assert duplicates == {"new0": "stored", "new2": "new1"}
+    
+    # Passages are kept even when their content is stored already
+    passage = ("file#1", "a passage seen before", {"content_hash": content_hash("a passage seen before"), "parent_id": "file"})
+    assert drop_duplicates(db, [passage]) == ([passage], {})
+    
+    db.delete_document("stored")
+    unique, _ = drop_duplicates(db, batch)
+    assert [doc_id for doc_id, _, _ in unique] == ["new0", "new1"]
+
+def test_same_name_uploads_get_their_own_ids(pipeline, tmp_path):
+    """Test that files of the same name uploaded within a second are all stored"""
+    for content in ("first version", "second version"):
+        path = tmp_path / "notes.txt"
+        path.write_text(content)
+        pipeline.submit(str(path))
+        assert pipeline.wait_until_idle(timeout=5)
+    
+    assert pipeline.db.get_document_count() == 2
+    assert pipeline.get_stats()["failed"] == 0
+
+def test_taken_ids_do_not_fail_the_batch(pipeline):
+    """Test that a document whose ID is stored already is the only one of its batch rejected"""
+    pipeline.db.add_document("taken", "stored first", {})
+    pipeline._store(pipeline.db, [
+        ("taken", "written again", {}),
+        ("new", "another file", {}),
+        ("new", "the same ID twice", {}),
+    ])
+    
+    assert pipeline.db.get_document("taken")["content"] == "stored first"
+    assert pipeline.db.get_document("new")["content"] == "another file"
+    stats = pipeline.get_stats()
+    assert (stats["processed"], stats["failed"]) == (1, 2)
+
+def test_ingestion_stats_endpoint(client):
+    response = client.get("/ingestion/stats")
+    assert response.status_code == 200
+    assert "queue_depth" in response.get_json()
+
+def test_search_stats_endpoint(client):
+    response = client.get("/search/stats")
+    assert response.status_code == 200
+    assert "mean_batch_size" in response.get_json()
+
+def test_iter_passages_offsets_and_overlap(tmp_path):
+    from upload_worker import iter_passages
+    text = "".join(f"Sentence number {i} is here. " for i in range(200))
+    path = tmp_path / "large.txt"
+    path.write_text(text)
+    
+    passages = list(iter_passages(str(path), passage_size=300, overlap=50, split="sentence", read_size=128))
+    assert len(passages) > 1
+    assert passages[0][0] == 0
+    assert passages[-1][1] == len(text)
+    for start, end, passage in passages:
+        assert text[start:end] == passage
+        assert len(passage) <= 300
+        assert passage.rstrip().endswith(".")
+    for (_, previous_end, _), (start, _, _) in zip(passages, passages[1:]):
+        # Consecutive passages overlap and together cover the whole file
+        assert start < previous_end
+        assert previous_end - start <= 50
+
+def test_large_file_ingested_as_passages(tmp_path):
+    from upload_worker import IngestionPipeline
+    from vector_db import VectorDatabase
+    
+    db = VectorDatabase(persist_directory=str(tmp_path / "db"))
+    pipeline = IngestionPipeline(db, workers=1, batch_size=4, flush_interval=0.05,
+                                 passage_size=200, passage_overlap=20)
+    paragraphs = [f"Paragraph {i} talks about topic{i} in some detail." for i in range(30)]
+    large = tmp_path / "large.txt"
+    large.write_text("\n\n".join(paragraphs))
+    small = tmp_path / "small.txt"
+    small.write_text("a short file about topic7")
+    try:
+        assert pipeline.submit(str(large))
+        assert pipeline.submit(str(small))
+        assert pipeline.wait_until_idle(timeout=5)
+    finally:
+        pipeline.stop()
+    
+    stats = pipeline.get_stats()
+    assert stats["files_read"] == 2
+    passages = [doc for doc in db.list_documents() if "parent_id" in doc["metadata"]]
+    assert len(passages) > 1
+    assert stats["processed"] == len(passages) + 1
+    text = large.read_text()
+    for doc in passages:
+        meta = doc["metadata"]
+        assert doc["id"] == f"{meta['parent_id']}#{meta['passage_index']}"
+        assert text[meta["start_offset"]:meta["end_offset"]] == doc["content"]
+    
+    # Several passages of the large file match, but collapsing reports it once
+    parent_id = passages[0]["metadata"]["parent_id"]
+    results = db.query("topic7 paragraph", n_results=5)
+    assert sum(doc_id.startswith(parent_id + "#") for doc_id in results["ids"]) > 1
+    collapsed = db.query("topic7 paragraph", n_results=5, collapse=True)
+    assert collapsed["ids"].count(parent_id) == 1
+    assert len(collapsed["ids"]) == 2
+    meta = collapsed["metadata"][collapsed["ids"].index(parent_id)]
+    assert meta["passage_id"].startswith(parent_id + "#")
+    assert meta["matched_passages"] >= 1
+
+def test_files_sharing_passages_are_stored_whole(tmp_path):
+    from upload_worker import IngestionPipeline, iter_passages
+    from vector_db import VectorDatabase
+    
+    db = VectorDatabase(persist_directory=str(tmp_path / "db"))
+    pipeline = IngestionPipeline(db, workers=1, batch_size=4, flush_interval=0.05,
+                                 passage_size=200, passage_overlap=20)
+    paragraphs = [f"Paragraph {i} talks about topic{i} in some detail." for i in range(30)]
+    first = tmp_path / "first.txt"
+    first.write_text("\n\n".join(paragraphs))
+    # Same opening as the first file, so its first passages are identical
+    second = tmp_path / "second.txt"
+    second.write_text("\n\n".join(paragraphs[:15] + [f"Another ending {i}." for i in range(15)]))
+    try:
+        for path in (first, second):
+            assert pipeline.submit(str(path))
+            assert pipeline.wait_until_idle(timeout=5)
+    finally:
+        pipeline.stop()
+    
+    for path in (first, second):
+        stored = [doc for doc in db.list_documents() if doc["metadata"]["filename"] == path.name]
+        assert len(stored) == len(list(iter_passages(str(path), 200, 20)))
+    assert pipeline.get_stats()["duplicates"] == 0
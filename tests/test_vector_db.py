@@ -5,16 +5,20 @@ import os
 import json
 import tempfile
 import shutil
+import threading
+import time
 
 # Add the parent directory to the path so we can import the app module
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app
+from segment_store import SegmentContents
 from vector_db import VectorDatabase
 
 @pytest.fixture
-def client():
-    """Create a test client for the Flask application"""
+def client(temp_db, monkeypatch):
+    """Create a test client for the Flask application backed by the temporary database"""
+    monkeypatch.setattr("app.vector_db", temp_db)
     app.config['TESTING'] = True
     with app.test_client() as client:
         yield client
@@ -25,7 +29,9 @@ def temp_db():
     temp_dir = tempfile.mkdtemp()
     test_db = VectorDatabase(persist_directory=temp_dir)
     yield test_db
-    # Clean up
+    # Clean up once background merges and compactions are done
+    test_db.wait_for_compaction()
+    test_db.store.wait_for_merges()
     shutil.rmtree(temp_dir, ignore_errors=True)
 
 @pytest.fixture
@@ -58,6 +64,74 @@ def test_search_no_results(temp_db):
     # Should return empty results
     assert len(results["ids"]) == 0 or len(results["ids"][0]) == 0
 
+def test_query_batch_matches_single_queries(temp_db):
+    """Test that a batch of queries returns what each query returns on its own"""
+    temp_db.add_documents(
+        ["Cats are small furry pets", "Rockets fly to the moon", "Python is a programming language"],
+        [{"n": 0}, {"n": 1}, {"n": 2}],
+        ["cats", "rockets", "python"],
+    )
+    queries = ["furry cats", "moon rockets", "zzz unrelated", "programming in python"]
+    
+    batch = temp_db.query_batch(queries, n_results=2)
+    
+    assert len(batch) == len(queries)
+    for query, results in zip(queries, batch):
+        assert results == temp_db.query(query, n_results=2)
+    assert batch[0]["ids"][0] == "cats"
+    assert batch[2]["ids"] == []
+    
+    nested = temp_db.search_batch(queries, n_results=2)
+    assert nested["ids"][1][0] == "rockets"
+    assert len(nested["ids"]) == len(queries)
+
+def test_query_cache_invalidated_by_changes(temp_db, sample_document, monkeypatch):
+    """Test that repeated queries are cached until a document is added or deleted"""
+    doc_id, content, metadata = sample_document
+    first = temp_db.query("Artificial  Intelligence", n_results=3)
+    
+    searches = []
+    search = temp_db._search
+    monkeypatch.setattr(temp_db, "_search", lambda *args: searches.append(args) or search(*args))
+    assert temp_db.query("artificial intelligence", n_results=3) == first
+    assert searches == []
+    assert temp_db.get_stats()["query_cache"]["hits"] == 1
+    
+    temp_db.add_document("ai_2", "More about artificial intelligence", {})
+    assert "ai_2" in temp_db.query("artificial intelligence", n_results=3)["ids"]
+    temp_db.delete_document("ai_2")
+    assert "ai_2" not in temp_db.query("artificial intelligence", n_results=3)["ids"]
+    assert len(searches) == 2
+
+@pytest.mark.parametrize("backend", ["faiss", "sparse"])
+def test_query_with_metadata_filter(temp_db, backend):
+    """Test that filters restrict the search instead of thinning out its results"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, backend=backend)
+    # The filtered-for documents rank below twenty better matches
+    db.add_documents(["machine learning models " * 3] * 20 + ["machine learning notes"] * 3,
+                     [{"filename": "other.txt", "file_size": 10}] * 20 +
+                     [{"filename": f"notes{i}.txt", "file_size": 100 * i} for i in range(3)],
+                     [f"other{i}" for i in range(20)] + [f"notes{i}" for i in range(3)])
+    
+    def ids(where, n_results=3):
+        return sorted(db.query("machine learning", n_results, where=where)["ids"])
+    
+    assert ids({"filename": "notes1.txt"}) == ["notes1"]
+    assert ids({"filename": {"$in": ["notes0.txt", "notes2.txt", "missing.txt"]}}) == ["notes0", "notes2"]
+    assert ids({"file_size": {"$gte": 100, "$lt": 1000}}) == ["notes1", "notes2"]
+    assert ids({"file_size": {"$gt": 10}, "filename": "notes2.txt"}) == ["notes2"]
+    assert ids({"filename": "missing.txt"}) == []
+    
+    # Deleted and newly added rows are accounted for
+    db.delete_document("notes1")
+    db.add_document("notes3", "machine learning notes", {"filename": "notes3.txt", "file_size": 300})
+    assert ids({"file_size": {"$gte": 100}}, n_results=5) == ["notes2", "notes3"]
+    db.compact()
+    assert ids({"file_size": {"$gte": 100}}, n_results=5) == ["notes2", "notes3"]
+    
+    with pytest.raises(ValueError):
+        db.query("machine learning", where={"file_size": {"$near": 1}})
+
 def test_list_documents(temp_db, sample_document):
     """Test listing all documents"""
     doc_id, content, metadata = sample_document
@@ -67,6 +141,36 @@ def test_list_documents(temp_db, sample_document):
     assert len(documents) > 0
     assert any(doc["id"] == doc_id for doc in documents)
 
+def test_list_documents_page(temp_db):
+    """Test paging through documents with a cursor and a field projection"""
+    temp_db.add_documents([f"document {i}" for i in range(5)], [{"n": i} for i in range(5)],
+                          [f"doc{i}" for i in range(5)])
+    temp_db.delete_document("doc1")
+    
+    page, cursor = temp_db.list_documents_page(limit=2, fields=["metadata", "id"])
+    assert list(page) == [{"id": "doc0", "metadata": {"n": 0}}, {"id": "doc2", "metadata": {"n": 2}}]
+    page, cursor = temp_db.list_documents_page(limit=2, after=cursor)
+    assert [doc["id"] for doc in page] == ["doc3", "doc4"]
+    assert cursor is None
+    
+    with pytest.raises(ValueError):
+        temp_db.list_documents_page(fields=["embedding"])
+    with pytest.raises(ValueError):
+        temp_db.list_documents_page(after="not a cursor")
+
+def test_list_documents_cursor_survives_compaction(temp_db):
+    """Test that a cursor resumes after its document once the rows were renumbered"""
+    temp_db.add_documents([f"document {i}" for i in range(6)], [{}] * 6, [f"doc{i}" for i in range(6)])
+    page, cursor = temp_db.list_documents_page(limit=3, fields=["id"])
+    assert [doc["id"] for doc in page] == ["doc0", "doc1", "doc2"]
+    
+    temp_db.delete_document("doc0")
+    temp_db.delete_document("doc1")
+    temp_db.compact()
+    
+    page, cursor = temp_db.list_documents_page(limit=3, after=cursor, fields=["id"])
+    assert [doc["id"] for doc in page] == ["doc3", "doc4", "doc5"]
+
 def test_get_document(temp_db, sample_document):
     """Test getting a specific document"""
     doc_id, content, metadata = sample_document
@@ -115,6 +219,609 @@ def test_update_document(temp_db):
     document = temp_db.get_document(doc_id)
     assert document is not None
     assert document["content"] == updated_content
+    assert temp_db.search("new information", n_results=5)["ids"] == [[doc_id]]
+    assert temp_db.get_document_count() == 1
+    assert VectorDatabase(persist_directory=temp_db.persist_directory).get_document(doc_id)["content"] == updated_content
+
+def test_failed_update_keeps_document(temp_db, monkeypatch):
+    """Test that an update that cannot be stored leaves the old version in place"""
+    temp_db.add_document("kept", "Original content", {"version": 1})
+    
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(temp_db.store, "append", fail)
+    
+    assert not temp_db.update_document("kept", "Updated content", {"version": 2})
+    assert not temp_db.update_document("missing", "Updated content")
+    assert temp_db.get_document("kept")["metadata"] == {"version": 1}
+    assert temp_db.get_document_count() == 1
+    monkeypatch.undo()
+    assert VectorDatabase(persist_directory=temp_db.persist_directory).get_document("kept")["content"] == "Original content"
+
+def test_document_ids_are_unique(temp_db):
+    """Test that adding an existing or repeated ID is rejected without storing anything"""
+    temp_db.add_documents(["first", "second"], [{}, {}], ["a", "b"])
+    
+    with pytest.raises(ValueError, match="b"):
+        temp_db.add_documents(["again", "new"], [{}, {}], ["b", "c"])
+    with pytest.raises(ValueError, match="d"):
+        temp_db.add_documents(["one", "two"], [{}, {}], ["d", "d"])
+    assert temp_db.add_document("a", "again", {}) is False
+    assert temp_db.get_document_count() == 2
+    assert temp_db.get_document("c") is None
+    
+    # Generated IDs skip the ones in use
+    temp_db.add_documents(["third"], [{}], ["doc_2"])
+    temp_db.add_documents(["fourth"])
+    assert {doc["id"] for doc in temp_db.list_documents()} == {"a", "b", "doc_2", "doc_3"}
+    
+    # A deleted ID can be reused
+    temp_db.delete_document("a")
+    temp_db.add_document("a", "replacement", {})
+    assert temp_db.get_document("a")["content"] == "replacement"
+
+def test_duplicate_ids_in_stored_data_are_dropped(temp_db):
+    """Test that only the newest copy of an ID stored before IDs were unique survives a reload"""
+    temp_db.store.append(["x", "y"], ["old x", "y"], [{}, {}])
+    temp_db.store.append(["x"], ["new x"], [{}])
+    
+    reloaded = VectorDatabase(persist_directory=temp_db.persist_directory)
+    
+    assert [doc["content"] for doc in reloaded.list_documents()] == ["y", "new x"]
+    assert reloaded.get_document("x")["content"] == "new x"
+    reopened = VectorDatabase(persist_directory=temp_db.persist_directory)
+    assert reopened.get_document_count() == 2
+    # Deleting the old copy starts a background compaction
+    reloaded.wait_for_compaction()
+    reopened.wait_for_compaction()
+
+def test_incremental_add_does_not_rebuild(temp_db, monkeypatch):
+    """Test that incremental mode only indexes the newly added documents"""
+    temp_db.add_document("first", "Neural networks learn representations", {})
+    
+    def fail_rebuild():
+        raise AssertionError("index should not be rebuilt")
+    monkeypatch.setattr(temp_db, "_rebuild_index", fail_rebuild)
+    
+    temp_db.add_document("second", "Databases store structured records", {})
+    
+    assert temp_db.index.ntotal == 2
+    assert temp_db.vectorizer.n_docs == 2
+    results = temp_db.search("structured records", n_results=1)
+    assert results["ids"][0] == ["second"]
+
+def test_identical_content_is_tokenized_once(temp_db, monkeypatch):
+    """Test that the vector cache serves the term counts of content it has seen"""
+    count = temp_db.vectorizer.count
+    tokenized = []
+    monkeypatch.setattr(temp_db.vectorizer, "count", lambda documents: tokenized.extend(documents) or count(documents))
+    
+    temp_db.add_documents(["compiler design notes", "compiler design notes", "garden vegetables"], ids=["a", "b", "c"])
+    temp_db.add_document("d", "compiler design notes", {})
+    temp_db.reindex()
+    
+    assert tokenized == ["compiler design notes", "garden vegetables"]
+    assert temp_db.get_stats()["vector_cache"]["hits"] >= 1
+    assert sorted(temp_db.search("compiler design notes", n_results=3)["ids"][0]) == ["a", "b", "d"]
+
+def test_incremental_index_survives_reload(temp_db):
+    """Test that a reloaded database keeps indexing incrementally"""
+    temp_db.add_document("first", "Neural networks learn representations", {})
+    
+    temp_db.store.wait_for_merges()
+    reloaded = VectorDatabase(persist_directory=temp_db.persist_directory)
+    reloaded.add_document("second", "Databases store structured records", {})
+    
+    assert reloaded.index.ntotal == 2
+    assert reloaded.vectorizer.n_docs == 2
+
+def test_full_rebuild_mode(temp_db):
+    """Test that the refitting mode still works"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, incremental=False)
+    db.add_document("first", "Neural networks learn representations", {})
+    db.add_document("second", "Databases store structured records", {})
+    
+    results = db.search("neural networks", n_results=1)
+    assert results["ids"][0] == ["first"]
+
+def test_full_rebuild_mode_refits_in_the_background(temp_db, monkeypatch):
+    """Test that past refit_min_rows adds use the fitted vocabulary until a re-fit"""
+    monkeypatch.setattr(VectorDatabase, "refit_min_rows", 3)
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, incremental=False, refit_growth=100)
+    db.add_documents(["Neural networks learn representations", "Databases store structured records",
+                      "Compilers translate programs"], ids=["first", "second", "third"])
+    
+    def fail_rebuild(counts=None):
+        raise AssertionError("index should not be rebuilt")
+    monkeypatch.setattr(db, "_rebuild_index", fail_rebuild)
+    db.add_document("fourth", "Zebras graze savannas", {})
+    assert db.index.ntotal == 4
+    assert db.get_stats()["refit"]["rows_since_fit"] == 1
+    
+    assert db.refit()
+    assert db.get_stats()["refit"]["fitted_rows"] == 4
+    assert db.search("zebras", n_results=1)["ids"][0] == ["fourth"]
+
+@pytest.mark.parametrize("trigger", ["growth", "oov"])
+def test_drift_triggers_refit(temp_db, monkeypatch, trigger):
+    """Test that corpus growth or unseen terms re-fit the vectorizer on the maintenance thread"""
+    monkeypatch.setattr(VectorDatabase, "refit_min_rows", 10)
+    monkeypatch.setattr(VectorDatabase, "refit_min_terms", 5)
+    options = {"refit_growth": 0.5, "refit_oov": 2.0} if trigger == "growth" else {"refit_growth": 100, "refit_oov": 0.5}
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, **options)
+    db.add_documents(synthetic_documents(10), ids=[f"doc{i}" for i in range(10)])
+    assert db.get_stats()["refit"]["refits"] == 0
+    
+    late = [f"unheard vocabulary word{i} appears" for i in range(6)] if trigger == "growth" else ["quasar nebula pulsar magnetar blazar"]
+    db.add_documents(late, ids=[f"late{i}" for i in range(len(late))])
+    db.wait_for_compaction()
+    
+    stats = db.get_stats()["refit"]
+    assert stats["refits"] == 1
+    assert stats["fitted_rows"] == 10 + len(late)
+    assert stats["oov_rate"] == 0.0
+    assert db.search("quasar" if trigger == "oov" else "word3", n_results=1)["ids"][0] == ["late0" if trigger == "oov" else "late3"]
+
+def test_refit_timer(temp_db):
+    """Test that refit_interval re-fits a changed corpus on a timer"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, refit_interval=0.1)
+    db.add_documents(synthetic_documents(5))
+    db.add_document("late", "Telescopes observe distant galaxies", {})
+    
+    deadline = time.monotonic() + 10
+    while db.get_stats()["refit"]["refits"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    db.wait_for_compaction()
+    assert db.get_stats()["refit"]["fitted_rows"] == 6
+
+def test_reload_replays_segments(temp_db):
+    """Test that adds and deletes are persisted as segments and replayed on load"""
+    temp_db.add_document("first", "Neural networks learn representations", {"n": 1})
+    temp_db.add_document("second", "Databases store structured records", {"n": 2})
+    temp_db.add_document("third", "Compilers translate source code", {"n": 3})
+    temp_db.delete_document("second")
+    
+    assert not os.path.exists(os.path.join(temp_db.persist_directory, "data.json"))
+    
+    reloaded = VectorDatabase(persist_directory=temp_db.persist_directory, compaction_threshold=1.0)
+    assert [doc["id"] for doc in reloaded.list_documents()] == ["first", "third"]
+    assert [doc["metadata"] for doc in reloaded.list_documents()] == [{"n": 1}, {"n": 3}]
+    assert reloaded.get_document("second") is None
+    assert reloaded.get_document_count() == 2
+    assert reloaded.search("compilers", n_results=1)["ids"][0] == ["third"]
+
+def test_delete_is_a_tombstone(temp_db, monkeypatch):
+    """Test that deleting only tombstones the row and hides it from searches"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, compaction_threshold=1.0)
+    db.add_document("first", "Neural networks learn representations", {})
+    db.add_document("second", "Neural networks and databases", {})
+    
+    def fail_rebuild():
+        raise AssertionError("index should not be rebuilt")
+    monkeypatch.setattr(db, "_rebuild_index", fail_rebuild)
+    
+    assert db.delete_document("second")
+    assert not db.delete_document("second")
+    
+    assert db.index.ntotal == 2
+    assert db.get_stats()["deleted_count"] == 1
+    assert db.search("neural networks", n_results=5)["ids"][0] == ["first"]
+
+@pytest.mark.parametrize("backend", ["faiss", "sparse"])
+def test_compaction_reclaims_tombstones(temp_db, backend):
+    """Test that compaction drops tombstoned rows and keeps the rest searchable"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, backend=backend, compaction_threshold=1.0)
+    for i, topic in enumerate(["neural networks", "relational databases", "compiler design", "operating systems"]):
+        db.add_document(f"doc{i}", f"A document about {topic}", {"i": i})
+    db.delete_document("doc1")
+    db.delete_document("doc2")
+    
+    assert db.compact()
+    
+    assert db.document_ids == ["doc0", "doc3"]
+    assert db.index.ntotal == 2
+    assert db.get_stats()["deleted_count"] == 0
+    assert db.get_document("doc3")["metadata"] == {"i": 3}
+    assert db.search("operating systems", n_results=5)["ids"][0] == ["doc3"]
+    
+    db.store.wait_for_merges()
+    reloaded = VectorDatabase(persist_directory=temp_db.persist_directory, backend=backend)
+    assert reloaded.document_ids == ["doc0", "doc3"]
+    assert reloaded.search("neural networks", n_results=5)["ids"][0] == ["doc0"]
+
+def test_compaction_runs_in_background_past_threshold(temp_db):
+    """Test that crossing the tombstone threshold triggers a compaction"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, compaction_threshold=0.3)
+    for i in range(4):
+        db.add_document(f"doc{i}", f"Document number {i} about search engines", {})
+    
+    db.delete_document("doc0")  # 25% tombstones
+    db.wait_for_compaction()
+    assert len(db.documents) == 4
+    
+    db.delete_document("doc1")  # 50% tombstones
+    db.wait_for_compaction()
+    assert db.document_ids == ["doc2", "doc3"]
+
+def test_bodies_are_read_from_the_store(temp_db):
+    """Test that document bodies stay on disk through adds, compaction and reloads"""
+    temp_db.add_documents([f"body {i}" for i in range(4)], [{}] * 4, [f"doc{i}" for i in range(4)])
+    temp_db.add_document("doc4", "body 4", {})
+    temp_db.delete_document("doc0")
+    temp_db.compact()
+    
+    for db in (temp_db, VectorDatabase(persist_directory=temp_db.persist_directory)):
+        assert all(isinstance(part, SegmentContents) for part in db.documents._parts)
+        assert db.get_document("doc4")["content"] == "body 4"
+        assert db.query("body", n_results=4)["documents"][0].startswith("body")
+
+def test_lazy_database_loads_on_warm_up(temp_db):
+    """Test that a lazy database loads nothing until it is warmed up or used"""
+    temp_db.add_documents(["Neural networks", "Databases"], [{"n": 1}, {"n": 2}], ["nn", "db"])
+    
+    lazy = VectorDatabase(persist_directory=temp_db.persist_directory, lazy=True)
+    assert not lazy.ready
+    assert lazy.index is None and len(lazy.documents) == 0
+    lazy.warm_up()
+    assert lazy.ready
+    assert lazy.get_document_count() == 2
+    assert lazy.metadata[1] == {"n": 2}
+    
+    first_use = VectorDatabase(persist_directory=temp_db.persist_directory, lazy=True)
+    assert first_use.search("databases", n_results=1)["ids"] == [["db"]]
+    assert first_use.ready
+
+def test_import_does_not_load_heavy_modules(tmp_path):
+    """Test that importing the app neither loads the database nor scikit-learn"""
+    import subprocess
+    
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = "import sys, app; print('sklearn' in sys.modules, app.vector_db.ready)"
+    output = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=package), check=True).stdout
+    assert output.split()[-2:] == ["False", "False"]
+
+def test_legacy_data_json_is_migrated(temp_db):
+    """Test that a store written as data.json is moved into segments"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(temp_dir, "data.json"), "w") as f:
+            json.dump({
+                "documents": ["Neural networks learn representations"],
+                "metadata": [{"filename": "nn.txt"}],
+                "document_ids": ["legacy"]
+            }, f)
+        
+        db = VectorDatabase(persist_directory=temp_dir)
+        
+        assert db.get_document("legacy")["metadata"] == {"filename": "nn.txt"}
+        assert not os.path.exists(os.path.join(temp_dir, "data.json"))
+        assert VectorDatabase(persist_directory=temp_dir).document_ids == ["legacy"]
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+@pytest.mark.parametrize("scoring", ["cosine", "bm25"])
+def test_sparse_backend_search(temp_db, scoring):
+    """Test that the sparse inverted-index backend ranks like the dense one"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, backend="sparse", scoring=scoring)
+    db.add_document("ai", "Artificial intelligence and machine learning research", {"topic": "AI"})
+    db.add_document("db", "Relational databases store structured records", {"topic": "DB"})
+    
+    results = db.search("machine learning", n_results=5)
+    assert results["ids"][0] == ["ai"]
+    assert results["metadatas"][0] == [{"topic": "AI"}]
+    assert 0 <= results["distances"][0][0] < 1
+    
+    reloaded = VectorDatabase(persist_directory=temp_db.persist_directory, backend="sparse", scoring=scoring)
+    assert reloaded.search("structured records", n_results=5)["ids"][0] == ["db"]
+
+def test_sparse_index_matches_exhaustive_search():
+    """Test that segment flushing and merging do not change search results"""
+    from scipy import sparse
+    from vector_db import SparseIndex
+    
+    vectors = sparse.random(500, 50, density=0.1, random_state=0, format="csr", dtype="float32")
+    index = SparseIndex(50, flush_threshold=16)
+    for start in range(0, 500, 7):
+        index.add(vectors[start:start + 7])
+    assert index.ntotal == 500
+    
+    query = vectors[42]
+    expected = (vectors @ query.T).toarray().ravel()
+    scores, indices = index.search(query, 5)
+    assert indices[0][0] == 42
+    assert scores[0].tolist() == pytest.approx(sorted(expected, reverse=True)[:5], rel=1e-5)
+
+def test_bm25_requires_sparse_backend(temp_db):
+    """Test that BM25 scoring is rejected for the dense backend"""
+    with pytest.raises(ValueError):
+        VectorDatabase(persist_directory=temp_db.persist_directory, scoring="bm25")
+
+def test_instances_share_changes_without_reload(temp_db):
+    """Test that a second instance on the same directory sees writes through the generation counter"""
+    other = VectorDatabase(persist_directory=temp_db.persist_directory, compaction_threshold=1.0)
+    temp_db.add_document("nn", "Neural networks learn representations", {"i": 0})
+    temp_db.add_document("db", "Relational databases store records", {"i": 1})
+    
+    assert other.search("neural networks", n_results=5)["ids"][0] == ["nn"]
+    assert other.get_document("db")["metadata"] == {"i": 1}
+    
+    other.delete_document("nn")
+    other.add_document("os", "Operating systems schedule processes", {"i": 2})
+    assert temp_db.get_document("nn") is None
+    assert temp_db.search("operating systems", n_results=5)["ids"][0] == ["os"]
+    assert [doc["id"] for doc in temp_db.list_documents()] == ["db", "os"]
+    
+    # Rows renumbered by one instance force a full reload in the other
+    assert other.compact()
+    assert temp_db.get_stats()["deleted_count"] == 0
+    assert temp_db.document_ids == ["db", "os"]
+    assert temp_db.delete_document("db")
+    assert other.get_document("db") is None
+    other.wait_for_compaction()
+
+def test_shutdown_durability_commits_on_request(temp_db):
+    """Test that writes after the last commit are only visible until a crash cuts them short"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, durability="shutdown")
+    db.add_documents(synthetic_documents(3), ids=["a", "b", "c"])
+    db.store.commit()
+    db.add_document("d", "Written after the commit", {})
+    stats = db.get_stats()
+    assert (stats["durability"], stats["uncommitted_writes"]) == ("shutdown", 1)
+    assert VectorDatabase(persist_directory=temp_db.persist_directory).get_document("d") is not None
+    
+    segment = db.store.manifest["segments"][-1]["name"]
+    os.truncate(os.path.join(temp_db.persist_directory, f"{segment}.bin"), 0)
+    reopened = VectorDatabase(persist_directory=temp_db.persist_directory)
+    assert reopened.document_ids == ["a", "b", "c"]
+
+def test_cached_results_follow_writes_while_another_writes(temp_db):
+    """Test that writes of this process are not hidden by cached results while another writer holds the lock"""
+    temp_db.add_documents(["apple pie recipe", "apple orchard tour", "apple juice press"], ids=["a", "b", "c"])
+    # Enough other documents that the delete does not start a compaction, which would refresh
+    temp_db.add_documents([f"banana bread {i}" for i in range(10)])
+    
+    def search_while_locked():
+        holding, release = threading.Event(), threading.Event()
+        
+        def hold():
+            with temp_db._write_lock:
+                holding.set()
+                release.wait(5)
+        writer = threading.Thread(target=hold)
+        writer.start()
+        assert holding.wait(5)
+        try:
+            return sorted(temp_db.search("apple", n_results=5)["ids"][0])
+        finally:
+            release.set()
+            writer.join()
+    
+    # Each search caches its results for the generation the write starts from
+    assert sorted(temp_db.search("apple", n_results=5)["ids"][0]) == ["a", "b", "c"]
+    temp_db.delete_by_id("a")
+    assert search_while_locked() == ["b", "c"]
+    assert temp_db.get_document("a") is None
+    temp_db.add_document("z", "apple cider vinegar", {})
+    assert search_while_locked() == ["b", "c", "z"]
+
+def test_search_does_not_wait_for_writes(temp_db):
+    """Test that a search goes on with the current state while another thread writes"""
+    temp_db.add_document("nn", "Neural networks learn representations", {})
+    other = VectorDatabase(persist_directory=temp_db.persist_directory)
+    other.add_document("db", "Relational databases store records", {})
+    writing, written = threading.Event(), threading.Event()
+    
+    def write():
+        # A writer of this process, busy tokenizing and persisting
+        with temp_db._write_lock:
+            writing.set()
+            written.wait(5)
+    writer = threading.Thread(target=write)
+    writer.start()
+    assert writing.wait(5)
+    started = time.monotonic()
+    assert temp_db.search("relational databases", n_results=5)["ids"][0] == []
+    assert temp_db.get_document("nn")["id"] == "nn"
+    assert time.monotonic() - started < 2
+    
+    written.set()
+    writer.join()
+    assert temp_db.search("relational databases", n_results=5)["ids"][0] == ["db"]
+    other.wait_for_compaction()
+
+def test_compaction_waits_for_running_searches(temp_db, monkeypatch):
+    """Test that a compaction does not renumber the rows under a search that is running"""
+    documents = synthetic_documents(20)
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, compaction_threshold=1.0)
+    db.add_documents(documents, ids=[f"doc{i}" for i in range(20)])
+    for i in range(10):
+        db.delete_document(f"doc{i}")
+    compaction = threading.Thread(target=db.compact)
+    search = db._search
+    
+    def search_then_compact(*args, **kwargs):
+        found = search(*args, **kwargs)
+        compaction.start()
+        compaction.join(timeout=0.5)
+        return found
+    monkeypatch.setattr(db, "_search", search_then_compact)
+    results = db.query("topic15", n_results=1)
+    compaction.join()
+    
+    assert (results["ids"], results["documents"]) == (["doc15"], [documents[15]])
+    assert db.document_ids[5] == "doc15"
+
+def test_metrics_collection_does_not_block_writes(temp_db, monkeypatch):
+    """Test that collecting the metrics while documents are added and searched never deadlocks"""
+    import metrics
+    
+    def count_locked():
+        # A gauge function that reads the state under its lock
+        with temp_db._state_lock.read():
+            return temp_db.get_document_count()
+    monkeypatch.setattr(metrics.DOCUMENTS, "_function", count_locked)
+    stop = threading.Event()
+    
+    def collect():
+        while not stop.is_set():
+            metrics.registry.collect()
+    
+    def write():
+        for i in range(100):
+            temp_db.add_document(f"doc{i}", f"document {i} about topic{i % 7}", {})
+    
+    def search():
+        while not stop.is_set():
+            temp_db.search("topic3")
+    threads = [threading.Thread(target=target, daemon=True) for target in (collect, search, write)]
+    for thread in threads:
+        thread.start()
+    threads[-1].join(30)
+    stop.set()
+    for thread in threads:
+        thread.join(5)
+    
+    assert not any(thread.is_alive() for thread in threads)
+    assert temp_db.get_document_count() == 100
+    assert metrics.registry.collect()["vector_db_documents"]["samples"] == [[[], 100.0]]
+
+def test_concurrent_processes_append_to_one_store(temp_db):
+    """Test that writers in separate processes never overwrite each other's segments"""
+    import subprocess
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (
+        "import sys; from vector_db import VectorDatabase\n"
+        "db = VectorDatabase(persist_directory=sys.argv[1])\n"
+        "for i in range(15):\n"
+        "    db.add_document(f'{sys.argv[2]}-{i}', f'document {i} written by {sys.argv[2]}', {})\n"
+        "db.store.wait_for_merges()\n"
+    )
+    writers = [
+        subprocess.Popen([sys.executable, "-c", script, temp_db.persist_directory, name], cwd=root)
+        for name in ("first", "second")
+    ]
+    assert [writer.wait(timeout=60) for writer in writers] == [0, 0]
+    
+    assert temp_db.get_stats()["document_count"] == 30
+    reloaded = VectorDatabase(persist_directory=temp_db.persist_directory)
+    assert sorted(reloaded.document_ids) == sorted(temp_db.document_ids)
+    assert reloaded.search("written by second", n_results=1)["ids"][0][0].startswith("second-")
+
+def test_shared_index_snapshot_is_memory_mapped(temp_db, monkeypatch):
+    """Test that processes map the published index snapshot and keep only newer rows private"""
+    monkeypatch.setattr(VectorDatabase, "snapshot_interval", 4)
+    writer = VectorDatabase(persist_directory=temp_db.persist_directory, shared_index=True)
+    topics = ["neural networks", "relational databases", "compiler design", "operating systems", "computer graphics"]
+    writer.add_documents([f"A document about {topic}" for topic in topics], ids=[f"doc{i}" for i in range(5)])
+    writer.wait_for_compaction()
+    assert writer.get_stats()["mapped_rows"] == 5
+    
+    reader = VectorDatabase(persist_directory=temp_db.persist_directory, shared_index=True)
+    assert reader.get_stats()["mapped_rows"] == 5
+    assert reader.index.ntotal == 0
+    
+    writer.add_document("doc5", "A document about distributed consensus", {})
+    writer.delete_document("doc1")
+    results = reader.search("distributed consensus", n_results=5)
+    assert results["ids"][0][0] == "doc5"
+    assert reader.index.ntotal == 1
+    assert "doc1" not in reader.search("relational databases", n_results=5)["ids"][0]
+    
+    assert writer.publish_snapshot()
+    reader.refresh()
+    assert reader.get_stats()["mapped_rows"] == 6
+    assert reader.index.ntotal == 0
+    assert reader.search("compiler design", n_results=1)["ids"][0] == ["doc2"]
+
+def synthetic_documents(n):
+    return [f"Document {i} is about topic{i} and subject{i % 7}" for i in range(n)]
+
+@pytest.mark.parametrize("index_type", ["ivf", "ivfpq", "hnsw"])
+def test_approximate_index_types(temp_db, monkeypatch, index_type):
+    """Test that IVF, IVF-PQ and HNSW indexes are trained, searched and honour tombstones"""
+    monkeypatch.setattr(VectorDatabase, "ivf_min_points", 1)
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, index_type=index_type, compaction_threshold=1.0)
+    db.add_documents(synthetic_documents(300), ids=[f"doc{i}" for i in range(300)])
+    
+    assert db.get_stats()["active_index"] == index_type
+    assert db.search("topic42", n_results=1, nprobe=1000, ef_search=300)["ids"][0] == ["doc42"]
+    
+    db.delete_document("doc42")
+    assert "doc42" not in db.search("topic42", n_results=5, nprobe=1000, ef_search=300)["ids"][0]
+    db.add_document("new", "A late document about topic1000", {})
+    assert db.search("late document about topic1000", n_results=1, nprobe=1000, ef_search=300)["ids"][0] == ["new"]
+
+def test_ivf_with_pq_compression_is_not_reindexed_on_add(temp_db, monkeypatch):
+    """Test that an IVF index of PQ codes is seen as IVF-PQ, so small adds do not rebuild it"""
+    monkeypatch.setattr(VectorDatabase, "ivf_min_points", 1)
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, index_type="ivf", compression="pq")
+    db.add_documents(synthetic_documents(300), ids=[f"doc{i}" for i in range(300)])
+    db.wait_for_compaction()
+    assert db.get_stats()["active_index"] == "ivfpq"
+    refits = db.get_stats()["refit"]["refits"]
+    
+    db.add_document("new", "A late document about topic1000", {})
+    db.wait_for_compaction()
+    assert not db._needs_reindex()
+    assert db.get_stats()["refit"]["refits"] == refits
+
+def test_ivf_falls_back_to_flat_until_trainable(temp_db):
+    """Test that an IVF index stays exact while there are too few vectors to train it"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, index_type="ivf")
+    db.add_documents(synthetic_documents(20))
+    assert db.get_stats()["active_index"] == "flat"
+
+def test_auto_index_switches_to_ann_past_threshold(temp_db, monkeypatch):
+    """Test that the auto policy rebuilds the index as IVF in the background once the corpus grows"""
+    monkeypatch.setattr(VectorDatabase, "ivf_min_points", 1)
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, index_type="auto", ann_threshold=50)
+    documents = synthetic_documents(80)
+    db.add_documents(documents[:40], ids=[f"doc{i}" for i in range(40)])
+    assert db.get_stats()["active_index"] == "flat"
+    
+    db.add_documents(documents[40:], ids=[f"doc{i}" for i in range(40, 80)])
+    db.wait_for_compaction()
+    
+    assert db.get_stats()["active_index"] == "ivf"
+    assert db.index.ntotal == 80
+    assert db.search("topic65", n_results=1, nprobe=100)["ids"][0] == ["doc65"]
+
+@pytest.mark.parametrize("compression,index_type,bytes_per_vector", [
+    ("fp16", "flat", 2000), ("sq8", "flat", 1000), ("sq8", "hnsw", 1000), ("pq", "flat", 125)])
+def test_compressed_vectors(temp_db, monkeypatch, compression, index_type, bytes_per_vector):
+    """Test that compressed indexes shrink the vectors and re-ranking restores exact scores"""
+    monkeypatch.setattr(VectorDatabase, "ivf_min_points", 1)
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, index_type=index_type,
+                        compression=compression, rerank=10)
+    db.add_documents(synthetic_documents(300), ids=[f"doc{i}" for i in range(300)])
+    stats = db.get_stats()
+    
+    assert stats["active_compression"] == compression
+    assert bytes_per_vector <= stats["bytes_per_vector"] < 4000
+    assert stats["index_memory_bytes"] >= 300 * bytes_per_vector
+    results = db.search("topic42", n_results=1, ef_search=300)
+    assert results["ids"][0] == ["doc42"]
+    exact = VectorDatabase(persist_directory=temp_db.persist_directory)
+    assert results["distances"][0][0] == pytest.approx(exact.search("topic42", n_results=1)["distances"][0][0], abs=1e-5)
+
+def test_pq_compression_waits_for_training_data(temp_db):
+    """Test that PQ falls back to 8-bit quantization while there are too few vectors to train it"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, compression="pq")
+    db.add_documents(synthetic_documents(20))
+    assert db.get_stats()["active_compression"] == "sq8"
+    
+    with pytest.raises(ValueError):
+        VectorDatabase(persist_directory=temp_db.persist_directory, compression="pq", backend="sparse")
+
+def test_vector_dimension_is_configurable(temp_db):
+    """Test that the TF-IDF feature space follows the dimension option"""
+    db = VectorDatabase(persist_directory=temp_db.persist_directory, dimension=256)
+    db.add_documents(synthetic_documents(20), ids=[f"doc{i}" for i in range(20)])
+    
+    assert db.index.d == 256
+    assert db.get_stats()["bytes_per_vector"] == 256 * 4
+    assert db.search("topic7", n_results=1)["ids"][0] == ["doc7"]
 
 # Test Flask endpoints with proper test client
 def test_search_endpoint(client):
@@ -138,6 +845,61 @@ def test_search_endpoint_missing_query(client):
     data = response.get_json()
     assert "error" in data
 
+def test_search_endpoint_index_knobs(client, sample_document):
+    """Test that nprobe and ef_search are accepted per request and validated"""
+    response = client.post("/search", json={"query": "artificial intelligence", "nprobe": 4, "ef_search": 32})
+    assert response.status_code == 200
+    assert response.get_json()["count"] == 1
+    
+    response = client.post("/search", json={"query": "artificial intelligence", "nprobe": 0})
+    assert response.status_code == 400
+
+def test_search_endpoint_n_results(client, sample_document, monkeypatch):
+    """Test that n_results must be a positive integer within the configured limit"""
+    monkeypatch.setattr("app.MAX_SEARCH_RESULTS", 10)
+    response = client.post("/search", json={"query": "artificial intelligence", "n_results": 10})
+    assert response.status_code == 200
+    
+    for n_results in (0, -1, "3", 2.5, True, None, 11):
+        response = client.post("/search", json={"query": "artificial intelligence", "n_results": n_results})
+        assert response.status_code == 400
+        assert "n_results" in response.get_json()["error"]
+        response = client.post("/search/batch", json={"queries": ["artificial intelligence"], "n_results": n_results})
+        assert response.status_code == 400
+
+def test_search_endpoint_where(client, temp_db):
+    """Test metadata filters on the search endpoints"""
+    temp_db.add_documents(["artificial intelligence notes", "artificial intelligence slides"],
+                          [{"category": "notes"}, {"category": "slides"}], ["notes", "slides"])
+    
+    response = client.post("/search", json={"query": "artificial intelligence", "where": {"category": "slides"}})
+    assert response.status_code == 200
+    assert [result["id"] for result in response.get_json()["results"]] == ["slides"]
+    
+    response = client.post("/search/batch", json={"queries": ["artificial intelligence"],
+                                                  "where": {"category": {"$in": ["notes"]}}})
+    assert [result["id"] for result in response.get_json()["results"][0]["results"]] == ["notes"]
+    
+    for where in ("slides", {"category": {"$gt": "a"}}, {"category": {}}):
+        assert client.post("/search", json={"query": "ai", "where": where}).status_code == 400
+
+def test_search_batch_endpoint(client, sample_document):
+    """Test searching for several queries in one request"""
+    doc_id, content, metadata = sample_document
+    
+    response = client.post("/search/batch", json={"queries": ["artificial intelligence", "xyz123"], "n_results": 3})
+    
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["count"] == 2
+    assert data["results"][0]["query"] == "artificial intelligence"
+    assert data["results"][0]["results"][0]["id"] == doc_id
+    assert data["results"][1]["count"] == 0
+    
+    for body in ({}, {"queries": []}, {"queries": "artificial intelligence"}, {"queries": ["ok", 1]},
+                 {"queries": ["ok"], "nprobe": -1}):
+        assert client.post("/search/batch", json=body).status_code == 400
+
 def test_documents_endpoint(client):
     """Test the documents listing endpoint"""
     response = client.get("/documents")
@@ -146,6 +908,30 @@ def test_documents_endpoint(client):
     data = response.get_json()
     assert "documents" in data
     assert "count" in data
+
+def test_documents_endpoint_pagination(client, temp_db):
+    """Test cursor pagination, projection and NDJSON streaming of the listing"""
+    temp_db.add_documents([f"document {i}" for i in range(3)], [{"n": i} for i in range(3)],
+                          [f"doc{i}" for i in range(3)])
+    
+    data = client.get("/documents?limit=2&fields=id").get_json()
+    assert data["documents"] == [{"id": "doc0"}, {"id": "doc1"}]
+    assert data["total"] == 3
+    data = client.get(f"/documents?limit=2&after={data['next_cursor']}").get_json()
+    assert [doc["id"] for doc in data["documents"]] == ["doc2"]
+    assert data["next_cursor"] is None
+    
+    response = client.get("/documents?limit=2&format=ndjson&fields=id,metadata")
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{"id": "doc0", "metadata": {"n": 0}}, {"id": "doc1", "metadata": {"n": 1}}]
+    assert "X-Next-Cursor" in response.headers
+    
+    for query in ("limit=0", "limit=abc", "fields=embedding", "after=bogus", "format=xml"):
+        assert client.get(f"/documents?{query}").status_code == 400
+
+def test_get_document_endpoint(client, sample_document):
+    """Test getting a specific document through the API"""
     doc_id, content, metadata = sample_document
     
     response = client.get(f"/documents/{doc_id}")
@@ -163,7 +949,7 @@ def test_get_nonexistent_document(client):
     data = response.get_json()
     assert "error" in data
 
-def test_delete_document(client, sample_document):
+def test_delete_document_endpoint(client, sample_document):
     """Test deleting a document"""
     doc_id, content, metadata = sample_document
     
@@ -182,6 +968,24 @@ def test_db_info(client):
     assert "name" in data
     assert "count" in data
     assert "persist_directory" in data
+    assert "bytes_per_vector" in data
+    assert "index_memory_bytes" in data
+
+def test_metrics_endpoint(client, sample_document):
+    """Test that searches are timed per stage and exported in the Prometheus format"""
+    client.post("/search", json={"query": "artificial intelligence"})
+    
+    response = client.get("/metrics")
+    
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    for stage in ("vectorize", "index_search", "materialize", "serialize"):
+        assert f'stage_duration_seconds_count{{operation="search",stage="{stage}"}}' in text
+    assert 'stage_duration_seconds_count{operation="write",stage="persist"}' in text
+    assert 'http_request_duration_seconds_bucket{method="POST",endpoint="/search",status="200",le="+Inf"}' in text
+    assert "# TYPE vector_db_documents gauge" in text
+    assert "process_resident_memory_bytes{pid=" in text
 
 def test_upload_and_process_file(client):
     """Test file upload and processing with vector database integration"""
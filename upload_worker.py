@@ -1,45 +1,514 @@
+import atexit
+import collections
+import hashlib
+import itertools
+import math
+import queue
+import re
 import threading
 import time
 import os
+import uuid
 from logger_config import get_logger
+from metrics import INGESTED_DOCUMENTS, INGESTED_FILES, QUEUE_DEPTH, STAGE_SECONDS
+from query_cache import content_hash
 from vector_db import vector_db
 
 logger = get_logger(__name__)
 
-def process_file(path):
+PASSAGE_SPLITS = ("size", "sentence", "paragraph")
+
+# End of a sentence, including any closing quotes or brackets and the whitespace after it
+SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s+')
+
+def file_hash(path, read_size: int = 1024 * 1024):
+    """SHA-256 of a file's bytes, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(read_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_metadata(path):
+    """Metadata shared by every document created from an uploaded file."""
+    return {
+        'filename': os.path.basename(path),
+        'file_path': path,
+        'upload_time': time.time(),
+        'file_size': os.path.getsize(path),
+        'file_hash': file_hash(path)
+    }
+
+def remove_upload(path):
+    """Delete an uploaded file once it is ingested, and the directory it was saved in if that is left empty."""
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove upload {path}: {e}")
+        return
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+def new_document_id(path):
+    """ID for the document of an uploaded file, unique even among uploads of one name in the same second."""
+    return f"file_{os.path.basename(path)}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+
+def build_document(path):
+    """Read an uploaded file into a (document ID, content, metadata) tuple."""
+    with open(path, 'r', encoding='utf-8') as file:
+        content = file.read()
+
+    return new_document_id(path), content, dict(file_metadata(path), content_hash=content_hash(content))
+
+def _passage_end(window, split):
+    """Where to cut a full window: the last boundary of the split kind past its middle."""
+    middle = len(window) // 2
+    if split == "paragraph":
+        position = window.rfind("\n\n", middle)
+        if position != -1:
+            return position + 2
+    if split in ("paragraph", "sentence"):
+        last = None
+        for last in SENTENCE_END.finditer(window, middle):
+            pass
+        if last is not None:
+            return last.end()
+        # Fall back to a word boundary rather than cutting a word in half
+        position = max(window.rfind(" ", middle), window.rfind("\n", middle))
+        if position != -1:
+            return position + 1
+    return len(window)
+
+def iter_passages(path, passage_size: int = 4000, overlap: int = 400,
+                  split: str = "paragraph", read_size: int = 64 * 1024):
+    """Stream overlapping (start, end, text) passages out of a text file.
+
+    The file is read ``read_size`` characters at a time, so at most
+    ``passage_size + read_size`` characters are held in memory whatever the
+    file size. Offsets are character offsets into the decoded file and
+    consecutive passages share up to ``overlap`` characters.
+    """
+    if split not in PASSAGE_SPLITS:
+        raise ValueError(f"Unknown passage split: {split!r} (expected one of {', '.join(PASSAGE_SPLITS)})")
+    if not 0 <= overlap < passage_size:
+        raise ValueError("overlap must be smaller than passage_size")
+
+    with open(path, 'r', encoding='utf-8') as file:
+        buffer = ""
+        start = 0
+        emitted = 0
+        eof = False
+        while True:
+            while not eof and len(buffer) <= passage_size:
+                chunk = file.read(read_size)
+                eof = not chunk
+                buffer += chunk
+            if len(buffer) <= passage_size:
+                # Last passage, unless it only repeats the previous overlap
+                if start + len(buffer) > emitted and buffer.strip():
+                    yield start, start + len(buffer), buffer
+                return
+            end = _passage_end(buffer[:passage_size], split)
+            if buffer[:end].strip():
+                yield start, start + end, buffer[:end]
+            emitted = start + end
+            advance = max(end - overlap, 1)
+            buffer = buffer[advance:]
+            start += advance
+
+def iter_documents(path, passage_size: int = 0, overlap: int = 400, split: str = "paragraph"):
+    """Yield the (document ID, content, metadata) tuples to index for a file.
+
+    Files that fit in one passage (or every file, when ``passage_size`` is 0)
+    become a single document. Larger files are streamed into passages whose
+    IDs are ``<parent_id>#<index>``; their metadata records the
+    ``parent_id``, ``passage_index`` and the ``start_offset``/``end_offset``
+    of the passage in the file. Every document's metadata holds the
+    ``file_hash`` of the file and the ``content_hash`` of its own text.
+    """
+    if not passage_size or os.path.getsize(path) <= passage_size:
+        yield build_document(path)
+        return
+
+    passages = iter_passages(path, passage_size, overlap, split)
+    head = list(itertools.islice(passages, 2))
+    parent_id = new_document_id(path)
+    metadata = file_metadata(path)
+    if len(head) < 2:
+        # Multi-byte text can be larger on disk than in characters
+        content = head[0][2] if head else ""
+        yield parent_id, content, dict(metadata, content_hash=content_hash(content))
+        return
+
+    for index, (start, end, text) in enumerate(itertools.chain(head, passages)):
+        yield f"{parent_id}#{index}", text, dict(
+            metadata,
+            parent_id=parent_id,
+            passage_index=index,
+            start_offset=start,
+            end_offset=end,
+            content_hash=content_hash(text),
+        )
+
+def drop_duplicates(db, documents):
+    """Split (document ID, content, metadata) tuples into those to store and the duplicates.
+
+    A whole-file document is a duplicate when a live document of ``db`` or
+    an earlier one in ``documents`` has the same ``content_hash``. Passages
+    are always kept, so a file is never stored with passages missing.
+    Returns the documents to store and a dict mapping the ID of each
+    duplicate to the ID of the document holding its content.
+    """
+    hashes = {meta.get('content_hash') for _, _, meta in documents if 'parent_id' not in meta} - {None}
+    seen = db.find_by_metadata('content_hash', list(hashes))
+    unique = []
+    duplicates = {}
+    for document in documents:
+        doc_id, _, meta = document
+        key = meta.get('content_hash')
+        if key is not None and 'parent_id' not in meta:
+            if key in seen:
+                duplicates[doc_id] = seen[key]
+                continue
+            seen[key] = doc_id
+        unique.append(document)
+    return unique, duplicates
+
+def drop_taken_ids(db, documents):
+    """The (document ID, content, metadata) tuples whose ID is neither stored in ``db`` nor used earlier in ``documents``."""
+    seen = set()
+    kept = []
+    for document in documents:
+        if document[0] in seen or db.get_document(document[0]) is not None:
+            continue
+        seen.add(document[0])
+        kept.append(document)
+    return kept
+
+def process_file(path, batch_size: int = 32, db=None):
     logger.info(f"Starting file processing: {path}")
-    
+    if db is None:
+        db = vector_db
+
     try:
-        # Read file content
-        with open(path, 'r', encoding='utf-8') as file:
-            content = file.read()
-        
-        # Extract filename and create document ID
-        filename = os.path.basename(path)
-        document_id = f"file_{filename}_{int(time.time())}"
-        
-        # Create metadata
-        metadata = {
-            'filename': filename,
-            'file_path': path,
-            'upload_time': time.time(),
-            'file_size': os.path.getsize(path)
-        }
-        
-        # Add to vector database
-        success = vector_db.add_document(document_id, content, metadata)
-        
-        if success:
-            logger.info(f"Successfully processed and stored file: {filename}")
-        else:
-            logger.error(f"Failed to store file in vector database: {filename}")
-            
+        documents = iter_documents(path, pipeline.passage_size, pipeline.passage_overlap, pipeline.passage_split)
+        stored = skipped = 0
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                break
+            batch, duplicates = drop_duplicates(db, batch)
+            skipped += len(duplicates)
+            if not batch:
+                continue
+            ids, contents, metadata = (list(column) for column in zip(*batch))
+            # Add to vector database
+            db.add_documents(contents, metadata, ids)
+            stored += len(batch)
+
+        logger.info(f"Successfully processed and stored file: {os.path.basename(path)} "
+                    f"({stored} documents, {skipped} duplicates skipped)")
+
     except Exception as e:
         logger.error(f"Error processing file {path}: {e}")
-    
+
     logger.info(f"Completed file processing: {os.path.basename(path)}")
 
-def process_file_background(path):
+class IngestionPipeline:
+    """Bounded ingestion queue feeding a fixed worker pool and a batching writer.
+
+    ``submit`` never blocks: when ``max_queue_size`` files are waiting it
+    rejects the file so the caller can ask the client to retry. Reader
+    threads turn files into documents, and a single writer thread groups
+    them into one ``add_documents`` call per ``batch_size`` documents or
+    ``flush_interval`` seconds, whichever comes first. Files go to ``db``
+    unless ``submit`` names another database, such as a collection; a batch
+    is split into one write per database.
+
+    With a ``passage_size`` files larger than one passage are streamed into
+    overlapping passages (see ``iter_documents``), so a large upload never
+    has to fit in memory at once.
+
+    With ``dedup`` a file identical to one already stored (e.g. a client
+    retrying an upload) is skipped before any of its documents is queued,
+    and whole-file documents whose content is stored already are dropped
+    from each batch, both by content hash. The latest skipped files and the
+    IDs their content is stored as are reported in the stats.
+    """
+
+    def __init__(self, db, max_queue_size: int = 100, workers: int = 2,
+                 batch_size: int = 32, flush_interval: float = 0.5,
+                 passage_size: int = 0, passage_overlap: int = 400,
+                 passage_split: str = "paragraph", dedup: bool = True):
+        if passage_split not in PASSAGE_SPLITS:
+            raise ValueError(f"Unknown passage split: {passage_split!r} (expected one of {', '.join(PASSAGE_SPLITS)})")
+        if passage_size and not 0 <= passage_overlap < passage_size:
+            raise ValueError("passage_overlap must be smaller than passage_size")
+        self.db = db
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.passage_size = passage_size
+        self.passage_overlap = passage_overlap
+        self.passage_split = passage_split
+        self.dedup = dedup
+        self.files = queue.Queue(maxsize=max_queue_size)
+        # Bounded so readers slow down instead of piling documents up in memory
+        self.documents = queue.Queue(maxsize=2 * batch_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # Files still being read plus documents waiting to be written
+        self._in_flight = 0
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "files_read": 0,
+            "files_failed": 0,
+            "files_duplicate": 0,
+            "processed": 0,
+            "failed": 0,
+            "duplicates": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+        }
+        self._write_seconds = 0.0
+        self._batched_documents = 0
+        # (filename, stored document ID) of the latest files skipped as duplicates
+        self._recent_duplicates = collections.deque(maxlen=100)
+
+    def start(self):
+        """Start the worker pool and the writer thread (idempotent)."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                self._threads.append(threading.Thread(target=self._read_files, name=f"ingest-reader-{i}", daemon=True))
+            self._writer = threading.Thread(target=self._write_batches, name="ingest-writer", daemon=True)
+            for thread in self._threads + [self._writer]:
+                thread.start()
+        logger.info(f"Started ingestion pipeline with {self.workers} workers")
+
+    def submit(self, path, db=None, remove: bool = False) -> bool:
+        """Queue a file for ingestion into ``db`` (the pipeline's database by default). Returns False if the queue is full.
+
+        With ``remove`` the file is deleted once it has been read.
+        """
+        self.start()
+        with self._lock:
+            try:
+                self.files.put_nowait((path, db if db is not None else self.db, remove))
+            except queue.Full:
+                self._stats["rejected"] += 1
+                INGESTED_FILES.inc(result="rejected")
+                return False
+            self._stats["submitted"] += 1
+            self._in_flight += 1
+        return True
+
+    def _finish(self, count: int, stat: str):
+        if stat in ("files_read", "files_failed", "files_duplicate"):
+            INGESTED_FILES.inc(result=stat[len("files_"):])
+        else:
+            INGESTED_DOCUMENTS.inc(count, result=stat)
+        with self._lock:
+            self._stats[stat] += count
+            self._in_flight -= count
+            if self._in_flight == 0:
+                self._idle.notify_all()
+
+    def _read_files(self):
+        while True:
+            item = self.files.get()
+            if item is None:
+                break
+            path, db, remove = item
+            started = time.perf_counter()
+            try:
+                documents = iter_documents(path, self.passage_size, self.passage_overlap, self.passage_split)
+                first = next(documents, None)
+                stored_as = self._stored_file(db, first[2]) if first is not None else None
+                if stored_as is not None:
+                    self._record_duplicate(os.path.basename(path), stored_as)
+                    self._finish(1, "files_duplicate")
+                    continue
+                for document in itertools.chain([first] if first is not None else [], documents):
+                    with self._lock:
+                        self._in_flight += 1
+                    self.documents.put((db, document))
+                STAGE_SECONDS.observe(time.perf_counter() - started, operation="ingest", stage="read")
+                self._finish(1, "files_read")
+            except Exception as e:
+                logger.error(f"Error processing file {path}: {e}")
+                self._finish(1, "files_failed")
+            finally:
+                if remove:
+                    remove_upload(path)
+
+    def _record_duplicate(self, filename, stored_as):
+        logger.info(f"Skipped {filename}, its content is stored as {stored_as}")
+        with self._lock:
+            self._recent_duplicates.append({"filename": filename, "stored_as": stored_as})
+
+    def _stored_file(self, db, metadata):
+        """ID of a document of ``db`` from a file with the same content, or None."""
+        if not self.dedup or 'file_hash' not in metadata:
+            return None
+        return db.find_by_metadata('file_hash', [metadata['file_hash']]).get(metadata['file_hash'])
+
+    def _write_batches(self):
+        while True:
+            document = self.documents.get()
+            if document is None:
+                break
+            batch = [document]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    document = self.documents.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if document is None:
+                    stop = True
+                    break
+                batch.append(document)
+            self._flush(batch)
+            if stop:
+                break
+
+    def _flush(self, batch):
+        groups = {}
+        for db, document in batch:
+            groups.setdefault(id(db), (db, []))[1].append(document)
+        for db, documents in groups.values():
+            self._store(db, documents)
+
+    def _store(self, db, batch):
+        if self.dedup:
+            metadata = {doc_id: meta for doc_id, _, meta in batch}
+            try:
+                batch, duplicates = drop_duplicates(db, batch)
+            except Exception as e:
+                duplicates = {}
+                logger.error(f"Could not look up duplicates of a batch of {len(batch)} documents: {e}")
+            for doc_id, stored_as in duplicates.items():
+                self._record_duplicate(metadata[doc_id].get('filename', doc_id), stored_as)
+            if duplicates:
+                self._finish(len(duplicates), "duplicates")
+            if not batch:
+                return
+        started = time.monotonic()
+        stored, failed = self._add(db, batch)
+        STAGE_SECONDS.observe(time.monotonic() - started, operation="ingest", stage="write")
+        with self._lock:
+            self._write_seconds += time.monotonic() - started
+            self._batched_documents += len(batch)
+            self._stats["batches"] += 1
+            self._stats["last_batch_size"] = len(batch)
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+        if stored:
+            self._finish(stored, "processed")
+        if failed:
+            self._finish(failed, "failed")
+
+    def _add(self, db, batch):
+        """Add a batch to ``db``. Returns the numbers of documents stored and failed."""
+        ids, contents, metadata = (list(column) for column in zip(*batch))
+        try:
+            db.add_documents(contents, metadata, ids)
+            logger.info(f"Stored batch of {len(batch)} documents")
+            return len(batch), 0
+        except ValueError as e:
+            # A taken ID fails the whole call; the other documents of the batch are stored without it
+            kept = drop_taken_ids(db, batch)
+            if not kept or len(kept) == len(batch):
+                logger.error(f"Failed to store batch of {len(batch)} documents: {e}")
+                return 0, len(batch)
+            logger.warning(f"Rejected {len(batch) - len(kept)} documents of a batch: {e}")
+            stored, failed = self._add(db, kept)
+            return stored, failed + len(batch) - len(kept)
+        except Exception as e:
+            logger.error(f"Failed to store batch of {len(batch)} documents: {e}")
+            return 0, len(batch)
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        """Block until every submitted file has been stored or has failed."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait, estimated from the write throughput."""
+        with self._lock:
+            if not self._stats["processed"] or not self._write_seconds:
+                return 1
+            throughput = self._stats["processed"] / self._write_seconds
+        return min(60, max(1, math.ceil(self.files.qsize() / throughput)))
+
+    def stop(self, timeout: float = 10.0):
+        """Drain the queue and stop all threads."""
+        if not self._threads:
+            return
+        for _ in self._threads:
+            self.files.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self.documents.put(None)
+        self._writer.join(timeout)
+        self._threads = []
+
+    def get_stats(self):
+        """Queue depth and batching statistics."""
+        with self._lock:
+            stats = dict(self._stats)
+            files = stats["files_read"] + stats["files_failed"] + stats["files_duplicate"]
+            documents = stats["processed"] + stats["failed"] + stats["duplicates"]
+            stats.update({
+                "queue_depth": self.files.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "in_flight": self._in_flight,
+                "workers": self.workers,
+                "batch_size": self.batch_size,
+                "flush_interval": self.flush_interval,
+                "passage_size": self.passage_size,
+                "passage_overlap": self.passage_overlap,
+                "passage_split": self.passage_split,
+                "dedup": self.dedup,
+                # Shares of the files and documents skipped as duplicates
+                "duplicate_file_rate": stats["files_duplicate"] / files if files else 0.0,
+                "duplicate_rate": stats["duplicates"] / documents if documents else 0.0,
+                "average_batch_size": self._batched_documents / stats["batches"] if stats["batches"] else 0,
+                "recent_duplicates": list(self._recent_duplicates),
+            })
+        return stats
+
+# Shared pipeline feeding the shared vector database
+pipeline = IngestionPipeline(
+    vector_db,
+    max_queue_size=int(os.getenv("INGEST_QUEUE_SIZE", "100")),
+    workers=int(os.getenv("INGEST_WORKERS", "2")),
+    batch_size=int(os.getenv("INGEST_BATCH_SIZE", "32")),
+    flush_interval=float(os.getenv("INGEST_FLUSH_INTERVAL", "0.5")),
+    passage_size=int(os.getenv("INGEST_PASSAGE_SIZE", "4000")),
+    passage_overlap=int(os.getenv("INGEST_PASSAGE_OVERLAP", "400")),
+    passage_split=os.getenv("INGEST_PASSAGE_SPLIT", "paragraph"),
+    dedup=os.getenv("INGEST_DEDUP", "1").lower() in ("1", "true", "yes"),
+)
+# Store files that are still queued when the process exits
+atexit.register(pipeline.stop)
+QUEUE_DEPTH.set_function(pipeline.files.qsize)
+
+def process_file_background(path, db=None):
+    """Queue an uploaded file for ingestion into ``db`` (the shared database by default) and delete it once read.
+
+    Returns False if the ingestion queue is full.
+    """
     logger.info(f"Queuing file for background processing: {os.path.basename(path)}")
-    thread = threading.Thread(target=process_file, args=(path,), daemon=True)
-    thread.start()
+    return pipeline.submit(path, db, remove=True)
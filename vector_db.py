@@ -1,216 +1,1733 @@
 import numpy as np
+import base64
+import importlib.util
+import itertools
 import json
 import os
-import pickle
-from typing import List, Dict, Any, Optional
-import faiss
-from sklearn.feature_extraction.text import TfidfTransformer
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Dict, Any, Optional, Sequence, Tuple
+from scipy import sparse
 import logging
+from segment_store import ContentList, ReadWriteLock, SegmentStore
+from query_cache import QueryCache, VectorCache, content_hash, normalize_query
+from metadata_index import MetadataIndex, validate_where, where_key
+from metrics import DOCUMENTS, INDEX_VECTORS, STAGE_SECONDS
 
 logger = logging.getLogger(__name__)
 
+def _lazy_import(name: str):
+    """Import a module on first attribute access instead of now."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# Heavy imports are deferred so importing this module (and the app) stays fast;
+# scikit-learn is imported where it is used for the same reason
+faiss = _lazy_import("faiss")
+
+class OnlineTfidfVectorizer:
+    """TF-IDF over a fixed hashed feature space with IDF statistics updated online.
+
+    Unlike ``TfidfVectorizer`` the vector space never changes, so new documents
+    can be vectorized on their own and appended to an existing index.
+    """
+    
+    def __init__(self, n_features: int = 1000, stop_words: Optional[str] = 'english'):
+        from sklearn.feature_extraction.text import HashingVectorizer
+        self.n_features = n_features
+        self.hasher = HashingVectorizer(n_features=n_features, stop_words=stop_words,
+                                        alternate_sign=False, norm=None)
+        self.reset()
+        
+    def reset(self):
+        """Forget all document frequency statistics."""
+        self.doc_freq = np.zeros(self.n_features, dtype=np.int64)
+        self.n_docs = 0
+        self._idf = None
+        
+    @property
+    def idf_(self) -> np.ndarray:
+        """Smoothed IDF weights, matching ``TfidfTransformer(smooth_idf=True)``."""
+        if self._idf is None:
+            self._idf = np.log((1 + self.n_docs) / (1 + self.doc_freq)) + 1
+        return self._idf
+        
+    def count(self, raw_documents: List[str]) -> sparse.csr_matrix:
+        """Hash documents into raw term counts."""
+        counts = self.hasher.transform(raw_documents)
+        counts.sum_duplicates()
+        return counts
+        
+    def update(self, counts: sparse.csr_matrix):
+        """Fold the document frequencies of ``counts`` into the IDF statistics."""
+        np.add.at(self.doc_freq, counts.indices, 1)
+        self.n_docs += counts.shape[0]
+        self._idf = None
+        
+    def weight(self, counts: sparse.csr_matrix) -> sparse.csr_matrix:
+        """Apply the current IDF weights to raw counts and L2-normalize the rows."""
+        from sklearn.preprocessing import normalize
+        tfidf = counts.astype(np.float64)
+        tfidf.data *= self.idf_[tfidf.indices]
+        return normalize(tfidf, norm='l2', copy=False)
+        
+    def partial_fit_transform(self, raw_documents: List[str]) -> sparse.csr_matrix:
+        """Update the IDF statistics with new documents and return their TF-IDF vectors."""
+        counts = self.count(raw_documents)
+        self.update(counts)
+        return self.weight(counts)
+        
+    def fit_transform(self, raw_documents: List[str]) -> sparse.csr_matrix:
+        self.reset()
+        return self.partial_fit_transform(raw_documents)
+        
+    def transform(self, raw_documents: List[str]) -> sparse.csr_matrix:
+        return self.weight(self.count(raw_documents))
+
+class SparseIndex:
+    """Inverted index over sparse document vectors.
+    
+    Postings are stored column-wise (CSC, one column per term) in size-tiered
+    segments, so scoring a query only touches the postings of its terms.
+    Mirrors the part of the FAISS index API used by ``VectorDatabase``:
+    ``ntotal``, ``is_trained``, ``add`` and ``search``.
+    
+    With ``scoring="cosine"`` the added rows are expected to be L2-normalized
+    TF-IDF vectors and scores are inner products. With ``scoring="bm25"`` the
+    added rows are raw term counts and BM25 is computed at query time from the
+    index's own document frequencies and lengths.
+    """
+    
+    is_trained = True  # nothing to train
+    
+    def __init__(self, d: int, scoring: str = "cosine", k1: float = 1.2, b: float = 0.75,
+                 flush_threshold: int = 1024):
+        if scoring not in ("cosine", "bm25"):
+            raise ValueError(f"Unknown scoring function: {scoring}")
+        self.d = d
+        self.scoring = scoring
+        self.k1 = k1
+        self.b = b
+        self.flush_threshold = flush_threshold
+        self.reset()
+        
+    def reset(self):
+        self.segments = []  # CSC matrices, oldest (largest) first
+        self.segment_lengths = []  # document lengths per segment
+        self.pending = []  # recently added CSR rows not yet in a segment
+        self.pending_lengths = []
+        self.pending_rows = 0
+        self.doc_freq = np.zeros(self.d, dtype=np.int64)
+        self.total_length = 0.0
+        self._pending_segment = None
+        
+    @property
+    def ntotal(self) -> int:
+        return sum(segment.shape[0] for segment in self.segments) + self.pending_rows
+        
+    def memory_bytes(self) -> int:
+        """Bytes held by the postings and statistics."""
+        matrices = self.segments + self.pending
+        return (sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in matrices)
+                + sum(lengths.nbytes for lengths in self.segment_lengths + self.pending_lengths)
+                + self.doc_freq.nbytes)
+        
+    def add(self, vectors):
+        """Append document vectors (rows of a sparse matrix)."""
+        vectors = sparse.csr_matrix(vectors, dtype=np.float32)
+        vectors.sum_duplicates()
+        lengths = np.asarray(vectors.sum(axis=1), dtype=np.float32).ravel()
+        np.add.at(self.doc_freq, vectors.indices, 1)
+        self.total_length += float(lengths.sum())
+        self.pending.append(vectors)
+        self.pending_lengths.append(lengths)
+        self.pending_rows += vectors.shape[0]
+        self._pending_segment = None
+        if self.pending_rows >= self.flush_threshold:
+            self._flush()
+            
+    def _flush(self):
+        """Turn pending rows into a segment and merge equally sized segments."""
+        if not self.pending:
+            return
+        self.segments.append(sparse.vstack(self.pending, format='csc'))
+        self.segment_lengths.append(np.concatenate(self.pending_lengths))
+        self.pending, self.pending_lengths, self.pending_rows = [], [], 0
+        self._pending_segment = None
+        # Binary-counter merging keeps O(log n) segments with O(log n) amortized cost per row
+        while len(self.segments) > 1 and self.segments[-2].shape[0] <= 2 * self.segments[-1].shape[0]:
+            newer, newer_lengths = self.segments.pop(), self.segment_lengths.pop()
+            older, older_lengths = self.segments.pop(), self.segment_lengths.pop()
+            self.segments.append(sparse.vstack([older, newer], format='csc'))
+            self.segment_lengths.append(np.concatenate([older_lengths, newer_lengths]))
+            
+    def _all_segments(self):
+        """Yield (segment, lengths, row offset) for every segment including pending rows."""
+        offset = 0
+        for segment, lengths in zip(self.segments, self.segment_lengths):
+            yield segment, lengths, offset
+            offset += segment.shape[0]
+        if self.pending:
+            if self._pending_segment is None:
+                self._pending_segment = (sparse.vstack(self.pending, format='csc'),
+                                         np.concatenate(self.pending_lengths))
+            yield self._pending_segment[0], self._pending_segment[1], offset
+            
+    def _score(self, terms: np.ndarray, weights: np.ndarray):
+        """Score every document that shares a term with the query."""
+        n_docs = self.ntotal
+        if self.scoring == "bm25":
+            df = self.doc_freq[terms]
+            weights = weights * np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            avg_length = self.total_length / n_docs
+            
+        rows, contributions = [], []
+        for segment, lengths, offset in self._all_segments():
+            postings = segment[:, terms]
+            if postings.nnz == 0:
+                continue
+            term_weights = np.repeat(weights, np.diff(postings.indptr))
+            tf = postings.data
+            if self.scoring == "bm25":
+                norm = self.k1 * (1 - self.b + self.b * lengths[postings.indices] / avg_length)
+                tf = tf * (self.k1 + 1) / (tf + norm)
+            rows.append(postings.indices + offset)
+            contributions.append(tf * term_weights)
+            
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        candidates, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        return candidates.astype(np.int64), scores.astype(np.float32)
+        
+    def search(self, queries, k: int, exclude: Optional[np.ndarray] = None, include: Optional[np.ndarray] = None):
+        """Return the top-k (scores, row indices) per query row, padded with -1 like FAISS.
+        
+        Rows listed in ``exclude`` are never returned, and with ``include``
+        only the rows it lists are.
+        """
+        queries = sparse.csr_matrix(queries, dtype=np.float32)
+        queries.sum_duplicates()
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        all_indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        if self.ntotal == 0:
+            return all_scores, all_indices
+            
+        for i in range(queries.shape[0]):
+            start, end = queries.indptr[i], queries.indptr[i + 1]
+            candidates, scores = self._score(queries.indices[start:end], queries.data[start:end])
+            if exclude is not None and len(exclude):
+                allowed = ~np.isin(candidates, exclude)
+                candidates, scores = candidates[allowed], scores[allowed]
+            if include is not None:
+                allowed = np.isin(candidates, include)
+                candidates, scores = candidates[allowed], scores[allowed]
+            if len(candidates) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                candidates, scores = candidates[top], scores[top]
+            order = np.argsort(-scores, kind='stable')
+            all_scores[i, :len(order)] = scores[order]
+            all_indices[i, :len(order)] = candidates[order]
+        return all_scores, all_indices
+
+# Fields of a stored document, in the order listings report them
+DOCUMENT_FIELDS = ("id", "content", "metadata")
+
+@contextmanager
+def _timed(timings: List[Tuple[str, float]], stage: str):
+    """Append the duration of the ``with`` block to ``timings``, to be observed once no lock is held."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((stage, time.perf_counter() - started))
+
 class VectorDatabase:
-    """Vector database using FAISS for efficient similarity search."""
+    """Vector database using FAISS for efficient similarity search.
+    
+    Documents live in a ``SegmentStore`` that several processes can share;
+    only the IDs and the index are held in memory. The options match the
+    ``VECTOR_DB_*`` settings, see README_VECTOR.md for them and for how
+    writes, maintenance and searches interact.
+    """
+    
+    INDEX_TYPES = ("auto", "flat", "ivf", "ivfpq", "hnsw")
+    COMPRESSIONS = ("none", "fp16", "sq8", "pq")
+    # Rows a process may index privately before it publishes a new snapshot
+    snapshot_interval = 1024
+    # Training points FAISS asks for per IVF list (and per PQ centroid)
+    ivf_min_points = 39
+    # Below this many rows re-fitting is cheap: no drift-triggered re-fits, and
+    # without incremental mode every write re-fits in place
+    refit_min_rows = 1000
+    # New term occurrences needed before their out-of-vocabulary rate counts
+    refit_min_terms = 1000
     
-    def __init__(self, persist_directory: str = "vector_db"):
+    def __init__(self, persist_directory: str = "vector_db", incremental: bool = True,
+                 backend: str = "faiss", scoring: str = "cosine", compaction_threshold: float = 0.2,
+                 shared_index: bool = False, index_type: str = "flat", ann_threshold: int = 100_000,
+                 nprobe: int = 8, ef_search: int = 64, cache_size: int = 1024,
+                 cache_bytes: int = 64 * 1024 * 1024, cache_ttl: float = 300.0, lazy: bool = False,
+                 dimension: Optional[int] = None, compression: str = "none", rerank: int = 0,
+                 vector_cache_bytes: int = 64 * 1024 * 1024, refit_growth: float = 0.25,
+                 refit_oov: float = 0.1, refit_interval: float = 0.0, durability: str = "write",
+                 commit_writes: int = 64, commit_interval: float = 1.0):
+        if backend not in ("faiss", "sparse"):
+            raise ValueError(f"Unknown index backend: {backend}")
+        if scoring == "bm25" and (backend != "sparse" or not incremental):
+            raise ValueError("BM25 scoring requires backend='sparse' and incremental=True")
+        if index_type not in self.INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type}")
+        if backend == "sparse" and index_type not in ("auto", "flat"):
+            raise ValueError("Approximate index types require backend='faiss'")
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Unknown vector compression: {compression}")
+        if backend == "sparse" and compression != "none":
+            raise ValueError("Vector compression requires backend='faiss'")
         self.persist_directory = persist_directory
-        self.documents = []
-        self.metadata = []
+        self.incremental = incremental
+        self.backend = backend
+        self.scoring = scoring
+        self.compaction_threshold = compaction_threshold
+        # Snapshots hold uncompressed flat indexes
+        self.shared_index = shared_index and backend == "faiss" and incremental and compression == "none"
+        self.index_type = index_type
+        self.ann_threshold = ann_threshold
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.compression = compression
+        self.rerank = rerank
+        self.refit_growth = refit_growth
+        self.refit_oov = refit_oov
+        self.refit_interval = refit_interval
+        self._refit_timer = None
+        self.documents = ContentList()  # bodies, read from disk on access
+        self.metadata = ContentList()  # metadata, decoded on access
         self.document_ids = []
-        self.vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
-        self.index = None
-        self.dimension = 1000  # TF-IDF max_features
+        self._id_to_row = {}  # document ID -> row of its live copy
+        self._tombstones = set()  # rows of deleted documents
+        self._excluded = None  # cached array of self._tombstones for searches
+        self._write_lock = threading.RLock()  # serializes writers
+        self._state_lock = ReadWriteLock()  # shared by readers, exclusive while a writer changes the state
+        self._counts = (0, 0)  # live documents and index rows as of the last change, read without locking
+        self._maintenance_thread = None
+        # Dense vectors need a small TF-IDF space; the sparse backend can afford a large one
+        self.dimension = dimension or (2 ** 20 if backend == "sparse" else 1000)
+        self.vectorizer = None  # created by warm_up
+        self.index = None  # in shared mode only the rows after the snapshot
+        self._base_index = None  # memory-mapped snapshot of the first rows
+        self._snapshot = None  # name of the mapped snapshot
+        self._generation = None  # store generation the in-memory state matches
+        self._epoch = None
+        self._refits = 0
+        self._mark_fitted()
+        self._query_cache = QueryCache(cache_size, cache_bytes, cache_ttl)
+        self._vector_cache = VectorCache(vector_cache_bytes)  # content hash -> term counts
+        self._metadata_index = None  # built by the first filtered search
+        self._metadata_lock = threading.Lock()
+        self._loaded = False
         
-        # Create persist directory if it doesn't exist
-        os.makedirs(persist_directory, exist_ok=True)
+        # Append-only segment storage in the persist directory
+        self.store = SegmentStore(persist_directory, durability=durability, commit_writes=commit_writes,
+                                  commit_interval=commit_interval)
         
-        # Load existing data if available
-        self._load_data()
+        if not lazy:
+            self.warm_up()
+        
+    @property
+    def ready(self) -> bool:
+        """Whether the documents and the index have been loaded."""
+        return self._loaded
+        
+    def warm_up(self):
+        """Load the documents and the index, unless they are loaded already.
+        
+        Meant to run once per process before it serves requests, e.g. from a
+        gunicorn ``post_worker_init`` hook.
+        """
+        if self._loaded:
+            return
+        with self._write_lock:
+            if self._loaded:
+                return
+            started = time.monotonic()
+            with self._applying():
+                # Readers that see the flag wait for the lock until the data is loaded
+                self._loaded = True
+                self._reset()
+                self._load_data()
+            if self.refit_interval and self._refit_timer is None:
+                self._refit_timer = threading.Thread(target=self._refit_periodically, name="vector-db-refit", daemon=True)
+                self._refit_timer.start()
+        logger.info(f"Vector database ready in {time.monotonic() - started:.2f}s "
+                    f"with {self.get_document_count()} documents")
         
     def add_documents(self, documents: List[str], metadata: List[Dict[str, Any]] = None, ids: List[str] = None):
-        """Add documents to the FAISS vector database."""
+        """Add documents to the FAISS vector database.
+        
+        Document IDs are unique: raises ValueError, without adding anything,
+        if an ID is already stored or repeated in ``ids``. Use
+        ``update_document`` to replace a document.
+        """
         if metadata is None:
             metadata = [{}] * len(documents)
         
-        if ids is None:
-            ids = [f"doc_{len(self.documents) + i}" for i in range(len(documents))]
+        counts = self._tokenize(documents)
+        self._store_documents(documents, metadata, ids, counts)
         
-        # Add to existing documents
+        logger.info(f"Added {len(documents)} documents to FAISS vector database")
+        self._maybe_maintain()
+        
+    def _tokenize(self, documents: List[str]) -> Optional[sparse.csr_matrix]:
+        """Term counts of documents about to be added; None outside incremental mode."""
+        self.warm_up()
+        # Raw term counts are persisted with the documents in incremental mode
+        with STAGE_SECONDS.time(operation="write", stage="tokenize"):
+            return self._count(documents) if self.incremental else None
+        
+    def _store_documents(self, documents: List[str], metadata: List[Dict[str, Any]], ids: Optional[List[str]],
+                         counts: Optional[sparse.csr_matrix]):
+        """Persist and index documents tokenized by ``_tokenize``; the second half of ``add_documents``."""
+        with self._write_lock:
+            # Holding the store lock keeps other processes from adding the same IDs meanwhile
+            with self.store.lock:
+                self.refresh()
+                if ids is None:
+                    ids = self._new_ids(len(documents))
+                self._check_new_ids(ids)
+                # Persist only the new documents
+                with STAGE_SECONDS.time(operation="write", stage="persist"):
+                    stored_at = self.store.append(ids, documents, metadata, counts)
+                columns = self.store.columns(epoch=self._epoch)
+                generation = self.store.generation
+            first_row = len(self.documents)
+            if stored_at != (self._epoch, first_row) or columns is None:
+                # Another process wrote in between, pick these rows up with its rows
+                self.refresh()
+            else:
+                with self._applying(generation):
+                    # Add to existing documents, whose bodies and metadata are now read from the store
+                    self.documents, self.metadata = columns
+                    self.document_ids.extend(ids)
+                    for row, doc_id in enumerate(ids, start=first_row):
+                        self._id_to_row[doc_id] = row
+                    
+                    started = time.perf_counter()
+                    self._index_new_rows(documents, counts, first_row)
+                # Observed outside the state lock, recording a metric takes the registry lock
+                STAGE_SECONDS.observe(time.perf_counter() - started, operation="write", stage="index")
+        
+    @contextmanager
+    def _applying(self, generation: Optional[int] = None):
+        """Hold the state lock exclusively while a writer changes the in-memory state.
+        
+        The counts reported without locking are updated when the change is
+        complete. A writer applying its own store change passes the store
+        generation it read under the store lock, so cached results from
+        before the change are not served.
+        """
+        with self._state_lock.write():
+            yield
+            self._counts = (len(self.documents) - len(self._tombstones), self._index_rows())
+            if generation is not None:
+                self._generation = generation
+        
+    def _new_ids(self, n: int) -> List[str]:
+        """Generate ``n`` IDs that are not in use."""
+        ids = []
+        number = len(self.documents)
+        while len(ids) < n:
+            doc_id = f"doc_{number}"
+            if doc_id not in self._id_to_row:
+                ids.append(doc_id)
+            number += 1
+        return ids
+        
+    def _check_new_ids(self, ids: List[str]):
+        """Raise ValueError if any of the IDs is taken or repeated."""
+        duplicates = {doc_id for doc_id in ids if doc_id in self._id_to_row}
+        if len(set(ids)) != len(ids):
+            seen = set()
+            for doc_id in ids:
+                if doc_id in seen:
+                    duplicates.add(doc_id)
+                seen.add(doc_id)
+        if duplicates:
+            raise ValueError(f"Document IDs already exist: {', '.join(sorted(duplicates))}")
+        
+    def refresh(self, wait: bool = True) -> bool:
+        """Catch up with changes other processes made to the store.
+        
+        Costs a single memory read when nothing changed. Otherwise only the
+        rows appended and deleted since are read, unless the rows were
+        renumbered, which forces a full reload. With ``wait=False`` nothing
+        is done while another thread of this process is writing, so readers
+        go on with the state they have. Returns whether anything changed.
+        """
+        if not self._loaded:
+            self.warm_up()
+        if self.store.generation == self._generation:
+            return False
+        if not self._write_lock.acquire(blocking=wait):
+            return False
+        try:
+            generation = self.store.refresh()
+            if generation == self._generation:
+                return False
+            if self.store.epoch != self._epoch:
+                with self._applying():
+                    self._reload()
+                return True
+            
+            appended = None
+            if self.store.row_count > len(self.documents):
+                ids, documents, metadata, counts = self.store.read_rows(len(self.documents))
+                if self.incremental and (counts is None or counts.shape[1] != self.dimension):
+                    # Tokenized before readers are locked out
+                    counts = self._count(documents)
+                appended = ids, documents, metadata, counts
+            deleted = self.store.deleted_rows() - self._tombstones if self.store.deleted_count != len(self._tombstones) else None
+            with self._applying():
+                if appended is not None:
+                    self._append_rows(*appended)
+                if deleted is not None:
+                    for row in deleted:
+                        self._tombstones.add(row)
+                        if self._id_to_row.get(self.document_ids[row]) == row:
+                            del self._id_to_row[self.document_ids[row]]
+                    self._excluded = None
+                self._map_snapshot()
+                # Segments may have been merged, stop reading rows from the replaced files
+                columns = self.store.columns(len(self.documents), self._epoch)
+                if columns is not None:
+                    self.documents, self.metadata = columns
+                self._generation = generation
+        finally:
+            self._write_lock.release()
+        return True
+        
+    def _append_rows(self, ids: List[str], documents: ContentList, metadata: ContentList,
+                     counts: Optional[sparse.csr_matrix]):
+        """Add rows another process stored to the in-memory state and the index."""
+        first_row = len(self.documents)
         self.documents.extend(documents)
         self.metadata.extend(metadata)
         self.document_ids.extend(ids)
+        for row, doc_id in enumerate(ids, start=first_row):
+            self._id_to_row[doc_id] = row
+        self._index_new_rows(documents, counts, first_row)
+        logger.info(f"Picked up {len(documents)} documents stored by another process")
         
-        # Rebuild FAISS index with all documents
-        self._rebuild_index()
+    def _reload(self):
+        """Replace the in-memory state with a fresh replay of the store."""
+        self._reset()
+        self._load_data()
         
-        # Persist the data
-        self._save_data()
+    def _reset(self):
+        self.documents = ContentList()
+        self.metadata = ContentList()
+        self.document_ids = []
+        self._id_to_row = {}
+        self._tombstones = set()
+        self._excluded = None
+        self.vectorizer = self._new_vectorizer()
+        self.index = None
+        self._base_index = None
+        self._snapshot = None
+        self._metadata_index = None
+        self._mark_fitted()
         
-        logger.info(f"Added {len(documents)} documents to FAISS vector database")
+    def _mark_fitted(self):
+        """Restart the drift statistics after the vectorizer was fitted to the current rows."""
+        self._fitted_rows = len(self.documents)
+        self._fitted_at = time.monotonic()
+        # Hashed terms the IDF statistics knew at the fit
+        self._fitted_terms = self.vectorizer.doc_freq > 0 if self.incremental and self.vectorizer is not None else None
+        self._new_terms = 0
+        self._oov_terms = 0
+        
+    def _new_vectorizer(self):
+        """Create an unfitted vectorizer for the configured indexing mode."""
+        if self.incremental:
+            return OnlineTfidfVectorizer(n_features=self.dimension, stop_words='english')
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        return TfidfVectorizer(max_features=self.dimension, stop_words='english')
+        
+    def _new_index(self, dimension: int, n_rows: int = 0):
+        """Create an empty index for the configured backend, suited to ``n_rows`` vectors.
+        
+        IVF indexes are returned untrained.
+        """
+        if self.backend == "sparse":
+            return SparseIndex(dimension, scoring=self.scoring)
+        kind = self._index_kind_for(n_rows)
+        compression = self._compression_for(kind, n_rows)
+        codes = {"none": "Flat", "fp16": "SQfp16", "sq8": "SQ8",
+                 "pq": f"PQ{self._pq_subquantizers(dimension)}"}[compression]
+        if kind == "flat":
+            if compression == "none":
+                return faiss.IndexFlatIP(dimension)  # Inner Product (cosine similarity)
+            # "np": no polysemous training, which is slow and only helps Hamming-distance search
+            return faiss.index_factory(dimension, codes + "np" if compression == "pq" else codes,
+                                       faiss.METRIC_INNER_PRODUCT)
+        if kind == "hnsw":
+            spec = "HNSW32" if compression == "none" else f"HNSW32_{codes}" if compression == "pq" else f"HNSW32,{codes}"
+            index = faiss.index_factory(dimension, spec, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = self.ef_search
+            return index
+        index = faiss.index_factory(dimension, f"IVF{self._nlist(n_rows)},{codes}", faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = self.nprobe
+        if kind == "ivfpq":
+            # Polysemous codes are never searched, and training them is slow
+            index.do_polysemous_training = False
+        return index
+        
+    def _index_kind_for(self, n_rows: int) -> str:
+        """The index type to use for ``n_rows`` vectors."""
+        kind = self.index_type
+        if kind == "auto":
+            kind = "ivf" if n_rows >= self.ann_threshold else "flat"
+        # Fall back until there are enough vectors to train the quantizers
+        if kind == "ivfpq" and n_rows < 256 * self.ivf_min_points:
+            kind = "ivf"
+        if kind == "ivf" and n_rows < self.ivf_min_points * self._nlist(n_rows):
+            kind = "flat"
+        # IVF lists of PQ codes are an IVF-PQ index
+        if kind == "ivf" and self._compression_for(kind, n_rows) == "pq":
+            kind = "ivfpq"
+        return kind
+        
+    def _compression_for(self, kind: str, n_rows: int) -> str:
+        """How an index of ``kind`` over ``n_rows`` vectors stores them."""
+        if kind == "ivfpq":
+            return "pq"
+        if self.compression == "pq" and n_rows < 256 * self.ivf_min_points:
+            # Too few vectors to train the PQ codebooks yet
+            return "sq8"
+        return self.compression
+        
+    @staticmethod
+    def _index_compression(index) -> str:
+        """How a live FAISS index stores its vectors."""
+        if isinstance(index, faiss.IndexHNSW):
+            index = faiss.downcast_index(index.storage)
+        if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+            return "pq"
+        if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+            return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+        return "none"
+        
+    def _index_memory(self, index) -> Tuple[float, int]:
+        """Approximate (bytes per vector, total bytes) of an index."""
+        if self.backend == "sparse":
+            total = index.memory_bytes()
+            return (total / index.ntotal if index.ntotal else 0.0), total
+        kind = self._index_kind(index)
+        storage = faiss.downcast_index(index.storage) if kind == "hnsw" else index
+        per_vector = float(storage.code_size)
+        fixed = 0
+        if kind in ("ivf", "ivfpq"):
+            per_vector += 8  # the row number stored next to each code in its list
+            fixed += index.nlist * index.d * 4  # centroids
+        if kind == "hnsw" and index.ntotal:
+            per_vector += index.hnsw.neighbors.size() * 4 / index.ntotal
+        if self._index_compression(index) == "pq":
+            fixed += 256 * index.d * 4  # codebooks
+        return per_vector, int(per_vector * index.ntotal) + fixed
+        
+    @staticmethod
+    def _index_kind(index) -> str:
+        """The index type of a live FAISS index."""
+        if isinstance(index, faiss.IndexIVFPQ):
+            return "ivfpq"
+        if isinstance(index, faiss.IndexIVF):
+            return "ivf"
+        if isinstance(index, faiss.IndexHNSW):
+            return "hnsw"
+        return "flat"
+        
+    @staticmethod
+    def _nlist(n_rows: int) -> int:
+        """Number of IVF lists for ``n_rows`` vectors."""
+        return int(min(max(np.sqrt(n_rows), 1), 65536))
+        
+    @staticmethod
+    def _pq_subquantizers(dimension: int) -> int:
+        """Largest divisor of ``dimension`` giving PQ subvectors of at least 8 dimensions."""
+        return next(m for m in range(max(dimension // 8, 1), 0, -1) if dimension % m == 0)
+        
+    def _train_and_add(self, index, vectors):
+        if not index.is_trained:
+            if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexHNSW)) and self._index_compression(index) == "sq8":
+                # Weights of L2-normalized TF-IDF rows lie in [0, 1]: quantize that range, not the first batch's
+                index.train(np.vstack([np.zeros(index.d), np.ones(index.d)]).astype(np.float32))
+            else:
+                index.train(vectors)
+        index.add(vectors)
+        
+    def _count(self, documents) -> sparse.csr_matrix:
+        """Term counts of ``documents``, tokenizing only content the vector cache does not hold."""
+        parts = []
+        documents = iter(documents)
+        while True:
+            # In chunks, so a rebuild does not hold every body in memory
+            chunk = list(itertools.islice(documents, 1024))
+            if not chunk:
+                break
+            hashes = [content_hash(document) for document in chunk]
+            known = self._vector_cache.get_many(dict.fromkeys(hashes))
+            missing = {key: document for key, document in zip(hashes, chunk) if key not in known}
+            if missing:
+                counts = self.vectorizer.count(list(missing.values()))
+                fresh = [(key, counts[row]) for row, key in enumerate(missing)]
+                self._vector_cache.put_many(fresh)
+                known.update(fresh)
+            parts.append(sparse.vstack([known[key] for key in hashes], format='csr'))
+        return sparse.vstack(parts, format='csr') if parts else self.vectorizer.count([])
+        
+    def _weighted(self, counts: sparse.csr_matrix):
+        """Turn raw term counts into the vectors stored in the index."""
+        return counts if self.scoring == "bm25" else self.vectorizer.weight(counts)
+        
+    def _query_vectors(self, query_texts: List[str]):
+        """Vectorize query texts into the representation the index searches."""
+        if self.scoring == "bm25":
+            return self._prepare(self.vectorizer.count(query_texts))
+        return self._prepare(self.vectorizer.transform(query_texts))
+        
+    def _prepare(self, vectors):
+        """Convert sparse vectors into the input format of the index."""
+        if self.backend == "sparse":
+            return vectors
+        # Convert sparse matrix to dense for FAISS and normalize for cosine similarity
+        vectors = vectors.toarray().astype(np.float32)
+        faiss.normalize_L2(vectors)
+        return vectors
+        
+    def _distance(self, score: float) -> float:
+        """Convert a similarity score into a distance (smaller is closer)."""
+        if self.scoring == "bm25":
+            # BM25 scores are unbounded, map them into (0, 1]
+            return 1 / (1 + score)
+        return 1 - score
+        
+    def _index_new_rows(self, documents, counts: Optional[sparse.csr_matrix], first_row: int):
+        """Vectorize and index rows just appended at ``first_row``; ``counts`` are theirs in incremental mode."""
+        if self.index is None:
+            self._rebuild_index(counts if first_row == 0 else None)
+        elif self.incremental:
+            # Only the new documents need to be vectorized and indexed
+            self._index_counts(counts)
+        elif len(self.documents) < self.refit_min_rows:
+            self._rebuild_index()
+        else:
+            # Weighted with the current vocabulary until the next re-fit
+            self.index.add(self._prepare(self.vectorizer.transform(documents)))
+        
+    def _index_counts(self, counts: sparse.csr_matrix):
+        """Fold new documents' term counts into the IDF statistics and append them to the index."""
+        if self._fitted_terms is not None:
+            self._new_terms += int(counts.data.sum())
+            self._oov_terms += int(counts.data[~self._fitted_terms[counts.indices]].sum())
+        self.vectorizer.update(counts)
+        self.index.add(self._prepare(self._weighted(counts)))
+        logger.info(f"Indexed {counts.shape[0]} new documents incrementally")
+        
+    def _build_index(self, documents: List[str], counts: Optional[sparse.csr_matrix] = None):
+        """Fit a new vectorizer and build a new index over ``documents``.
+        
+        The live vectorizer and index are left untouched. In incremental mode
+        ``counts`` may hold the term counts of the documents (e.g. replayed from
+        storage) so they do not have to be re-tokenized. Returns
+        ``(vectorizer, index)``.
+        """
+        vectorizer = self._new_vectorizer()
+        if self.incremental:
+            if counts is None:
+                counts = self._count(documents)
+            vectorizer.update(counts)
+            vectors = counts if self.scoring == "bm25" else vectorizer.weight(counts)
+        else:
+            vectors = vectorizer.fit_transform(documents)
+        vectors = self._prepare(vectors)
+        index = self._new_index(vectors.shape[1], vectors.shape[0])
+        self._train_and_add(index, vectors)
+        return vectorizer, index
         
-    def _rebuild_index(self):
-        """Rebuild FAISS index for all documents."""
+    def _rebuild_index(self, counts: Optional[sparse.csr_matrix] = None):
+        """Rebuild the index for all documents, tombstoned rows included."""
+        self._base_index = None
+        self._snapshot = None
         if not self.documents:
+            self.index = None
             return
-            
-        # Create TF-IDF vectors
-        tfidf_vectors = self.vectorizer.fit_transform(self.documents)
+        self.vectorizer, self.index = self._build_index(self.documents, counts)
+        self._excluded = None
+        self._mark_fitted()
+        logger.info(f"Rebuilt {self.backend} index for {len(self.documents)} documents")
         
-        # Convert sparse matrix to dense for FAISS
-        vectors = tfidf_vectors.toarray().astype(np.float32)
+    def _search(self, vectors, k: int, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                rows: Optional[np.ndarray] = None):
+        """Search the index, excluding tombstoned rows.
         
-        # Create FAISS index
-        self.index = faiss.IndexFlatIP(vectors.shape[1])  # Inner Product (cosine similarity)
+        ``nprobe`` (IVF) and ``ef_search`` (HNSW) override the index defaults
+        for this search; other index types ignore them. With ``rows`` (sorted
+        live rows, e.g. from ``_filter_rows``) only those rows are searched.
+        """
+        if self._tombstones and self._excluded is None:
+            self._excluded = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+        if self._base_index is None:
+            return self._search_part(self.index, 0, vectors, k, nprobe, ef_search, rows)
+        # A mapped snapshot holds the first rows, the private index the rest
+        base_rows = self._base_index.ntotal
+        scores, indices = self._search_part(self._base_index, 0, vectors, k, rows=rows)
+        if not self.index.ntotal:
+            return scores, indices
+        delta_scores, delta_indices = self._search_part(self.index, base_rows, vectors, k, rows=rows)
+        delta_indices = np.where(delta_indices == -1, -1, delta_indices + base_rows)
+        scores = np.hstack([scores, delta_scores])
+        indices = np.hstack([indices, delta_indices])
+        order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
         
-        # Normalize vectors for cosine similarity
-        faiss.normalize_L2(vectors)
+    def _search_part(self, index, offset: int, vectors, k: int, nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None, rows: Optional[np.ndarray] = None):
+        """Search an index holding the rows from ``offset`` on, excluding their tombstones."""
+        excluded = self._excluded if self._tombstones else None
+        if rows is not None:
+            # The allowed rows are live ones, no need to exclude tombstones as well
+            excluded = None
+            rows = rows[(rows >= offset) & (rows < offset + index.ntotal)] - offset
+            if not len(rows):
+                return (np.full((vectors.shape[0], k), -np.inf, dtype=np.float32),
+                        np.full((vectors.shape[0], k), -1, dtype=np.int64))
+        if excluded is not None and offset:
+            excluded = excluded[excluded >= offset] - offset
+        if excluded is not None and not len(excluded):
+            excluded = None
+        if self.backend == "sparse":
+            return index.search(vectors, k, exclude=excluded, include=rows)
         
-        # Add vectors to index
-        self.index.add(vectors)
+        kind = self._index_kind(index)
+        if kind in ("ivf", "ivfpq"):
+            params = faiss.SearchParametersIVF(nprobe=nprobe or index.nprobe)
+        elif kind == "hnsw":
+            params = faiss.SearchParametersHNSW(efSearch=ef_search or index.hnsw.efSearch)
+        elif excluded is not None or rows is not None:
+            params = faiss.SearchParameters()
+        else:
+            return index.search(vectors, k)
+        if rows is not None:
+            selector = faiss.IDSelectorBatch(rows)
+            params.sel = selector
+        elif excluded is not None:
+            excluded = faiss.IDSelectorBatch(excluded)
+            selector = faiss.IDSelectorNot(excluded)
+            params.sel = selector
+        return index.search(vectors, k, params=params)
         
-        logger.info(f"Rebuilt FAISS index for {len(self.documents)} documents")
+    def _filter_rows(self, where: Dict[str, Any]) -> np.ndarray:
+        """Sorted live rows whose metadata matches ``where``."""
+        with self._metadata_lock:
+            metadata_index = self._metadata_index
+            metadata = self.metadata
+            if metadata_index is None or metadata_index.rows > len(metadata):
+                # Not built yet, or built before a compaction renumbered the rows
+                metadata_index = MetadataIndex()
+            if metadata_index.rows < len(metadata):
+                metadata_index.add(metadata[metadata_index.rows:])
+            self._metadata_index = metadata_index
+            rows = metadata_index.candidates(where)
+        if self._tombstones:
+            if self._excluded is None:
+                self._excluded = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+            rows = rows[~np.isin(rows, self._excluded)]
+        return rows
         
-    def query(self, query_text: str, n_results: int = 5) -> Dict[str, Any]:
-        """Query the FAISS vector database for similar documents."""
-        if not self.documents or self.index is None:
-            return {
-                "documents": [],
-                "metadata": [],
-                "ids": [],
-                "distances": []
-            }
+    def _index_rows(self) -> int:
+        """Number of rows in the index, the mapped snapshot included."""
+        rows = self.index.ntotal if self.index is not None else 0
+        return rows + (self._base_index.ntotal if self._base_index is not None else 0)
+        
+    def _map_snapshot(self):
+        """Switch to the latest published index snapshot, if it is newer than the mapped one.
+        
+        The snapshot is memory-mapped read-only, so every process shares the
+        same pages, and only the rows added after it stay in the private index.
+        """
+        snapshot = self.store.index_snapshot
+        if (not self.shared_index or not snapshot or snapshot["name"] == self._snapshot
+                or snapshot["epoch"] != self._epoch or self.index is None
+                or self._index_kind(self.index) != "flat"):
+            return
+        base_rows = self._base_index.ntotal if self._base_index is not None else 0
+        if not base_rows < snapshot["rows"] <= self._index_rows():
+            return
+        base = self._read_snapshot(snapshot)
+        if base is None:
+            return
+        start = snapshot["rows"] - base_rows
+        delta = faiss.IndexFlatIP(self.dimension)
+        if self.index.ntotal > start:
+            delta.add(self.index.reconstruct_n(start, self.index.ntotal - start))
+        self._base_index, self.index, self._snapshot = base, delta, snapshot["name"]
+        logger.info(f"Mapped index snapshot {snapshot['name']} of {snapshot['rows']} rows")
         
-        # Transform query using the same vectorizer
-        query_vector = self.vectorizer.transform([query_text]).toarray().astype(np.float32)
+    def publish_snapshot(self) -> bool:
+        """Write the index to a snapshot file for every process to map. Returns whether one was published."""
+        if not self.shared_index:
+            return False
+        with self.store.maintenance_lock:
+            with self._write_lock:
+                self.refresh()
+                if self.index is None or self.index.ntotal == 0 or self._index_kind(self.index) != "flat":
+                    return False
+                epoch, rows = self._epoch, self._index_rows()
+                index = faiss.IndexFlatIP(self.dimension)
+                for part in (self._base_index, self.index):
+                    if part is not None and part.ntotal:
+                        index.add(part.reconstruct_n(0, part.ntotal))
+            # Written outside the write lock, the rows it covers never change within an epoch
+            published = self.store.write_index_snapshot(rows, epoch, lambda path: faiss.write_index(index, path))
+            with self._write_lock:
+                self.refresh()
+                with self._applying():
+                    self._map_snapshot()
+        return published
         
-        # Normalize query vector
-        faiss.normalize_L2(query_vector)
+    def query(self, query_text: str, n_results: int = 5, collapse: bool = False,
+              nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+              where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Query the FAISS vector database for similar documents.
         
-        # Search in FAISS index
-        n_results = min(n_results, len(self.documents))
-        scores, indices = self.index.search(query_vector, n_results)
+        With ``collapse=True`` passages sharing a ``parent_id`` in their
+        metadata are folded into their parent document: each parent is
+        reported once, under its own ID, with the best matching passage as
+        its content and ``passage_id``/``matched_passages`` in its metadata.
+        ``nprobe`` and ``ef_search`` trade recall for speed on IVF and HNSW
+        indexes. ``where`` only returns documents whose metadata matches the
+        filter, e.g. ``{"filename": "notes.txt", "upload_time": {"$gte": t}}``;
+        raises ValueError for an invalid filter.
+        """
+        results = self.query_batch([query_text], n_results, collapse, nprobe, ef_search, where)[0]
+        logger.info(f"Query returned {len(results['documents'])} results")
+        return results
         
-        # Convert to lists and filter valid results
-        scores = scores[0].tolist()
-        indices = indices[0].tolist()
+    def query_batch(self, query_texts: List[str], n_results: int = 5, collapse: bool = False,
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                    where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Query for many texts at once, returning one ``query`` result per text.
         
-        # Filter out invalid indices and low scores
-        valid_results = [(idx, score) for idx, score in zip(indices, scores) 
-                        if idx != -1 and score > 0.01]
+        All texts are vectorized in one call and searched with one call on
+        the whole query matrix, which lets FAISS batch the distance
+        computations. Cached results are served without touching the index;
+        only the remaining texts are vectorized and searched. ``where``
+        applies to every text.
+        """
+        if where:
+            validate_where(where)
+        self.refresh(wait=False)
+        if not query_texts:
+            return []
+        timings = []
+        try:
+            with self._state_lock.read():
+                return self._query_batch(query_texts, n_results, collapse, nprobe, ef_search, where, timings)
+        finally:
+            for stage, seconds in timings:
+                STAGE_SECONDS.observe(seconds, operation="search", stage=stage)
         
-        results = {
-            "documents": [self.documents[idx] for idx, _ in valid_results],
-            "metadata": [self.metadata[idx] for idx, _ in valid_results],
-            "ids": [self.document_ids[idx] for idx, _ in valid_results],
-            "distances": [1 - score for _, score in valid_results]  # Convert similarity to distance
-        }
+    def _query_batch(self, query_texts: List[str], n_results: int, collapse: bool, nprobe: Optional[int],
+                     ef_search: Optional[int], where: Optional[Dict[str, Any]],
+                     timings: List[Tuple[str, float]]) -> List[Dict[str, Any]]:
+        """``query_batch`` on the current state, with the state lock held for reading.
         
-        logger.info(f"FAISS query returned {len(results['documents'])} results")
+        Stage durations are appended to ``timings`` rather than observed under the lock.
+        """
+        if self.get_document_count() == 0 or self.index is None:
+            return [{"documents": [], "metadata": [], "ids": [], "distances": []} for _ in query_texts]
+        
+        generation = self._generation
+        options = (n_results, collapse, nprobe or self.nprobe, ef_search or self.ef_search, where_key(where))
+        keys = [(normalize_query(text),) + options for text in query_texts]
+        results = [self._query_cache.get(key, generation) for key in keys]
+        misses = [position for position, cached in enumerate(results) if cached is None]
+        if not misses:
+            return results
+        
+        # Transform queries using the same vectorizer
+        with _timed(timings, "vectorize"):
+            query_vectors = self._query_vectors([query_texts[position] for position in misses])
+        
+        rows = None
+        available = self.get_document_count()
+        if where:
+            with _timed(timings, "filter"):
+                rows = self._filter_rows(where)
+            available = len(rows)
+            if not available:
+                for position in misses:
+                    results[position] = self._results([])
+                return results
+        
+        # Collapsing needs more hits than parents, so fetch extra and widen as needed
+        k = min(n_results * 4 if collapse else n_results, available)
+        rerank = self.rerank and self.backend == "faiss" and self._index_compression(self.index) != "none"
+        computed = [None] * len(misses)
+        pending = np.arange(len(misses))
+        while len(pending):
+            fetch = min(k * self.rerank, available) if rerank else k
+            with _timed(timings, "index_search"):
+                scores, indices = self._search(query_vectors[pending], fetch, nprobe, ef_search, rows)
+            if rerank:
+                with _timed(timings, "rerank"):
+                    scores, indices = self._rerank(query_vectors[pending], scores, indices, k)
+            widen = []
+            # Reading the documents and metadata of the hits
+            with _timed(timings, "materialize"):
+                for row, position in enumerate(pending.tolist()):
+                    # Filter out invalid indices and low scores
+                    valid_results = [(idx, score) for idx, score in zip(indices[row].tolist(), scores[row].tolist())
+                                    if idx != -1 and score > 0.01]
+                    if not collapse:
+                        computed[position] = self._results(valid_results)
+                        continue
+                    hits = self._collapse(valid_results)
+                    if len(hits) >= n_results or k >= available or len(valid_results) < k:
+                        computed[position] = self._collapsed_results(hits[:n_results])
+                    else:
+                        widen.append(position)
+            pending = np.array(widen, dtype=np.int64)
+            k = min(k * 4, available)
+        
+        for position, result in zip(misses, computed):
+            self._query_cache.put(keys[position], generation, result)
+            results[position] = result
+        
+        if len(query_texts) > 1:
+            logger.info(f"Batch of {len(query_texts)} queries returned {sum(len(r['ids']) for r in results)} results")
         return results
         
+    def _rerank(self, vectors, scores, indices, k: int):
+        """Re-score the candidates of a compressed index exactly and keep the top ``k`` per query.
+        
+        The candidates' documents are vectorized again rather than keeping an
+        uncompressed copy of every vector in memory.
+        """
+        found = indices >= 0
+        rows = np.unique(indices[found])
+        if len(rows):
+            exact = self._prepare(self.vectorizer.transform([self.documents[row] for row in rows]))
+            similarities = vectors @ exact.T
+            positions = np.searchsorted(rows, np.where(found, indices, rows[0]))
+            scores = np.where(found, np.take_along_axis(similarities, positions, axis=1), -np.inf).astype(np.float32)
+        order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+        
+    def _results(self, hits):
+        """Format ranked (row, score) hits."""
+        return {
+            "documents": [self.documents[idx] for idx, _ in hits],
+            "metadata": [self.metadata[idx] for idx, _ in hits],
+            "ids": [self.document_ids[idx] for idx, _ in hits],
+            "distances": [self._distance(score) for _, score in hits]
+        }
+        
+    def _collapsed_results(self, hits):
+        """Format hits grouped by ``_collapse``."""
+        return {
+            "documents": [self.documents[idx] for _, idx, _, _ in hits],
+            "metadata": [dict(self.metadata[idx], passage_id=self.document_ids[idx], matched_passages=matches)
+                         for _, idx, _, matches in hits],
+            "ids": [parent for parent, _, _, _ in hits],
+            "distances": [self._distance(score) for _, _, score, _ in hits]
+        }
+        
+    def _collapse(self, results):
+        """Group ranked (row, score) hits by parent document, best hit first.
+        
+        Returns (parent ID, best row, best score, matching passages) tuples.
+        Rows without a ``parent_id`` are their own parent.
+        """
+        hits = {}
+        for idx, score in results:
+            meta = self.metadata[idx] or {}
+            parent = meta.get("parent_id", self.document_ids[idx])
+            if parent in hits:
+                hits[parent][3] += 1
+            else:
+                hits[parent] = [parent, idx, score, 1]
+        return [tuple(hit) for hit in hits.values()]
+        
     def get_document_count(self) -> int:
-        """Get the number of documents in the database."""
-        return len(self.documents)
+        """Get the number of documents in the database.
+        
+        Reads the count kept by ``_applying`` without taking any lock, so it
+        is safe to call from metric callbacks.
+        """
+        return self._counts[0]
         
     def delete_by_id(self, doc_id: str) -> bool:
-        """Delete a document by its ID."""
-        try:
-            index = self.document_ids.index(doc_id)
-            del self.documents[index]
-            del self.metadata[index]
-            del self.document_ids[index]
-            
-            # Rebuild index after deletion
-            self._rebuild_index()
-            self._save_data()
+        """Delete a document by its ID.
+        
+        The row is only tombstoned, so this takes constant time; the space is
+        reclaimed by a later compaction.
+        """
+        with self._write_lock:
+            while True:
+                with self.store.lock:
+                    self.refresh()
+                    row = self._id_to_row.get(doc_id)
+                    if row is None:
+                        logger.warning(f"Document with ID {doc_id} not found")
+                        return False
+                    # Fails if another process renumbered the rows since the refresh
+                    if self.store.delete(row, epoch=self._epoch):
+                        generation = self.store.generation
+                        break
+            with self._applying(generation):
+                del self._id_to_row[doc_id]
+                self._tombstones.add(row)
+                self._excluded = None
             
-            logger.info(f"Deleted document with ID: {doc_id}")
+        logger.info(f"Deleted document with ID: {doc_id}")
+        self._maybe_maintain()
+        return True
+        
+    def _tombstone_ratio(self) -> float:
+        return len(self._tombstones) / len(self.documents) if self.documents else 0.0
+        
+    def _needs_compaction(self) -> bool:
+        return self._tombstone_ratio() > self.compaction_threshold
+        
+    def _needs_reindex(self) -> bool:
+        if self.backend == "sparse" or self.index is None:
+            return False
+        n_rows = len(self.documents)
+        kind = self._index_kind(self.index)
+        if kind != self._index_kind_for(n_rows):
+            return True
+        if self._index_compression(self.index) != self._compression_for(kind, n_rows):
+            return True
+        # Retrain once the lists hold about four times the rows they were trained for
+        return kind in ("ivf", "ivfpq") and self._nlist(n_rows) >= 2 * self.index.nlist
+        
+    def _oov_rate(self) -> float:
+        """Share of the term occurrences indexed since the last fit whose terms it did not know."""
+        return self._oov_terms / self._new_terms if self._new_terms else 0.0
+        
+    def _needs_refit(self) -> bool:
+        if self.index is None or self.scoring == "bm25":
+            return False
+        n_rows = len(self.documents)
+        if (self.refit_interval and n_rows != self._fitted_rows
+                and time.monotonic() - self._fitted_at >= self.refit_interval):
             return True
-        except ValueError:
-            logger.warning(f"Document with ID {doc_id} not found")
+        if n_rows < self.refit_min_rows:
             return False
-            
-    def clear(self):
-        """Clear all documents from the database."""
-        self.documents = []
-        self.metadata = []
-        self.document_ids = []
-        self.index = None
-        self._save_data()
-        logger.info("Cleared all documents from FAISS vector database")
+        if n_rows - self._fitted_rows >= self.refit_growth * self._fitted_rows:
+            return True
+        return self._new_terms >= self.refit_min_terms and self._oov_rate() >= self.refit_oov
         
-    def _save_data(self):
-        """Save data and FAISS index to disk for persistence."""
-        try:
-            # Save document data
-            data = {
-                "documents": self.documents,
-                "metadata": self.metadata,
-                "document_ids": self.document_ids
-            }
+    def _refit_periodically(self):
+        while True:
+            time.sleep(self.refit_interval)
+            try:
+                self._maybe_maintain()
+            except Exception as e:
+                logger.error(f"Error scheduling a re-fit: {e}")
+        
+    def _needs_snapshot(self) -> bool:
+        return (self.shared_index and self.index is not None and self._index_kind(self.index) == "flat"
+                and self.index.ntotal >= self.snapshot_interval)
+        
+    def _maybe_maintain(self):
+        """Start a background compaction, reindex, re-fit or snapshot once one is due.
+        
+        Compaction starts once the tombstone ratio passes the threshold, a
+        reindex once the index type no longer suits the corpus size, a re-fit
+        once the vocabulary has drifted (see ``_needs_refit``), and a
+        snapshot once ``snapshot_interval`` rows are indexed privately.
+        """
+        if not (self._needs_compaction() or self._needs_reindex() or self._needs_refit() or self._needs_snapshot()):
+            return
+        if self._maintenance_thread is None or not self._maintenance_thread.is_alive():
+            self._maintenance_thread = threading.Thread(target=self._maintain, daemon=True)
+            self._maintenance_thread.start()
             
-            data_file = os.path.join(self.persist_directory, "data.json")
-            with open(data_file, 'w') as f:
-                json.dump(data, f, indent=2)
+    def _maintain(self):
+        with self.store.maintenance_lock:
+            # Another process may have done the work while this one waited for the lock
+            self.refresh()
+            if self._needs_compaction():
+                self.compact()
+            elif self._needs_reindex():
+                self.reindex()
+            elif self._needs_refit():
+                self.refit()
+            elif self._needs_snapshot():
+                self.publish_snapshot()
             
-            # Save vectorizer
-            vectorizer_file = os.path.join(self.persist_directory, "vectorizer.pkl")
-            with open(vectorizer_file, 'wb') as f:
-                pickle.dump(self.vectorizer, f)
+    def wait_for_compaction(self):
+        """Block until a running background compaction, reindex, re-fit or snapshot has finished."""
+        if self._maintenance_thread is not None:
+            self._maintenance_thread.join()
             
-            # Save FAISS index
-            if self.index is not None:
-                index_file = os.path.join(self.persist_directory, "faiss.index")
-                faiss.write_index(self.index, index_file)
+    def compact(self) -> bool:
+        """Drop tombstoned rows from memory, the index and storage.
+        
+        The new state is built off to the side from a snapshot and swapped in
+        under the write lock, together with any documents added or deleted in
+        the meantime, by this or another process. Returns whether anything
+        was compacted.
+        """
+        with self.store.maintenance_lock:
+            started = time.perf_counter()
+            # Holding the store still makes the plan match the in-memory rows
+            with self._write_lock, self.store.lock:
+                self.refresh()
+                n_rows = len(self.documents)
+                dropped = set(self._tombstones)
+                if not dropped:
+                    return False
+                documents, ids = self.documents, self.document_ids
+                plan = self.store.plan_compaction()
+                
+            # Rows below n_rows are never modified in place, so they can be read without the lock
+            self.store.write_compaction(plan)
+            keep = [row for row in range(n_rows) if row not in dropped]
+            new_documents = documents.take(keep)
+            new_ids = [ids[row] for row in keep]
+            counts = self.store.read_plan_vectors(plan) if self.incremental else None
+            if counts is not None and counts.shape != (len(keep), self.dimension):
+                counts = None
+            vectorizer, index = self._build_index(new_documents, counts) if keep else (self._new_vectorizer(), None)
+            id_to_row = {doc_id: row for row, doc_id in enumerate(new_ids)}
+            new_row = np.cumsum([row not in dropped for row in range(n_rows)]) - 1
             
-            logger.debug(f"Saved FAISS data to {self.persist_directory}")
-        except Exception as e:
-            logger.error(f"Error saving FAISS data: {e}")
+            with self._write_lock, self.store.lock:
+                self.refresh()
+                # Carry over documents added and deleted since the snapshot
+                added = slice(n_rows, len(self.documents))
+                offset = len(keep) - n_rows
+                if added.start < added.stop:
+                    new_ids.extend(self.document_ids[added])
+                    for row, doc_id in enumerate(self.document_ids[added], start=len(keep)):
+                        id_to_row[doc_id] = row
+                    index = self._extend_index(vectorizer, index, self.documents[added])
+                tombstones = set()
+                for row in self._tombstones - dropped:
+                    row = int(new_row[row]) if row < n_rows else row + offset
+                    tombstones.add(row)
+                    if id_to_row.get(new_ids[row]) == row:
+                        del id_to_row[new_ids[row]]
+                        
+                self.store.commit_compaction(plan)
+                with self._applying():
+                    (self.documents, self.metadata), self.document_ids = self.store.columns(), new_ids
+                    self.vectorizer, self.index = vectorizer, index
+                    self._base_index, self._snapshot = None, None
+                    self._mark_fitted()
+                    # Cached results were ranked by the old index
+                    self._query_cache.clear()
+                    # Rows were renumbered
+                    self._metadata_index = None
+                    self._id_to_row = id_to_row
+                    self._tombstones = tombstones
+                    self._excluded = None
+                    self._epoch, self._generation = self.store.epoch, self.store.generation
+                
+            logger.info(f"Compacted {len(dropped)} deleted documents")
+            self.publish_snapshot()
+            STAGE_SECONDS.observe(time.perf_counter() - started, operation="maintenance", stage="compact")
+        return True
+        
+    def reindex(self) -> bool:
+        """Rebuild the index as the type suited to the current number of documents.
+        
+        Runs in the background when the corpus crosses ``ann_threshold`` or
+        an IVF index outgrows its lists. Like a compaction, the new index is
+        built off to the side and swapped in together with the documents
+        added in the meantime. Returns whether the index was rebuilt.
+        """
+        if self.backend == "sparse":
+            return False
+        return self._rebuild("reindex")
+        
+    def refit(self) -> bool:
+        """Re-fit the vectorizer to the current documents and rebuild the index with it.
+        
+        Runs in the background once the drift since the last fit passes the
+        ``refit_*`` thresholds. Built off to the side like ``reindex``; until
+        the swap, searches use the old vectorizer and index. Returns whether
+        anything was re-fitted.
+        """
+        if self.scoring == "bm25":
+            # Raw counts are indexed and weighted at query time, nothing goes stale
+            return False
+        return self._rebuild("refit")
+        
+    def _rebuild(self, stage: str) -> bool:
+        """Build a new vectorizer and index from a snapshot of the rows and swap them in."""
+        with self.store.maintenance_lock:
+            started = time.perf_counter()
+            with self._write_lock:
+                self.refresh()
+                n_rows = len(self.documents)
+                if not n_rows:
+                    return False
+                documents = self.documents[:n_rows]
+                
+            counts = self.store.read_vectors(n_rows) if self.incremental else None
+            if counts is not None and counts.shape != (n_rows, self.dimension):
+                counts = None
+            vectorizer, index = self._build_index(documents, counts)
             
-    def _load_data(self):
-        """Load data and FAISS index from disk if they exist."""
-        data_file = os.path.join(self.persist_directory, "data.json")
-        vectorizer_file = os.path.join(self.persist_directory, "vectorizer.pkl")
-        index_file = os.path.join(self.persist_directory, "faiss.index")
+            with self._write_lock:
+                self.refresh()
+                if len(self.documents) > n_rows:
+                    index = self._extend_index(vectorizer, index, self.documents[n_rows:])
+                with self._applying():
+                    self.vectorizer, self.index = vectorizer, index
+                    self._base_index, self._snapshot = None, None
+                    self._mark_fitted()
+                    self._refits += 1
+                    # Cached results were ranked by the old index
+                    self._query_cache.clear()
+                
+            kind = f"{self._index_kind(index)} index" if self.backend == "faiss" else "sparse index"
+            logger.info(f"Rebuilt {kind} for {n_rows} documents ({stage}) in {time.perf_counter() - started:.2f}s")
+            self.publish_snapshot()
+            STAGE_SECONDS.observe(time.perf_counter() - started, operation="maintenance", stage=stage)
+        return True
+        
+    def _extend_index(self, vectorizer, index, documents: List[str]):
+        """Add documents to an index built by ``_build_index``. Returns the index, created if None."""
+        if self.incremental:
+            counts = self._count(documents)
+            vectorizer.update(counts)
+            vectors = counts if self.scoring == "bm25" else vectorizer.weight(counts)
+        else:
+            vectors = vectorizer.transform(documents)
+        vectors = self._prepare(vectors)
+        if index is None:
+            index = self._new_index(vectors.shape[1], vectors.shape[0])
+        self._train_and_add(index, vectors)
+        return index
+            
+    def clear(self):
+        """Clear all documents from the database."""
+        with self.store.maintenance_lock, self._write_lock, self.store.lock, self._applying():
+            self._reset()
+            self._loaded = True
+            self.store.clear()
+            self._epoch, self._generation = self.store.epoch, self.store.generation
+        logger.info("Cleared all documents from FAISS vector database")
         
+    def _load_data(self):
+        """Replay the segment manifest to restore documents and the index."""
         try:
-            # Load document data
-            if os.path.exists(data_file):
-                with open(data_file, 'r') as f:
-                    data = json.load(f)
+            if not self.store.exists():
+                with self.store.maintenance_lock:
+                    # Only the first of several processes migrates
+                    if not self.store.exists():
+                        self._migrate_legacy_data()
+                
+            self._generation = self.store.refresh()
+            self._epoch = self.store.epoch
+            counts = []
+            for ids, documents, metadata, vectors, deleted in self.store.load():
+                self._tombstones.update(len(self.documents) + line for line in deleted)
+                self.document_ids.extend(ids)
+                self.documents.extend(documents)
+                self.metadata.extend(metadata)
+                if self.incremental and ids and (vectors is None or vectors.shape[1] != self.dimension):
+                    # Stored counts are reused, only segments without them (or from another feature space) are tokenized
+                    vectors = self._count(documents)
+                counts.append(vectors)
+            self._index_ids()
                 
-                self.documents = data.get("documents", [])
-                self.metadata = data.get("metadata", [])
-                self.document_ids = data.get("document_ids", [])
-            
-            # Load vectorizer
-            if os.path.exists(vectorizer_file):
-                with open(vectorizer_file, 'rb') as f:
-                    self.vectorizer = pickle.load(f)
-            
-            # Load FAISS index
-            if os.path.exists(index_file) and self.documents:
-                self.index = faiss.read_index(index_file)
-                logger.info(f"Loaded FAISS index with {len(self.documents)} documents")
-            elif self.documents:
-                # If we have documents but no index, rebuild it
-                self._rebuild_index()
+            if self.documents:
+                counts = sparse.vstack([vectors for vectors in counts if vectors is not None],
+                                       format='csr') if self.incremental else None
+                if counts is None or not self._load_snapshot(counts):
+                    self._rebuild_index(counts)
+                logger.info(f"Loaded {len(self.documents) - len(self._tombstones)} documents from {self.store.segment_count} segments")
+                self._maybe_maintain()
                 
         except Exception as e:
-            logger.error(f"Error loading FAISS data: {e}")
+            logger.error(f"Error loading vector database: {e}")
             # Reset to empty state on error
-            self.documents = []
-            self.metadata = []
-            self.document_ids = []
-            self.index = None
+            self._reset()
+            
+    def _load_snapshot(self, counts: sparse.csr_matrix) -> bool:
+        """Map the published index snapshot and only index the rows after it.
+        
+        The IDF statistics still come from the counts of every row. Returns
+        False if there is no snapshot this process can use.
+        """
+        snapshot = self.store.index_snapshot
+        if (not self.shared_index or not snapshot or snapshot["epoch"] != self._epoch
+                or snapshot["rows"] > counts.shape[0] or self._index_kind_for(counts.shape[0]) != "flat"):
+            return False
+        base = self._read_snapshot(snapshot)
+        if base is None:
+            return False
+        self.vectorizer = self._new_vectorizer()
+        self.vectorizer.update(counts)
+        self.index = faiss.IndexFlatIP(self.dimension)
+        if counts.shape[0] > snapshot["rows"]:
+            self.index.add(self._prepare(self._weighted(counts[snapshot["rows"]:])))
+        self._base_index, self._snapshot = base, snapshot["name"]
+        self._mark_fitted()
+        logger.info(f"Mapped index snapshot {snapshot['name']} of {snapshot['rows']} rows")
+        return True
+        
+    def _read_snapshot(self, snapshot: Dict[str, Any]):
+        """Memory-map a published index snapshot read-only. Returns None if it is unusable."""
+        if not self.store.verify_snapshot(snapshot):
+            logger.error(f"Index snapshot {snapshot['name']} does not match its checksum, not mapping it")
+            return None
+        try:
+            base = faiss.read_index(self.store.snapshot_path(snapshot), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            # Replaced by a newer snapshot in the meantime
+            logger.warning(f"Could not map index snapshot {snapshot['name']}: {e}")
+            return None
+        if base.d != self.dimension or base.ntotal != snapshot["rows"]:
+            return None
+        return base
+            
+    def _index_ids(self):
+        """Build the ID -> row index, deleting all but the newest copy of duplicated IDs.
+        
+        Duplicates can only come from data written before IDs were unique.
+        """
+        self._id_to_row = {}
+        duplicates = []
+        for row, doc_id in enumerate(self.document_ids):
+            if row in self._tombstones:
+                continue
+            if doc_id in self._id_to_row:
+                duplicates.append(self._id_to_row[doc_id])
+            self._id_to_row[doc_id] = row
+        if not duplicates:
+            return
+        with self.store.lock:
+            for row in duplicates:
+                # Another process renumbering the rows meanwhile dropped them already
+                if self.store.delete(row, epoch=self._epoch):
+                    self._tombstones.add(row)
+        logger.warning(f"Deleted {len(duplicates)} older copies of duplicated document IDs")
+        
+    def _migrate_legacy_data(self):
+        """Move a store written as a single data.json into a segment."""
+        data_file = os.path.join(self.persist_directory, "data.json")
+        if not os.path.exists(data_file):
+            return
+        with open(data_file, 'r') as f:
+            data = json.load(f)
+        documents = data.get("documents", [])
+        counts = self.vectorizer.count(documents) if self.incremental and documents else None
+        self.store.append(data.get("document_ids", []), documents, data.get("metadata", []), counts)
+        
+        for filename in ("data.json", "vectorizer.pkl", "faiss.index", "sparse_index.npz"):
+            path = os.path.join(self.persist_directory, filename)
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info(f"Migrated {len(documents)} documents from {data_file} to segment storage")
     
     def get_stats(self) -> Dict[str, Any]:
         """Get statistics about the vector database."""
+        self.refresh(wait=False)
+        with self._state_lock.read():
+            return self._stats()
+        
+    def _stats(self) -> Dict[str, Any]:
+        # Both parts of a shared index count, the mapped snapshot is memory too
+        parts = [part for part in (self._base_index, self.index) if part is not None]
+        memory = [self._index_memory(part) for part in parts]
+        index_memory = sum(total for _, total in memory)
+        rows = sum(part.ntotal for part in parts)
+        bytes_per_vector = sum(size * part.ntotal for (size, _), part in zip(memory, parts)) / rows if rows else None
         stats = {
-            "document_count": len(self.documents),
+            "document_count": self.get_document_count(),
+            "deleted_count": len(self._tombstones),
             "has_index": self.index is not None,
-            "index_size": self.index.ntotal if self.index else 0,
+            "index_size": self._index_rows(),
             "vector_dimension": self.dimension,
+            "incremental": self.incremental,
+            "backend": self.backend,
+            "scoring": self.scoring,
+            "segments": self.store.segment_count,
+            "durability": self.store.durability,
+            "uncommitted_writes": self.store.uncommitted_writes,
+            "generation": self._generation,
+            "shared_index": self.shared_index,
+            "index_type": self.index_type,
+            "active_index": self._index_kind(self.index) if self.backend == "faiss" and self.index is not None else None,
+            "mapped_rows": self._base_index.ntotal if self._base_index is not None else 0,
+            "compression": self.compression,
+            "active_compression": self._index_compression(self.index) if self.backend == "faiss" and self.index is not None else None,
+            "rerank": self.rerank,
+            "bytes_per_vector": bytes_per_vector,
+            "index_memory_bytes": index_memory,
+            "query_cache": self._query_cache.get_stats(),
+            "vector_cache": self._vector_cache.get_stats(),
+            "refit": {
+                "refits": self._refits,
+                "fitted_rows": self._fitted_rows,
+                "rows_since_fit": len(self.documents) - self._fitted_rows,
+                "oov_rate": self._oov_rate(),
+                "seconds_since_fit": time.monotonic() - self._fitted_at,
+            },
             "persist_directory": self.persist_directory
         }
         return stats
+    
+    # Document-level API used by the Flask app and the upload worker
+    
+    def add_document(self, doc_id: str, content: str, metadata: Dict[str, Any] = None) -> bool:
+        """Add a single document. Returns False if it could not be stored."""
+        try:
+            self.add_documents([content], [metadata or {}], [doc_id])
+            return True
+        except Exception as e:
+            logger.error(f"Error adding document {doc_id}: {e}")
+            return False
+            
+    def search(self, query_text: str, n_results: int = 5, collapse: bool = False,
+               nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+               where: Optional[Dict[str, Any]] = None) -> Dict[str, List[List[Any]]]:
+        """Search documents, returning results nested per query (Chroma-style)."""
+        results = self.query(query_text, n_results, collapse, nprobe, ef_search, where)
+        return self._nested([results])
+        
+    def search_batch(self, query_texts: List[str], n_results: int = 5, collapse: bool = False,
+                     nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                     where: Optional[Dict[str, Any]] = None) -> Dict[str, List[List[Any]]]:
+        """Search documents for many queries at once, one nested list per query (Chroma-style)."""
+        return self._nested(self.query_batch(query_texts, n_results, collapse, nprobe, ef_search, where))
+        
+    @staticmethod
+    def _nested(results: List[Dict[str, Any]]) -> Dict[str, List[List[Any]]]:
+        return {
+            "ids": [r["ids"] for r in results],
+            "documents": [r["documents"] for r in results],
+            "metadatas": [r["metadata"] for r in results],
+            "distances": [r["distances"] for r in results]
+        }
+        
+    def search_documents(self, query_text: str, n_results: int = 5, collapse: bool = False,
+                         nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                         where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, List[List[Any]]]]:
+        """Search documents. Returns None if the search fails."""
+        try:
+            return self.search(query_text, n_results, collapse, nprobe, ef_search, where)
+        except Exception as e:
+            logger.error(f"Error searching documents: {e}")
+            return None
+            
+    def search_documents_batch(self, query_texts: List[str], n_results: int = 5, collapse: bool = False,
+                               nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                               where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, List[List[Any]]]]:
+        """Search documents for many queries. Returns None if the search fails."""
+        try:
+            return self.search_batch(query_texts, n_results, collapse, nprobe, ef_search, where)
+        except Exception as e:
+            logger.error(f"Error searching documents in batch: {e}")
+            return None
+            
+    def list_documents(self) -> List[Dict[str, Any]]:
+        """List all stored documents."""
+        self.refresh(wait=False)
+        with self._state_lock.read():
+            return [
+                {"id": doc_id, "content": content, "metadata": meta}
+                for row, (doc_id, content, meta) in enumerate(zip(self.document_ids, self.documents, self.metadata))
+                if row not in self._tombstones
+            ]
+        
+    def list_documents_page(self, limit: int = 100, after: Optional[str] = None,
+                            fields: Sequence[str] = DOCUMENT_FIELDS) -> Tuple[Iterator[Dict[str, Any]], Optional[str]]:
+        """List up to ``limit`` stored documents in insertion order.
+        
+        Returns an iterator over the page, which only reads each document as
+        it is consumed, and the cursor to pass as ``after`` for the next page
+        (None after the last page). ``fields`` selects which of ``id``,
+        ``content`` and ``metadata`` each document includes. Raises
+        ValueError for an unknown field or an invalid cursor.
+        """
+        unknown = [field for field in fields if field not in DOCUMENT_FIELDS]
+        if unknown or not fields:
+            raise ValueError(f"fields must be a non-empty subset of {', '.join(DOCUMENT_FIELDS)}")
+        self.refresh(wait=False)
+        with self._state_lock.read():
+            # A compaction swaps in new lists, so these stay consistent while the page is read
+            values = {"id": self.document_ids, "content": self.documents, "metadata": self.metadata}
+            tombstones = self._tombstones
+            row = self._cursor_row(after) if after else 0
+            rows = []
+            while row < len(self.document_ids) and len(rows) < limit:
+                if row not in tombstones:
+                    rows.append(row)
+                row += 1
+            more = any(row not in tombstones for row in range(row, len(self.document_ids)))
+            next_cursor = self._cursor(rows[-1]) if rows and more else None
+        
+        fields = [field for field in DOCUMENT_FIELDS if field in fields]
+        page = ({field: values[field][row] for field in fields} for row in rows)
+        return page, next_cursor
+        
+    def _cursor(self, row: int) -> str:
+        """Opaque listing cursor pointing after ``row``."""
+        return base64.urlsafe_b64encode(json.dumps([self._epoch, row, self.document_ids[row]]).encode()).decode()
+        
+    def _cursor_row(self, cursor: str) -> int:
+        """First row after a listing cursor.
+        
+        Rows keep their numbers until a compaction renumbers them; after
+        that the listing resumes after the cursor document's new row.
+        """
+        try:
+            epoch, row, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+        if epoch == self._epoch and isinstance(row, int) and 0 <= row < len(self.document_ids) \
+                and self.document_ids[row] == doc_id:
+            return row + 1
+        row = self._id_to_row.get(doc_id)
+        if row is None:
+            raise ValueError("Cursor expired, restart the listing")
+        return row + 1
+        
+    def find_by_metadata(self, field: str, values: List[Any]) -> Dict[Any, str]:
+        """Map each of ``values`` that a live document has as its ``field`` metadata to the ID of one such document.
+        
+        Looked up in the metadata index, e.g. to find stored copies of content by its hash.
+        """
+        if not values:
+            return {}
+        self.refresh(wait=False)
+        found = {}
+        with self._state_lock.read():
+            for row in self._filter_rows({field: {"$in": list(values)}}):
+                found.setdefault((self.metadata[row] or {}).get(field), self.document_ids[row])
+        return found
+        
+    def get_document(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Get a document by its ID, or None if it does not exist."""
+        self.refresh(wait=False)
+        with self._state_lock.read():
+            index = self._id_to_row.get(doc_id)
+            if index is None:
+                return None
+            return {
+                "id": doc_id,
+                "content": self.documents[index],
+                "metadata": self.metadata[index]
+            }
+        
+    def delete_document(self, doc_id: str) -> bool:
+        """Delete a document by its ID."""
+        return self.delete_by_id(doc_id)
+        
+    def update_document(self, doc_id: str, content: str, metadata: Dict[str, Any] = None) -> bool:
+        """Replace the content and metadata of an existing document.
+        
+        The new version is tokenized and stored before the old one is
+        tombstoned, and both are applied in one step, so searches in this
+        process see the old or the new version, never neither. Returns False,
+        keeping the old version, if the document does not exist or the new
+        one could not be stored.
+        """
+        metadata = metadata or {}
+        self.warm_up()
+        try:
+            counts = self._count([content]) if self.incremental else None
+            with self._write_lock:
+                with self.store.lock:
+                    self.refresh()
+                    row = self._id_to_row.get(doc_id)
+                    if row is None:
+                        logger.warning(f"Document with ID {doc_id} not found")
+                        return False
+                    # Should the tombstone not be written, the newest copy of an ID wins when the store is loaded
+                    stored_at = self.store.append([doc_id], [content], [metadata], counts)
+                    self.store.delete(row, epoch=self._epoch)
+                    columns = self.store.columns(epoch=self._epoch)
+                    generation = self.store.generation
+                first_row = len(self.documents)
+                if stored_at != (self._epoch, first_row) or columns is None:
+                    self.refresh()
+                else:
+                    with self._applying(generation):
+                        self.documents, self.metadata = columns
+                        self.document_ids.append(doc_id)
+                        self._id_to_row[doc_id] = first_row
+                        self._tombstones.add(row)
+                        self._excluded = None
+                        self._index_new_rows([content], counts, first_row)
+        except Exception as e:
+            logger.error(f"Error updating document {doc_id}: {e}")
+            return False
+        
+        logger.info(f"Updated document with ID: {doc_id}")
+        self._maybe_maintain()
+        return True
+        
+    def get_collection_info(self) -> Optional[Dict[str, Any]]:
+        """Get information about the database for the /db-info endpoint."""
+        try:
+            info = self.get_stats()
+            info["name"] = os.path.basename(os.path.normpath(self.persist_directory))
+            info["count"] = info["document_count"]
+            return info
+        except Exception as e:
+            logger.error(f"Error getting database info: {e}")
+            return None
+
+
+# Options of the shared instance and of the shards of every collection
+DATABASE_OPTIONS = dict(
+    backend=os.getenv("VECTOR_DB_BACKEND", "faiss"),
+    scoring=os.getenv("VECTOR_DB_SCORING", "cosine"),
+    compaction_threshold=float(os.getenv("VECTOR_DB_COMPACTION_THRESHOLD", "0.2")),
+    shared_index=os.getenv("VECTOR_DB_SHARED_INDEX", "0").lower() in ("1", "true", "yes"),
+    index_type=os.getenv("VECTOR_DB_INDEX", "flat"),
+    ann_threshold=int(os.getenv("VECTOR_DB_ANN_THRESHOLD", "100000")),
+    nprobe=int(os.getenv("VECTOR_DB_NPROBE", "8")),
+    ef_search=int(os.getenv("VECTOR_DB_EF_SEARCH", "64")),
+    cache_size=int(os.getenv("VECTOR_DB_CACHE_SIZE", "1024")),
+    cache_bytes=int(os.getenv("VECTOR_DB_CACHE_BYTES", str(64 * 1024 * 1024))),
+    cache_ttl=float(os.getenv("VECTOR_DB_CACHE_TTL", "300")),
+    dimension=int(os.getenv("VECTOR_DB_DIMENSION", "0")) or None,
+    compression=os.getenv("VECTOR_DB_COMPRESSION", "none"),
+    rerank=int(os.getenv("VECTOR_DB_RERANK", "0")),
+    vector_cache_bytes=int(os.getenv("VECTOR_DB_VECTOR_CACHE_BYTES", str(64 * 1024 * 1024))),
+    refit_growth=float(os.getenv("VECTOR_DB_REFIT_GROWTH", "0.25")),
+    refit_oov=float(os.getenv("VECTOR_DB_REFIT_OOV", "0.1")),
+    refit_interval=float(os.getenv("VECTOR_DB_REFIT_INTERVAL", "0")),
+    durability=os.getenv("VECTOR_DB_DURABILITY", "write"),
+    commit_writes=int(os.getenv("VECTOR_DB_COMMIT_WRITES", "64")),
+    commit_interval=float(os.getenv("VECTOR_DB_COMMIT_INTERVAL", "1.0")),
+)
+
+# Shared instance used by the Flask app and the upload worker
+vector_db = VectorDatabase(
+    persist_directory=os.getenv("VECTOR_DB_DIR", "vector_db"),
+    # Loaded by warm_up (see gunicorn.conf.py) or the first request, not at import
+    lazy=True,
+    **DATABASE_OPTIONS,
+)
+DOCUMENTS.set_function(vector_db.get_document_count)
+INDEX_VECTORS.set_function(lambda: vector_db._counts[1])